@@ -0,0 +1,136 @@
+"""
+Local verification of Clerk session tokens.
+
+Clerk session JWTs are RS256-signed with keys published as a JWKS. The
+key set is fetched once, cached and refreshed every `refresh_interval`
+seconds, so verifying a request costs no network hop. A token signed
+with a kid we have not seen (Clerk rotated its keys) triggers one early
+refetch, rate-limited by `min_refetch_interval` so garbage kids cannot
+be used to hammer Clerk. If a refresh fails the previous keys stay in
+use.
+
+For tests and offline development the key set can be supplied locally
+(a JWKS file path or inline JSON), in which case nothing is fetched.
+"""
+import asyncio
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+import jwt
+import requests
+from jwt.exceptions import ExpiredSignatureError, InvalidTokenError, PyJWKSetError
+
+logger = logging.getLogger("server.clerk_auth")
+
+ALGORITHMS = ["RS256"]
+
+
+class ClerkTokenError(Exception):
+    pass
+
+
+class ClerkJWKSUnavailable(ClerkTokenError):
+    """No keys could be loaded; the token may well be valid."""
+
+
+def load_local_jwks(value: str) -> dict:
+    """A JWKS given inline as JSON or as the path of a JSON file."""
+    if value.lstrip().startswith("{"):
+        return json.loads(value)
+    return json.loads(Path(value).read_text())
+
+
+class ClerkJWKS:
+    def __init__(self, jwks_url: Optional[str] = None, local_jwks: Optional[dict] = None,
+                 refresh_interval: float = 3600.0, min_refetch_interval: float = 30.0, fetch_timeout: float = 5.0):
+        self.jwks_url = jwks_url
+        self.refresh_interval = refresh_interval
+        self.min_refetch_interval = min_refetch_interval
+        self.fetch_timeout = fetch_timeout
+        self._keys: Dict[str, jwt.PyJWK] = {}
+        self._fetched_at: Optional[float] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._local = local_jwks is not None
+        self.fetches = 0
+        if local_jwks is not None:
+            self._load(local_jwks)
+
+    @property
+    def configured(self) -> bool:
+        return self._local or bool(self.jwks_url)
+
+    def _load(self, jwks: dict):
+        # PyJWKSet drops keys it cannot use and raises if none are left
+        self._keys = {key.key_id: key for key in jwt.PyJWKSet.from_dict(jwks).keys}
+        self._fetched_at = time.monotonic()
+
+    def _fetch(self) -> dict:
+        response = requests.get(self.jwks_url, timeout=self.fetch_timeout)
+        response.raise_for_status()
+        return response.json()
+
+    async def refresh(self, force: bool = False):
+        if self._local or not self.jwks_url:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        fetched_at = self._fetched_at
+        async with self._lock:
+            # Another request refreshed while we waited for the lock
+            if self._fetched_at != fetched_at and not self._stale():
+                return
+            if not force and not self._stale():
+                return
+            try:
+                self._load(await asyncio.to_thread(self._fetch))
+                self.fetches += 1
+            except (requests.RequestException, ValueError, PyJWKSetError) as e:
+                if not self._keys:
+                    raise ClerkJWKSUnavailable(f"Clerk JWKS unavailable: {e}")
+                logger.warning(f"⚠️ Clerk JWKS refresh failed, keeping {len(self._keys)} cached keys: {e}")
+                # Back off so a Clerk outage is not retried on every request
+                self._fetched_at = time.monotonic() - self.refresh_interval + self.min_refetch_interval
+
+    def _age(self) -> float:
+        return float("inf") if self._fetched_at is None else time.monotonic() - self._fetched_at
+
+    def _stale(self) -> bool:
+        return self._age() >= self.refresh_interval
+
+    async def get_key(self, kid: Optional[str]) -> jwt.PyJWK:
+        await self.refresh()
+        if kid not in self._keys and self._age() >= self.min_refetch_interval:
+            # Unknown kid: Clerk may have rotated its signing key
+            await self.refresh(force=True)
+        if kid not in self._keys:
+            raise ClerkTokenError("Unknown signing key")
+        return self._keys[kid]
+
+
+async def verify_session_token(jwks: ClerkJWKS, token: str, issuer: Optional[str] = None,
+                               authorized_parties: Iterable[str] = (), leeway: float = 5.0) -> dict:
+    """Claims of a valid Clerk session token; `sub` is the Clerk user id."""
+    try:
+        header = jwt.get_unverified_header(token)
+    except InvalidTokenError:
+        raise ClerkTokenError("Invalid token")
+    if header.get("alg") not in ALGORITHMS:
+        raise ClerkTokenError("Invalid token")
+    key = await jwks.get_key(header.get("kid"))
+    try:
+        claims = jwt.decode(
+            token, key.key, algorithms=ALGORITHMS, issuer=issuer or None, leeway=leeway,
+            options={"require": ["exp", "iat", "sub"]}
+        )
+    except ExpiredSignatureError:
+        raise ClerkTokenError("Token expired")
+    except InvalidTokenError:
+        raise ClerkTokenError("Invalid token")
+    parties = set(authorized_parties)
+    # Clerk puts the requesting origin in azp; reject tokens minted for other sites
+    if parties and claims.get("azp") and claims["azp"] not in parties:
+        raise ClerkTokenError("Invalid authorized party")
+    return claims
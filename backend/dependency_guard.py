@@ -0,0 +1,112 @@
+"""
+Guards around blocking third-party SDK calls (Razorpay, Cloudinary).
+
+Each DependencyGuard runs calls in a worker thread with a deadline, limits
+how many may be in flight (bulkhead) and trips a circuit breaker after
+consecutive failures. While the breaker is open calls fail immediately
+with DependencyUnavailable; after reset_timeout one trial call is let
+through (half-open) and its outcome closes or re-opens the breaker.
+"""
+import asyncio
+import threading
+import time
+from typing import Callable, Optional
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class DependencyUnavailable(Exception):
+    def __init__(self, dependency: str, reason: str, retry_after: Optional[float] = None):
+        super().__init__(f"{dependency} unavailable: {reason}")
+        self.dependency = dependency
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class DependencyGuard:
+    def __init__(self, name: str, timeout: float, max_concurrency: int = 10,
+                 failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 is_failure: Callable[[BaseException], bool] = lambda exc: True):
+        self.name = name
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.is_failure = is_failure
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.in_flight = 0
+        self.rejected = 0
+        self._trial_in_flight = False
+        # Threads keep running after a deadline, so the slot is released when the thread ends
+        self._lock = threading.Lock()
+
+    def _admit(self):
+        with self._lock:
+            if self.state == OPEN:
+                remaining = self.opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    self.rejected += 1
+                    raise DependencyUnavailable(self.name, "circuit open", retry_after=remaining)
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and self._trial_in_flight:
+                self.rejected += 1
+                raise DependencyUnavailable(self.name, "circuit half-open", retry_after=self.reset_timeout)
+            # Checked before claiming the trial, which would otherwise never be released
+            if self.in_flight >= self.max_concurrency:
+                self.rejected += 1
+                raise DependencyUnavailable(self.name, "too many concurrent calls", retry_after=1)
+            if self.state == HALF_OPEN:
+                self._trial_in_flight = True
+            self.in_flight += 1
+
+    def _release(self, _=None):
+        with self._lock:
+            self.in_flight -= 1
+
+    def _abandon_trial(self):
+        """The caller went away; the outcome is unknown, so let the next call be the trial."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def _record(self, failed: bool):
+        with self._lock:
+            self._trial_in_flight = False
+            if not failed:
+                self.state = CLOSED
+                self.consecutive_failures = 0
+                return
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    async def call(self, fn, *args, **kwargs):
+        self._admit()
+        future = asyncio.ensure_future(asyncio.to_thread(fn, *args, **kwargs))
+        future.add_done_callback(self._release)
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            self._record(failed=True)
+            raise DependencyUnavailable(self.name, f"no response within {self.timeout}s")
+        except asyncio.CancelledError:
+            self._abandon_trial()
+            raise
+        except Exception as exc:
+            self._record(failed=self.is_failure(exc))
+            raise
+        self._record(failed=False)
+        return result
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "in_flight": self.in_flight,
+                "max_concurrency": self.max_concurrency,
+                "rejected": self.rejected,
+                "timeout_seconds": self.timeout,
+            }
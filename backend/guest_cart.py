@@ -0,0 +1,57 @@
+"""
+Signed guest carts.
+
+Anonymous visitors keep their cart client-side as a compact token:
+
+    v1.<base64url "issued_at:id1,id2,...">.<base64url truncated HMAC-SHA256>
+
+The server only verifies and re-signs it, so guest browsing never touches
+Mongo. Carts hold digital products, so an entry is just a product id
+(quantity is always 1). Tokens are merged into `carts` at login/checkout.
+"""
+import base64
+import hashlib
+import hmac
+import time
+from typing import List, Optional
+
+VERSION = "v1"
+SIGNATURE_BYTES = 16
+MAX_ITEMS = 50
+
+
+class GuestCartError(Exception):
+    pass
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(secret: str, payload: bytes) -> bytes:
+    return hmac.new(secret.encode(), VERSION.encode() + b"." + payload, hashlib.sha256).digest()[:SIGNATURE_BYTES]
+
+
+def encode_guest_cart(secret: str, product_ids: List[str], now: Optional[float] = None) -> str:
+    ids = list(dict.fromkeys(product_ids))[:MAX_ITEMS]
+    payload = f"{int(now or time.time())}:{','.join(ids)}".encode()
+    return f"{VERSION}.{_b64encode(payload)}.{_b64encode(_sign(secret, payload))}"
+
+
+def decode_guest_cart(secret: str, token: str, max_age_seconds: float, now: Optional[float] = None) -> List[str]:
+    try:
+        version, payload_part, signature_part = token.split(".")
+        payload = _b64decode(payload_part)
+        signature = _b64decode(signature_part)
+    except ValueError:
+        raise GuestCartError("Malformed guest cart")
+    if version != VERSION or not hmac.compare_digest(signature, _sign(secret, payload)):
+        raise GuestCartError("Invalid guest cart signature")
+    issued_at, _, ids = payload.decode().partition(":")
+    if (now or time.time()) - int(issued_at) > max_age_seconds:
+        raise GuestCartError("Guest cart expired")
+    return [product_id for product_id in ids.split(",") if product_id]
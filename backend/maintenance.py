@@ -0,0 +1,282 @@
+"""
+Batch maintenance jobs for the store database.
+
+    cd backend && python -m maintenance archive-orders --older-than-days 180
+    cd backend && python -m maintenance rebuild-recommendations
+    cd backend && python -m maintenance migrate-timestamps   # also backfills expires_at
+    cd backend && python -m maintenance migrate-uuid-ids [--swap]
+
+Jobs take a Motor database so the API can run them too (see the
+/api/admin/maintenance routes in server.py).
+"""
+import argparse
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReplaceOne, UpdateOne
+
+import recommendations
+import uuid_ids
+from timestamps import time_range, to_datetime
+
+logger = logging.getLogger("server.maintenance")
+
+ARCHIVABLE_ORDER_STATUSES = ["paid", "failed"]
+
+# Fields that used to be stored as ISO-8601 strings
+TIMESTAMP_FIELDS = [
+    ("users", "created_at"),
+    ("products", "created_at"),
+    ("carts", "updated_at"),
+    ("orders", "created_at"),
+    ("orders_archive", "created_at"),
+    ("product_chapters", "updated_at"),
+]
+
+
+async def archive_orders(db, older_than_days: int, batch_size: int = 500, max_batches: int = None) -> dict:
+    """
+    Move settled orders older than the cutoff from orders to orders_archive.
+
+    Each batch is upserted into the archive before it is deleted from
+    orders, so an interrupted run can simply be repeated.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days=older_than_days)
+    query = {"status": {"$in": ARCHIVABLE_ORDER_STATUSES}, **time_range("created_at", lt=cutoff)}
+    archived = batches = 0
+    while max_batches is None or batches < max_batches:
+        orders = await db.orders.find(query, {"_id": 0}).sort("created_at", 1).limit(batch_size).to_list(batch_size)
+        if not orders:
+            break
+        await db.orders_archive.bulk_write(
+            [ReplaceOne({"id": order['id']}, order, upsert=True) for order in orders],
+            ordered=False
+        )
+        result = await db.orders.delete_many({"id": {"$in": [order['id'] for order in orders]}})
+        archived += result.deleted_count
+        batches += 1
+        logger.info(f"Archived batch {batches}: {result.deleted_count} orders (up to {orders[-1]['created_at']})")
+    return {"archived": archived, "batches": batches, "cutoff": cutoff.isoformat()}
+
+
+async def migrate_timestamps(db, batch_size: int = 1000) -> dict:
+    """
+    Rewrite string timestamps in TIMESTAMP_FIELDS as native datetimes, in place.
+
+    Only documents still holding a string are selected, so the job can be
+    stopped and re-run at any time. Each write is conditional on the old
+    value, so a concurrent update from the API is never overwritten.
+    Documents are visited newest _id first: BSON sorts dates after strings,
+    so converting recent documents first keeps created_at sorts in order
+    while the migration is still running.
+    """
+    result = {}
+    for collection_name, field in TIMESTAMP_FIELDS:
+        collection = db[collection_name]
+        pending = {field: {"$type": "string"}}
+        total = await collection.count_documents(pending)
+        converted = skipped = 0
+        last_id = None
+        while True:
+            query = pending if last_id is None else {**pending, "_id": {"$lt": last_id}}
+            docs = await collection.find(query, {"_id": 1, field: 1}).sort("_id", -1).limit(batch_size).to_list(batch_size)
+            if not docs:
+                break
+            last_id = docs[-1]['_id']
+            operations = []
+            for doc in docs:
+                try:
+                    value = to_datetime(doc[field])
+                except ValueError:
+                    skipped += 1
+                    continue
+                operations.append(UpdateOne({"_id": doc['_id'], field: doc[field]}, {"$set": {field: value}}))
+            if operations:
+                converted += (await collection.bulk_write(operations, ordered=False)).modified_count
+            logger.info(f"{collection_name}.{field}: {converted + skipped}/{total} processed")
+        if skipped:
+            logger.warning(f"⚠️ {collection_name}.{field}: {skipped} unparseable values left as strings")
+        result[f"{collection_name}.{field}"] = {"total": total, "converted": converted, "skipped": skipped}
+    return result
+
+
+async def backfill_expiry(db, cart_ttl_days: int, unpaid_order_ttl_hours: int, batch_size: int = 1000) -> dict:
+    """
+    Set `expires_at` on carts and unpaid orders written before the TTL indexes.
+
+    The expiry is computed the way the API sets it: a cart's last update plus
+    the cart window, an unpaid order's creation plus the order window, or now
+    plus the window when the timestamp is missing or unparseable. Documents
+    whose expiry is already past are removed by the TTL monitor on its next
+    pass. Writes only apply while `expires_at` is still unset, so the job can
+    be re-run and never overrides a value the API wrote meanwhile.
+    """
+    targets = [
+        ("carts", {}, "updated_at", timedelta(days=cart_ttl_days)),
+        ("orders", {"status": "created"}, "created_at", timedelta(hours=unpaid_order_ttl_hours)),
+    ]
+    result = {}
+    for collection_name, match, field, window in targets:
+        collection = db[collection_name]
+        pending = {**match, "expires_at": {"$exists": False}}
+        total = await collection.count_documents(pending)
+        updated = 0
+        last_id = None
+        while True:
+            query = pending if last_id is None else {**pending, "_id": {"$gt": last_id}}
+            docs = await collection.find(query, {"_id": 1, field: 1}).sort("_id", 1).limit(batch_size).to_list(batch_size)
+            if not docs:
+                break
+            last_id = docs[-1]['_id']
+            now = datetime.now(timezone.utc)
+            operations = []
+            for doc in docs:
+                try:
+                    start = to_datetime(doc[field])
+                except (KeyError, TypeError, ValueError):
+                    start = now
+                operations.append(UpdateOne(
+                    {"_id": doc['_id'], "expires_at": {"$exists": False}}, {"$set": {"expires_at": start + window}}
+                ))
+            updated += (await collection.bulk_write(operations, ordered=False)).modified_count
+            logger.info(f"{collection_name}.expires_at: {updated}/{total} backfilled")
+        result[f"{collection_name}.expires_at"] = {"total": total, "backfilled": updated}
+    return result
+
+
+async def migrate_uuid_ids(db, batch_size: int = 1000, swap: bool = False) -> dict:
+    """
+    Copy users/products/carts/orders into `<name>_uuid_ids` with the UUID as _id.
+
+    The copy upserts by _id, so it can be interrupted and repeated; run it
+    once online, then again as a catch-up pass. Every pass also deletes
+    copies whose source document is gone (archived orders, released checkout
+    claims, deleted products and users), so they don't come back with the
+    swap. Writes made after the last pass are not copied: stop the API for
+    the final catch-up pass and the swap. `swap` renames the copies into
+    place (keeping the originals as `<name>_objectid`); start the API with
+    MONGO_UUID_IDS=1 right after so indexes are rebuilt on startup.
+    Takes the raw database, not the UuidIdDatabase wrapper.
+    """
+    result = {}
+    existing = set(await db.list_collection_names())
+    for name in uuid_ids.UUID_ID_COLLECTIONS:
+        source, target = db[name], db[f"{name}_uuid_ids"]
+        if swap:
+            if target.name not in existing:
+                result[name] = "nothing to swap"
+                continue
+            if name in existing:
+                await source.rename(f"{name}_objectid", dropTarget=False)
+            await target.rename(name)
+            result[name] = "swapped"
+            continue
+        total = await source.count_documents({})
+        copied = skipped = 0
+        async for batch in _batches(source.find({}).sort("_id", 1).batch_size(batch_size), batch_size):
+            operations = []
+            for doc in batch:
+                if not doc.get('id'):
+                    skipped += 1
+                    continue
+                stored = uuid_ids.map_document(doc)
+                operations.append(ReplaceOne({"_id": stored['_id']}, stored, upsert=True))
+            if operations:
+                await target.bulk_write(operations, ordered=False)
+                copied += len(operations)
+            logger.info(f"{name}: {copied + skipped}/{total} copied")
+        removed = await _remove_deleted_copies(source, target, batch_size)
+        if skipped:
+            logger.warning(f"⚠️ {name}: {skipped} documents without an id were not copied")
+        result[name] = {"total": total, "copied": copied, "skipped": skipped, "removed": removed}
+    return result
+
+
+async def _remove_deleted_copies(source, target, batch_size: int) -> int:
+    """Delete copies in `target` whose source document no longer exists."""
+    removed = 0
+    async for batch in _batches(target.find({}, {"_id": 1}).sort("_id", 1).batch_size(batch_size), batch_size):
+        stored_ids = {uuid_ids.to_app_id(doc['_id']): doc['_id'] for doc in batch}
+        present = {
+            doc['id'] for doc in
+            await source.find({"id": {"$in": list(stored_ids)}}, {"_id": 0, "id": 1}).to_list(None)
+        }
+        gone = [stored for app_id, stored in stored_ids.items() if app_id not in present]
+        if gone:
+            removed += (await target.delete_many({"_id": {"$in": gone}})).deleted_count
+    if removed:
+        logger.info(f"{target.name}: removed {removed} copies deleted from {source.name}")
+    return removed
+
+
+async def _batches(cursor, size: int):
+    batch = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Store database maintenance jobs")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    archive = commands.add_parser("archive-orders", help="move old paid/failed orders to orders_archive")
+    archive.add_argument("--older-than-days", type=int, default=int(os.environ.get("ORDER_ARCHIVE_AFTER_DAYS", 180)))
+    archive.add_argument("--batch-size", type=int, default=500)
+    archive.add_argument("--max-batches", type=int, default=None)
+
+    rebuild = commands.add_parser("rebuild-recommendations", help="recompute related products from paid orders")
+    rebuild.add_argument("--k", type=int, default=recommendations.TOP_K)
+
+    migrate = commands.add_parser(
+        "migrate-timestamps", help="convert ISO string timestamps to native dates and backfill expires_at"
+    )
+    migrate.add_argument("--batch-size", type=int, default=1000)
+    migrate.add_argument("--cart-ttl-days", type=int, default=int(os.environ.get("CART_TTL_DAYS", 30)))
+    migrate.add_argument("--unpaid-order-ttl-hours", type=int,
+                         default=int(os.environ.get("UNPAID_ORDER_TTL_HOURS", 24)))
+
+    uuid_migrate = commands.add_parser("migrate-uuid-ids", help="copy users/products/carts/orders to a binary UUID _id layout")
+    uuid_migrate.add_argument("--batch-size", type=int, default=1000)
+    uuid_migrate.add_argument("--swap", action="store_true", help="rename the copies into place")
+    return parser.parse_args(argv)
+
+
+async def run(args):
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    db = uuid_ids.open_database(client, os.environ['DB_NAME'])
+    try:
+        if args.command == "archive-orders":
+            result = await archive_orders(db, args.older_than_days, args.batch_size, args.max_batches)
+        elif args.command == "rebuild-recommendations":
+            result = await recommendations.rebuild(db, args.k)
+        elif args.command == "migrate-timestamps":
+            result = await migrate_timestamps(db, args.batch_size)
+            # Expiry is computed from the timestamps, so it runs once they are native dates
+            result.update(await backfill_expiry(
+                db, args.cart_ttl_days, args.unpaid_order_ttl_hours, args.batch_size
+            ))
+        elif args.command == "migrate-uuid-ids":
+            result = await migrate_uuid_ids(client[os.environ['DB_NAME']], args.batch_size, args.swap)
+        logger.info(f"✅ {args.command}: {result}")
+    finally:
+        client.close()
+
+
+def main(argv=None):
+    load_dotenv(Path(__file__).parent / '.env')
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    asyncio.run(run(parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
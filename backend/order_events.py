@@ -0,0 +1,102 @@
+"""
+Order status events for the SSE endpoint.
+
+OrderEventBus fans events out to subscribers of one order in this process.
+With a replica set (Atlas) a change stream on orders feeds the bus, so a
+payment verified on any instance reaches subscribers on every instance.
+Without one the bus falls back to events published by this process.
+"""
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Set
+
+logger = logging.getLogger("server.order_events")
+
+TERMINAL_STATUSES = {"paid", "failed"}
+
+
+def order_events(order: dict) -> List[dict]:
+    """Events describing an order's current state."""
+    events = [{"event": "status", "data": {"order_id": order['id'], "status": order.get('status')}}]
+    if order.get('status') == "paid":
+        events.append({"event": "entitlements", "data": {
+            "order_id": order['id'],
+            "product_ids": [item['product_id'] for item in order.get('items', [])],
+        }})
+    return events
+
+
+def format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class OrderEventBus:
+    def __init__(self):
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+        self._task: Optional[asyncio.Task] = None
+        self.bridged = False
+
+    @contextmanager
+    def subscribe(self, order_id: str):
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers[order_id].add(queue)
+        try:
+            yield queue
+        finally:
+            self._subscribers[order_id].discard(queue)
+            if not self._subscribers[order_id]:
+                del self._subscribers[order_id]
+
+    def dispatch(self, order: dict):
+        for queue in self._subscribers.get(order['id'], ()):
+            for event in order_events(order):
+                queue.put_nowait(event)
+
+    def notify(self, order: dict):
+        """Called by the process that changed the order; the change stream covers it when bridged."""
+        if not self.bridged:
+            self.dispatch(order)
+
+    # Change-stream bridge
+    def start(self, db):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._watch(db))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.bridged = False
+
+    async def _watch(self, db):
+        pipeline = [{"$match": {
+            "operationType": "update",
+            "updateDescription.updatedFields.status": {"$exists": True},
+        }}]
+        resume_token = None
+        delay = 1
+        while True:
+            try:
+                async with db.orders.watch(pipeline, full_document="updateLookup",
+                                           resume_after=resume_token) as stream:
+                    self.bridged = True
+                    delay = 1
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        order = change.get("fullDocument")
+                        if order:
+                            self.dispatch(order)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.bridged = False
+                # Standalone servers don't support change streams; stay process-local
+                if getattr(e, "code", None) == 40573:
+                    logger.info("Change streams unavailable; order events are process-local")
+                    return
+                logger.warning(f"⚠️ Order change stream interrupted, retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
@@ -0,0 +1,94 @@
+"""
+Write-behind product view and purchase counters.
+
+get_product and verify_payment only bump in-memory counts; a background
+task folds them into products.view_count / purchase_count with one
+unordered bulk_write of $inc per flush. Counts recorded since the last
+flush (at most `flush_interval` seconds' worth) are lost if the process
+dies, which is acceptable for popularity sorting. A flush is brought
+forward when `max_keys` products have pending counts.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger("server.product_counters")
+
+SORT_FIELDS = {"popular": "view_count", "best-selling": "purchase_count"}
+
+
+class ProductCounterBuffer:
+    def __init__(self, flush_interval: float = 10.0, max_keys: int = 5000):
+        self.flush_interval = flush_interval
+        self.max_keys = max_keys
+        self._pending: Dict[str, List[int]] = defaultdict(lambda: [0, 0])  # product_id -> [views, purchases]
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._db = None
+        self.flushed_operations = 0
+
+    def record_view(self, product_id: str):
+        self._pending[product_id][0] += 1
+        self._check_size()
+
+    def record_purchases(self, product_ids: Iterable[str]):
+        for product_id in product_ids:
+            self._pending[product_id][1] += 1
+        self._check_size()
+
+    def _check_size(self):
+        if len(self._pending) >= self.max_keys and self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self, db):
+        self._db = db
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"❌ Product counter flush failed: {e}")
+
+    async def flush(self):
+        if self._db is None or not self._pending:
+            return
+        batch, self._pending = self._pending, defaultdict(lambda: [0, 0])
+        operations = []
+        for product_id, (views, purchases) in batch.items():
+            increments = {}
+            if views:
+                increments['view_count'] = views
+            if purchases:
+                increments['purchase_count'] = purchases
+            operations.append(UpdateOne({"id": product_id}, {"$inc": increments}))
+        try:
+            await self._db.products.bulk_write(operations, ordered=False)
+        except BulkWriteError:
+            # Some increments were applied; requeueing would double count them
+            raise
+        except Exception:
+            # Put the counts back so the next flush retries them
+            for product_id, (views, purchases) in batch.items():
+                self._pending[product_id][0] += views
+                self._pending[product_id][1] += purchases
+            raise
+        self.flushed_operations += len(operations)
@@ -0,0 +1,222 @@
+"""
+Opt-in per-request profiling.
+
+A request is profiled when an admin sends the X-Profile header or when it
+falls into PROFILE_SAMPLE_RATE. While profiled, a background thread samples
+the event-loop thread's stack and the request's wall time is split into
+event-loop CPU, Mongo command time (from a pymongo command listener) and
+external calls (profile_span). The result is stored in speedscope format.
+
+Requests that aren't profiled only pay for one header scan and a
+ContextVar lookup per Mongo command.
+"""
+import random
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from pymongo import monitoring
+
+PROFILE_HEADER = b"x-profile"
+MAX_SAMPLES = 20000
+
+current_profile: ContextVar[Optional["RequestProfile"]] = ContextVar("current_profile", default=None)
+
+
+class StackSampler(threading.Thread):
+    """Samples one thread's Python stack at a fixed interval."""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(daemon=True, name="request-profiler")
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples: List[tuple] = []
+        self.weights: List[float] = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        last = time.perf_counter()
+        while not self._stop_event.wait(self.interval) and len(self.samples) < MAX_SAMPLES:
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, frame.f_lineno))
+                frame = frame.f_back
+            stack.reverse()
+            self.samples.append(tuple(stack))
+            self.weights.append((now - last) * 1000)
+            last = now
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class RequestProfile:
+    def __init__(self, method: str, path: str, trigger: str, interval: float):
+        self.id = str(uuid.uuid4())
+        self.method = method
+        self.path = path
+        self.trigger = trigger
+        self.mongo_ms = 0.0
+        self.mongo_commands = 0
+        self.external_ms: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._sampler = StackSampler(threading.get_ident(), interval)
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.thread_time()
+        self._sampler.start()
+
+    def add_mongo(self, duration_ms: float):
+        # Command listeners fire on Motor's executor threads
+        with self._lock:
+            self.mongo_ms += duration_ms
+            self.mongo_commands += 1
+
+    def add_external(self, name: str, duration_ms: float):
+        with self._lock:
+            self.external_ms[name] = self.external_ms.get(name, 0.0) + duration_ms
+
+    def finish(self, route: str, status: int) -> dict:
+        wall_ms = (time.perf_counter() - self._wall_start) * 1000
+        # Loop-thread CPU includes any concurrent requests interleaved with this one
+        cpu_ms = (time.thread_time() - self._cpu_start) * 1000
+        self._sampler.stop()
+        external_total = sum(self.external_ms.values())
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "route": route,
+            "status": status,
+            "trigger": self.trigger,
+            "created_at": datetime.now(timezone.utc),
+            "wall_ms": round(wall_ms, 3),
+            "breakdown": {
+                "event_loop_cpu_ms": round(cpu_ms, 3),
+                "mongo_ms": round(self.mongo_ms, 3),
+                "external_ms": {name: round(ms, 3) for name, ms in self.external_ms.items()},
+                "other_ms": round(max(wall_ms - cpu_ms - self.mongo_ms - external_total, 0.0), 3),
+            },
+            "mongo_commands": self.mongo_commands,
+            "speedscope": self._speedscope(f"{self.method} {route}", wall_ms),
+        }
+
+    def _speedscope(self, name: str, wall_ms: float) -> dict:
+        frames: List[dict] = []
+        index: Dict[tuple, int] = {}
+        samples = []
+        for stack in self._sampler.samples:
+            sample = []
+            for frame in stack:
+                if frame not in index:
+                    index[frame] = len(frames)
+                    frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+                sample.append(index[frame])
+            samples.append(sample)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "digitalstore-profiler",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": name,
+                "unit": "milliseconds",
+                "startValue": 0,
+                "endValue": round(wall_ms, 3),
+                "samples": samples,
+                "weights": [round(w, 3) for w in self._sampler.weights],
+            }],
+        }
+
+
+class ProfileCommandListener(monitoring.CommandListener):
+    """Attributes Mongo command time to the profiled request (Motor copies contextvars to its executor)."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        profile = current_profile.get()
+        if profile is not None:
+            profile.add_mongo(event.duration_micros / 1000)
+
+    def failed(self, event):
+        self.succeeded(event)
+
+
+@contextmanager
+def profile_span(name: str):
+    """Time a blocking external call (Razorpay, Cloudinary) for the profiled request."""
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_external(name, (time.perf_counter() - start) * 1000)
+
+
+class ProfilingMiddleware:
+    """
+    Pure ASGI middleware that profiles selected requests.
+
+    authorize(scope) decides whether an X-Profile request may be profiled;
+    store(doc) persists the finished profile and runs after the response.
+    """
+
+    def __init__(self, app, authorize: Callable[[dict], Awaitable[bool]],
+                 store: Callable[[dict], Awaitable[None]], sample_rate: float = 0.0,
+                 interval_ms: float = 5.0):
+        self.app = app
+        self.authorize = authorize
+        self.store = store
+        self.sample_rate = sample_rate
+        self.interval = interval_ms / 1000
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trigger = None
+        if any(name == PROFILE_HEADER for name, _ in scope.get("headers") or ()):
+            if await self.authorize(scope):
+                trigger = "header"
+        elif self.sample_rate and random.random() < self.sample_rate:
+            trigger = "sampled"
+        if trigger is None:
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope["method"], scope["path"], trigger, self.interval)
+        token = current_profile.set(profile)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-profile-id", profile.id.encode())
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_profile.reset(token)
+            route = getattr(scope.get("route"), "path", scope["path"])
+            await self.store(profile.finish(route, status))
@@ -0,0 +1,301 @@
+"""
+"Frequently bought together" recommendations from paid order history.
+
+The full rebuild streams paid orders (live and archived), counts product co-occurrences with
+NumPy as a sparse (row, col, count) list and stores the top-k related
+products per product in product_recommendations. Pair counts are kept in
+product_pairs so a newly paid order can update only the products it
+touches (record_order). The rebuild writes pairs into a scratch
+collection and renames it over product_pairs, so concurrent record_order
+upserts never collide with a half-written table. Counting runs in a worker
+thread to keep the event loop free.
+
+The rebuild counts orders paid before it started. Orders paid while it
+runs are parked in product_pairs_pending and folded into the swapped-in
+counts afterwards, so the rename never drops them. The cutoff of the last
+completed rebuild is kept in product_pairs_state; record_order skips orders
+paid before it, because the rebuilt counts already include them. A rebuild
+holds a lease, so a crashed one stops parking orders once it runs out.
+
+    cd backend && python -m recommendations --orders 1000000   # benchmark
+"""
+import argparse
+import asyncio
+import logging
+import time
+from array import array
+from datetime import datetime, timedelta, timezone
+from itertools import permutations
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from timestamps import to_datetime
+
+logger = logging.getLogger("server.recommendations")
+
+TOP_K = 10
+REBUILD_COLLECTION = "product_pairs_rebuild"
+STATE_COLLECTION = "product_pairs_state"
+PENDING_COLLECTION = "product_pairs_pending"
+REBUILD_LEASE = timedelta(hours=1)
+# Pair codes pack (row, col) product indices into one int64
+CODE_SHIFT = 32
+CODE_MASK = (1 << CODE_SHIFT) - 1
+
+
+class CooccurrenceCounter:
+    """Accumulates order baskets into sparse co-occurrence counts in bounded chunks."""
+
+    def __init__(self, chunk_pairs: int = 5_000_000):
+        self.index: Dict[str, int] = {}
+        self.product_ids: List[str] = []
+        self.chunk_pairs = chunk_pairs
+        self._buffer = array("q")
+        self._codes = np.empty(0, dtype=np.int64)
+        self._counts = np.empty(0, dtype=np.int64)
+
+    def _product_index(self, product_id: str) -> int:
+        idx = self.index.get(product_id)
+        if idx is None:
+            idx = self.index[product_id] = len(self.product_ids)
+            self.product_ids.append(product_id)
+        return idx
+
+    def add(self, product_ids: Iterable[str]):
+        basket = sorted({self._product_index(pid) for pid in product_ids})
+        for row, col in permutations(basket, 2):
+            self._buffer.append((row << CODE_SHIFT) | col)
+        if len(self._buffer) >= self.chunk_pairs:
+            self._reduce()
+
+    def add_many(self, baskets: Iterable[Iterable[str]]):
+        for basket in baskets:
+            self.add(basket)
+
+    def _reduce(self):
+        if not self._buffer:
+            return
+        codes = np.concatenate([self._codes, np.frombuffer(self._buffer, dtype=np.int64)])
+        counts = np.concatenate([self._counts, np.ones(len(self._buffer), dtype=np.int64)])
+        self._codes, inverse = np.unique(codes, return_inverse=True)
+        self._counts = np.bincount(inverse, weights=counts).astype(np.int64)
+        self._buffer = array("q")
+
+    def pairs(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(rows, cols, counts) with both directions of every pair."""
+        self._reduce()
+        return self._codes >> CODE_SHIFT, self._codes & CODE_MASK, self._counts
+
+
+def top_k_related(rows: np.ndarray, cols: np.ndarray, counts: np.ndarray, k: int = TOP_K):
+    """Vectorized top-k columns per row by count; returns the kept (rows, cols, counts)."""
+    if rows.size == 0:
+        return rows, cols, counts
+    order = np.lexsort((cols, -counts, rows))
+    rows, cols, counts = rows[order], cols[order], counts[order]
+    starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    group_start = np.repeat(starts, np.diff(np.r_[starts, rows.size]))
+    keep = (np.arange(rows.size) - group_start) < k
+    return rows[keep], cols[keep], counts[keep]
+
+
+def recommendation_docs(product_ids: List[str], rows, cols, counts) -> List[dict]:
+    now = datetime.now(timezone.utc)
+    docs: Dict[int, dict] = {}
+    for row, col, count in zip(rows.tolist(), cols.tolist(), counts.tolist()):
+        doc = docs.setdefault(row, {"product_id": product_ids[row], "related": [], "updated_at": now})
+        doc["related"].append({"product_id": product_ids[col], "score": count})
+    return list(docs.values())
+
+
+PAIR_INDEXES = [
+    ([("a", 1), ("b", 1)], {"unique": True}),
+    ([("a", 1), ("count", -1)], {}),
+]
+
+
+async def ensure_pair_indexes(collection):
+    for keys, options in PAIR_INDEXES:
+        await collection.create_index(keys, **options)
+
+
+class RebuildInProgress(Exception):
+    pass
+
+
+def pair_update_action(state: Optional[dict], paid_at: datetime, now: datetime) -> str:
+    """What record_order does with an order paid at `paid_at`: "apply", "defer" or "skip"."""
+    state = state or {}
+    if state.get("counted_before") and paid_at < to_datetime(state["counted_before"]):
+        return "skip"  # already in the rebuilt counts
+    leased = state.get("rebuilding_until") and to_datetime(state["rebuilding_until"]) > now
+    if leased and paid_at >= to_datetime(state["rebuilding_since"]):
+        return "defer"  # the rebuild does not see it and its rename would drop the increment
+    return "apply"
+
+
+async def _start_rebuild(db, now: datetime):
+    not_running = {"$or": [{"rebuilding_until": None}, {"rebuilding_until": {"$lte": now}}]}
+    try:
+        await db[STATE_COLLECTION].update_one(
+            {"_id": "pairs", **not_running},
+            {"$set": {"rebuilding_since": now, "rebuilding_until": now + REBUILD_LEASE}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # The state document exists but did not match: another rebuild holds the lease
+        raise RebuildInProgress("A recommendations rebuild is already running")
+
+
+async def rebuild(db, k: int = TOP_K, batch_size: int = 2000) -> dict:
+    cutoff = datetime.now(timezone.utc)
+    await _start_rebuild(db, cutoff)
+    try:
+        result = await _rebuild_pairs(db, cutoff, k, batch_size)
+    except Exception:
+        # Give up the lease; the parked orders belong in whichever counts are now live
+        await db[STATE_COLLECTION].update_one(
+            {"_id": "pairs"}, {"$unset": {"rebuilding_since": "", "rebuilding_until": ""}}
+        )
+        await apply_pending(db, k)
+        raise
+    await db[STATE_COLLECTION].update_one(
+        {"_id": "pairs"},
+        {"$set": {"counted_before": cutoff}, "$unset": {"rebuilding_since": "", "rebuilding_until": ""}}
+    )
+    result["applied_after_swap"] = await apply_pending(db, k)
+    return result
+
+
+async def _rebuild_pairs(db, cutoff: datetime, k: int, batch_size: int) -> dict:
+    counter = CooccurrenceCounter()
+    orders = 0
+    # Orders paid from the cutoff on are parked by record_order and applied after the swap;
+    # orders paid before paid_at was recorded count as before the cutoff
+    counted = {"status": "paid", "$or": [{"paid_at": {"$lt": cutoff}}, {"paid_at": None}]}
+    # Archived orders are all settled, but paid ones still count towards recommendations
+    for collection in (db.orders, db.orders_archive):
+        cursor = collection.find(counted, {"_id": 0, "items.product_id": 1}).batch_size(batch_size)
+        baskets = []
+        async for order in cursor:
+            baskets.append([item['product_id'] for item in order.get('items', [])])
+            if len(baskets) >= batch_size:
+                await asyncio.to_thread(counter.add_many, baskets)
+                orders += len(baskets)
+                baskets = []
+        await asyncio.to_thread(counter.add_many, baskets)
+        orders += len(baskets)
+    rows, cols, counts = await asyncio.to_thread(counter.pairs)
+
+    # Pair counts back the incremental path; build them aside and swap them in
+    scratch = db[REBUILD_COLLECTION]
+    await scratch.drop()
+    await ensure_pair_indexes(scratch)
+    for start in range(0, rows.size, 10000):
+        await scratch.insert_many([
+            {"a": counter.product_ids[a], "b": counter.product_ids[b], "count": c}
+            for a, b, c in zip(rows[start:start + 10000].tolist(), cols[start:start + 10000].tolist(),
+                               counts[start:start + 10000].tolist())
+        ])
+    await scratch.rename("product_pairs", dropTarget=True)
+
+    docs = await asyncio.to_thread(
+        lambda: recommendation_docs(counter.product_ids, *top_k_related(rows, cols, counts, k))
+    )
+    for start in range(0, len(docs), 1000):
+        await db.product_recommendations.bulk_write(
+            [ReplaceOne({"product_id": doc['product_id']}, doc, upsert=True) for doc in docs[start:start + 1000]],
+            ordered=False
+        )
+    await db.product_recommendations.delete_many({"product_id": {"$nin": [doc['product_id'] for doc in docs]}})
+    return {"orders": orders, "products": len(docs), "pairs": int(rows.size)}
+
+
+async def record_order(db, product_ids: List[str], paid_at: Optional[datetime] = None, k: int = TOP_K):
+    """Fold one newly paid order into the pair counts and refresh the products it touched."""
+    basket = sorted(set(product_ids))
+    if len(basket) < 2:
+        return
+    now = datetime.now(timezone.utc)
+    paid_at = to_datetime(paid_at) if paid_at else now
+    action = pair_update_action(await db[STATE_COLLECTION].find_one({"_id": "pairs"}), paid_at, now)
+    if action == "skip":
+        return
+    if action == "defer":
+        await db[PENDING_COLLECTION].insert_one({"product_ids": basket, "paid_at": paid_at})
+        return
+    await _apply_basket(db, basket, k)
+    # Picks up orders parked by a rebuild that finished or crashed since
+    await apply_pending(db, k)
+
+
+async def apply_pending(db, k: int = TOP_K) -> int:
+    applied = 0
+    # find_one_and_delete hands each parked order to exactly one caller
+    while True:
+        entry = await db[PENDING_COLLECTION].find_one_and_delete({}, sort=[("paid_at", 1)])
+        if entry is None:
+            return applied
+        await _apply_basket(db, entry['product_ids'], k)
+        applied += 1
+
+
+async def _apply_basket(db, basket: List[str], k: int):
+    await db.product_pairs.bulk_write(
+        [UpdateOne({"a": a, "b": b}, {"$inc": {"count": 1}}, upsert=True) for a, b in permutations(basket, 2)],
+        ordered=False
+    )
+    now = datetime.now(timezone.utc)
+    for product_id in basket:
+        top = await db.product_pairs.find({"a": product_id}, {"_id": 0}).sort("count", -1).limit(k).to_list(k)
+        await db.product_recommendations.update_one(
+            {"product_id": product_id},
+            {"$set": {
+                "related": [{"product_id": pair['b'], "score": pair['count']} for pair in top],
+                "updated_at": now
+            }},
+            upsert=True
+        )
+
+
+def benchmark(n_orders: int, n_products: int, max_items: int, k: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    # Zipf-ish popularity so a few products dominate, like a real catalog
+    weights = 1 / np.arange(1, n_products + 1)
+    weights /= weights.sum()
+    sizes = rng.integers(1, max_items + 1, size=n_orders)
+    items = rng.choice(n_products, size=int(sizes.sum()), p=weights)
+    product_ids = [f"p{i}" for i in range(n_products)]
+
+    start = time.perf_counter()
+    counter = CooccurrenceCounter()
+    offset = 0
+    for size in sizes.tolist():
+        counter.add(product_ids[i] for i in items[offset:offset + size].tolist())
+        offset += size
+    rows, cols, counts = counter.pairs()
+    counted = time.perf_counter()
+    kept = top_k_related(rows, cols, counts, k)
+    ranked = time.perf_counter()
+    docs = recommendation_docs(counter.product_ids, *kept)
+    done = time.perf_counter()
+    print(f"orders={n_orders} products={n_products} pairs={rows.size} docs={len(docs)}")
+    print(f"count {counted - start:.2f}s  top-k {ranked - counted:.2f}s  docs {done - ranked:.2f}s  "
+          f"total {done - start:.2f}s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the co-occurrence recommender on synthetic orders")
+    parser.add_argument("--orders", type=int, default=1_000_000)
+    parser.add_argument("--products", type=int, default=5000)
+    parser.add_argument("--max-items", type=int, default=4)
+    parser.add_argument("--k", type=int, default=TOP_K)
+    args = parser.parse_args(argv)
+    benchmark(args.orders, args.products, args.max_items, args.k)
+
+
+if __name__ == "__main__":
+    main()
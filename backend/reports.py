@@ -0,0 +1,181 @@
+"""
+Sales reports and order exports for admins.
+
+Orders (live and archived) are read through a batched cursor and flattened
+to one row per order item. Each batch is turned into a DataFrame and
+aggregated or serialized in a worker thread, so the event loop stays free
+and memory is bounded by the batch size, not the date range.
+"""
+import asyncio
+import io
+from typing import AsyncIterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from timestamps import time_range
+
+BATCH_SIZE = 5000
+GROUPINGS = ("day", "week", "product", "category")
+EXPORT_COLUMNS = [
+    "order_id", "user_id", "status", "created_at", "razorpay_order_id", "razorpay_payment_id",
+    "order_total", "product_id", "product_name", "price", "quantity",
+]
+ORDER_PROJECTION = {
+    "_id": 0, "id": 1, "user_id": 1, "status": 1, "created_at": 1, "total": 1,
+    "razorpay_order_id": 1, "razorpay_payment_id": 1, "items": 1,
+}
+
+
+def order_query(start, end, status: Optional[str]) -> dict:
+    query = {}
+    if status:
+        query['status'] = status
+    query.update(time_range("created_at", gte=start, lt=end))
+    return query
+
+
+async def order_item_batches(db, query: dict, batch_size: int = BATCH_SIZE) -> AsyncIterator[List[dict]]:
+    """Yields lists of flattened order-item rows, never holding more than one batch."""
+    for collection in (db.orders, db.orders_archive):
+        cursor = collection.find(query, ORDER_PROJECTION).sort("created_at", 1).batch_size(batch_size)
+        rows = []
+        async for order in cursor:
+            for item in order.get('items', []):
+                rows.append({
+                    "order_id": order['id'],
+                    "user_id": order.get('user_id'),
+                    "status": order.get('status'),
+                    "created_at": order.get('created_at'),
+                    "razorpay_order_id": order.get('razorpay_order_id'),
+                    "razorpay_payment_id": order.get('razorpay_payment_id'),
+                    "order_total": order.get('total'),
+                    "product_id": item.get('product_id'),
+                    "product_name": item.get('name'),
+                    "price": item.get('price', 0),
+                    "quantity": item.get('quantity', 1),
+                })
+            if len(rows) >= batch_size:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+
+
+def to_frame(rows: List[dict]) -> pd.DataFrame:
+    frame = pd.DataFrame.from_records(rows, columns=EXPORT_COLUMNS)
+    frame['created_at'] = pd.to_datetime(frame['created_at'], utc=True, format="ISO8601")
+    frame['price'] = frame['price'].astype("float64")
+    frame['quantity'] = frame['quantity'].astype("int64")
+    frame['order_total'] = frame['order_total'].astype("float64")
+    return frame
+
+
+def aggregate_batch(rows: List[dict], group_by: str, categories: dict) -> pd.DataFrame:
+    frame = to_frame(rows)
+    if group_by == "day":
+        key = frame['created_at'].dt.strftime("%Y-%m-%d")
+    elif group_by == "week":
+        key = frame['created_at'].dt.tz_localize(None).dt.to_period("W-SUN").dt.start_time.dt.strftime("%Y-%m-%d")
+    elif group_by == "product":
+        key = frame['product_id']
+    else:
+        key = frame['product_id'].map(categories).fillna("unknown")
+    frame = frame.assign(key=key, revenue=frame['price'].to_numpy() * frame['quantity'].to_numpy())
+    # Every order lies entirely within one batch, so per-batch unique counts add up exactly
+    return frame.groupby("key").agg(
+        orders=("order_id", "nunique"),
+        items=("quantity", "sum"),
+        revenue=("revenue", "sum"),
+    )
+
+
+async def build_report(db, start, end, group_by: str, status: Optional[str] = "paid") -> dict:
+    categories = {}
+    if group_by == "category":
+        products = await db.products.find({}, {"_id": 0, "id": 1, "category": 1}).to_list(None)
+        categories = {product['id']: product['category'] for product in products}
+
+    partials = []
+    async for rows in order_item_batches(db, order_query(start, end, status)):
+        partials.append(await asyncio.to_thread(aggregate_batch, rows, group_by, categories))
+
+    if partials:
+        report = await asyncio.to_thread(lambda: pd.concat(partials).groupby(level=0).sum().sort_index())
+    else:
+        report = pd.DataFrame(columns=["orders", "items", "revenue"])
+    records = [
+        {"key": row.Index, "orders": int(row.orders), "items": int(row.items), "revenue": round(float(row.revenue), 2)}
+        for row in report.itertuples()
+    ]
+    return {
+        "group_by": group_by,
+        "start": start.isoformat() if start else None,
+        "end": end.isoformat() if end else None,
+        "status": status,
+        "rows": records,
+        "totals": {
+            "orders": int(np.sum(report['orders'])) if len(report) and group_by in ("day", "week") else None,
+            "items": int(np.sum(report['items'])) if len(report) else 0,
+            "revenue": round(float(np.sum(report['revenue'])), 2) if len(report) else 0.0,
+        },
+    }
+
+
+async def stream_orders_csv(db, query: dict) -> AsyncIterator[bytes]:
+    header = True
+    async for rows in order_item_batches(db, query):
+        chunk = await asyncio.to_thread(lambda: to_frame(rows).to_csv(index=False, header=header))
+        header = False
+        yield chunk.encode()
+    if header:
+        yield (",".join(EXPORT_COLUMNS) + "\n").encode()
+
+
+class _DrainableSink(io.RawIOBase):
+    """Write-only file object whose buffered bytes can be taken between row groups."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+async def stream_orders_parquet(db, query: dict) -> AsyncIterator[bytes]:
+    """One Parquet row group per batch; raises ImportError if pyarrow isn't installed."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("order_id", pa.string()), ("user_id", pa.string()), ("status", pa.string()),
+        ("created_at", pa.timestamp("us", tz="UTC")), ("razorpay_order_id", pa.string()),
+        ("razorpay_payment_id", pa.string()), ("order_total", pa.float64()), ("product_id", pa.string()),
+        ("product_name", pa.string()), ("price", pa.float64()), ("quantity", pa.int64()),
+    ])
+    sink = _DrainableSink()
+    writer = pq.ParquetWriter(sink, schema, compression="snappy")
+    try:
+        async for rows in order_item_batches(db, query):
+            table = await asyncio.to_thread(
+                lambda: pa.Table.from_pandas(to_frame(rows), schema=schema, preserve_index=False)
+            )
+            await asyncio.to_thread(writer.write_table, table)
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
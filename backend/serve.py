@@ -0,0 +1,95 @@
+"""
+Production entry point for the API server.
+
+    cd backend && python -m serve --port 8001
+
+Runs server:app under uvicorn with one worker per available CPU, uvloop and
+httptools when they are installed, and graceful draining on shutdown. Every
+option can also be set through the environment so deployments don't need a
+custom command line.
+
+--max-requests only works with a single worker: uvicorn 0.25's multiprocess
+supervisor does not respawn workers that exit, so recycled workers would
+never come back. Run several single-worker instances behind the load
+balancer (or a process manager that restarts them) if recycling is needed.
+
+Workers keep MONGO_MIN_POOL_SIZE (default 10 here, 0 when server.py is
+imported elsewhere, e.g. by the serverless entry point) Mongo connections
+open so the first requests after a deploy don't pay for the handshakes.
+
+Proxy headers are trusted only from FORWARDED_ALLOW_IPS (default
+127.0.0.1); set it to the load balancer's address(es) so clients can't
+spoof X-Forwarded-For.
+"""
+import argparse
+import importlib.util
+import os
+
+import uvicorn
+
+
+def available_cpus() -> int:
+    # Respect container CPU pinning where the platform exposes it
+    if hasattr(os, "sched_getaffinity"):
+        return max(len(os.sched_getaffinity(0)), 1)
+    return os.cpu_count() or 1
+
+
+def default_workers() -> int:
+    return int(os.environ.get("WEB_CONCURRENCY", available_cpus()))
+
+
+def pick_loop() -> str:
+    return "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+
+
+def pick_http() -> str:
+    return "httptools" if importlib.util.find_spec("httptools") else "h11"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the API server for production")
+    parser.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8001)))
+    parser.add_argument("--workers", type=int, default=default_workers(),
+                        help="worker processes (default: WEB_CONCURRENCY or CPU count)")
+    parser.add_argument("--keep-alive", type=int, default=int(os.environ.get("KEEP_ALIVE_TIMEOUT", 75)),
+                        help="seconds to hold idle keep-alive connections; keep above the load balancer's")
+    parser.add_argument("--backlog", type=int, default=int(os.environ.get("BACKLOG", 2048)))
+    parser.add_argument("--graceful-timeout", type=int, default=int(os.environ.get("GRACEFUL_TIMEOUT", 30)),
+                        help="seconds to drain in-flight requests on shutdown")
+    parser.add_argument("--max-requests", type=int, default=int(os.environ.get("MAX_REQUESTS", 0)),
+                        help="recycle a worker after this many requests (0 disables)")
+    parser.add_argument("--forwarded-allow-ips", default=os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+                        help="comma-separated proxy addresses whose X-Forwarded-* headers are trusted")
+    parser.add_argument("--log-level", default=os.environ.get("LOG_LEVEL", "info"))
+    args = parser.parse_args(argv)
+    if args.max_requests and args.workers > 1:
+        parser.error("--max-requests requires --workers 1; uvicorn does not respawn recycled workers")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Workers inherit the environment and read it when they import server
+    os.environ.setdefault("MONGO_MIN_POOL_SIZE", "10")
+    uvicorn.run(
+        "server:app",
+        host=args.host,
+        port=args.port,
+        workers=max(args.workers, 1),
+        loop=pick_loop(),
+        http=pick_http(),
+        timeout_keep_alive=args.keep_alive,
+        backlog=args.backlog,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        limit_max_requests=args.max_requests or None,
+        proxy_headers=True,
+        forwarded_allow_ips=args.forwarded_allow_ips,
+        log_level=args.log_level,
+        access_log=False,  # server.py's RequestLogMiddleware emits structured access logs
+    )
+
+
+if __name__ == "__main__":
+    main()
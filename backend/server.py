@@ -1,23 +1,58 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, BackgroundTasks, HTTPException, Depends, status, UploadFile, File, Form
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import JSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 import os
+import asyncio
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional
+from pydantic import BaseModel, Field, ConfigDict, EmailStr, ValidationError
+from typing import Dict, List, Optional, Tuple
 import uuid
+import json
+import base64
+import hashlib
+import shutil
+import signal
+import sys
+import tempfile
+import time
 from datetime import datetime, timezone, timedelta
 import jwt
 from jwt.exceptions import ExpiredSignatureError, InvalidTokenError
 from passlib.context import CryptContext
 import razorpay
-from fastapi import Request
+import requests
+from fastapi import Request, Response
 import cloudinary
 import cloudinary.uploader
 import cloudinary.api
+import cloudinary.utils
+import cloudinary.exceptions
+from structured_logging import configure_logging, bind_request_context, RequestLogMiddleware
+from profiling import ProfilingMiddleware, ProfileCommandListener, profile_span
+from slow_queries import SlowQueryLog
+from maintenance import archive_orders
+import recommendations
+import reports
+from order_events import OrderEventBus, TERMINAL_STATUSES, format_sse, order_events
+from guest_cart import GuestCartError, decode_guest_cart, encode_guest_cart
+from dependency_guard import DependencyGuard, DependencyUnavailable
+from timestamps import time_range, to_datetime
+import uuid_ids
+import video_hls
+from video_jobs import VideoJobRunner, new_job, remove_source
+from product_counters import ProductCounterBuffer, SORT_FIELDS
+from clerk_auth import (
+    ALGORITHMS as CLERK_ALGORITHMS, ClerkJWKS, ClerkJWKSUnavailable, ClerkTokenError, load_local_jwks, verify_session_token
+)
+from clerk_webhooks import (
+    ClerkEventBatcher, WebhookVerificationError, clerk_user_upsert, event_to_operation, verify_svix_signature
+)
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -31,14 +66,72 @@ cloudinary.config(
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+slow_query_log = SlowQueryLog(
+    threshold_ms=float(os.environ.get('SLOW_QUERY_MS', 100)),
+    explain_rate=float(os.environ.get('SLOW_QUERY_EXPLAIN_RATE', 0.1))
+)
+# 0 by default so serverless instances hold no idle connections; serve.py raises it for long-running workers
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', 0))
+client = AsyncIOMotorClient(
+    mongo_url,
+    tz_aware=True,  # dates come back as UTC-aware datetimes and serialize with their offset
+    maxPoolSize=int(os.environ.get('MONGO_MAX_POOL_SIZE', 100)),
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    event_listeners=[ProfileCommandListener(), slow_query_log]
+)
+# MONGO_UUID_IDS=1 stores users/products/carts/orders under a binary UUID _id (see uuid_ids.py)
+db = uuid_ids.open_database(client, os.environ['DB_NAME'])
 
 # JWT Configuration
 SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'your-secret-key-change-in-production')
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
 
+# Every new account is granted the demo course
+DEMO_COURSE_ID = "12e942d3-1091-43f0-b22c-33508096276b"
+
+# Clerk webhook signing secret (whsec_...)
+CLERK_WEBHOOK_SECRET = os.environ.get('CLERK_WEBHOOK_SECRET', '')
+clerk_event_batcher = ClerkEventBatcher(lambda: db.users)
+
+# Clerk session tokens are verified locally against a cached JWKS (see clerk_auth.py).
+# CLERK_JWKS (a JWKS file path or inline JSON) replaces the fetched key set for tests.
+CLERK_ISSUER = os.environ.get('CLERK_ISSUER', '').rstrip('/')  # https://<frontend-api>.clerk.accounts.dev
+CLERK_AUTHORIZED_PARTIES = [p.strip() for p in os.environ.get('CLERK_AUTHORIZED_PARTIES', '').split(',') if p.strip()]
+clerk_jwks = ClerkJWKS(
+    jwks_url=os.environ.get('CLERK_JWKS_URL') or (f"{CLERK_ISSUER}/.well-known/jwks.json" if CLERK_ISSUER else None),
+    local_jwks=load_local_jwks(os.environ['CLERK_JWKS']) if os.environ.get('CLERK_JWKS') else None,
+    refresh_interval=float(os.environ.get('CLERK_JWKS_REFRESH_SECONDS', 3600))
+)
+
+# Retention - carts and unpaid orders carry a native `expires_at` for their TTL indexes
+CART_TTL_DAYS = int(os.environ.get('CART_TTL_DAYS', 30))
+UNPAID_ORDER_TTL_HOURS = int(os.environ.get('UNPAID_ORDER_TTL_HOURS', 24))
+# A checkout claim with no Razorpay order after this long belongs to a dead request and may be taken over
+ORDER_CLAIM_LEASE_SECONDS = float(os.environ.get('ORDER_CLAIM_LEASE_SECONDS', 60))
+ORDER_ARCHIVE_AFTER_DAYS = int(os.environ.get('ORDER_ARCHIVE_AFTER_DAYS', 180))
+
+# Guest carts - signed tokens in a cookie (or X-Guest-Cart header), checked against the cached catalog
+GUEST_CART_SECRET = os.environ.get('GUEST_CART_SECRET') or os.environ.get('JWT_SECRET_KEY', 'your-secret-key-change-in-production')
+GUEST_CART_COOKIE = "guest_cart"
+CATALOG_CACHE_SECONDS = float(os.environ.get('CATALOG_CACHE_SECONDS', 60))
+
+# HLS course videos - playlist URLs are HMAC-signed and expire, and so do the segment URLs they list
+HLS_SIGNING_SECRET = os.environ.get('HLS_SIGNING_SECRET') or os.environ.get('JWT_SECRET_KEY', 'your-secret-key-change-in-production')
+HLS_URL_TTL_SECONDS = int(os.environ.get('HLS_URL_TTL_SECONDS', 4 * 3600))
+HLS_UPLOAD_CONCURRENCY = 4
+# Uploaded sources wait here for a transcode worker; use a shared volume across hosts
+HLS_SOURCE_DIR = os.environ.get('HLS_SOURCE_DIR', os.path.join(tempfile.gettempdir(), 'hls-sources'))
+# Segments are listed as expiring CDN token URLs, so HLS is off (progressive video only) without the key;
+# the alternative, private download URLs, would serve every segment uncached from Cloudinary's API host
+CLOUDINARY_AUTH_TOKEN_KEY = os.environ.get('CLOUDINARY_AUTH_TOKEN_KEY', '')
+
+# Write-behind popularity counters; up to COUNTER_FLUSH_SECONDS of counts are lost on a crash
+product_counters = ProductCounterBuffer(
+    flush_interval=float(os.environ.get('COUNTER_FLUSH_SECONDS', 10)),
+    max_keys=int(os.environ.get('COUNTER_MAX_KEYS', 5000))
+)
+
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -48,10 +141,35 @@ razorpay_client = razorpay.Client(auth=(
     os.environ.get('RAZORPAY_KEY_SECRET', '')
 ))
 
+# Deadlines, bulkheads and circuit breakers for the payment and media SDKs.
+# Client errors (bad request) don't count against a breaker.
+razorpay_guard = DependencyGuard(
+    "razorpay",
+    timeout=float(os.environ.get('RAZORPAY_TIMEOUT_SECONDS', 10)),
+    max_concurrency=int(os.environ.get('RAZORPAY_MAX_CONCURRENCY', 20)),
+    failure_threshold=int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5)),
+    reset_timeout=float(os.environ.get('BREAKER_RESET_SECONDS', 30)),
+    is_failure=lambda exc: not isinstance(exc, razorpay.errors.BadRequestError)
+)
+cloudinary_guard = DependencyGuard(
+    "cloudinary",
+    timeout=float(os.environ.get('CLOUDINARY_TIMEOUT_SECONDS', 60)),
+    max_concurrency=int(os.environ.get('CLOUDINARY_MAX_CONCURRENCY', 8)),
+    failure_threshold=int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5)),
+    reset_timeout=float(os.environ.get('BREAKER_RESET_SECONDS', 30)),
+    is_failure=lambda exc: not isinstance(exc, (cloudinary.exceptions.BadRequest, cloudinary.exceptions.NotAllowed))
+)
+
 # Create the main app
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
+
+# Order status pub/sub for the SSE endpoint
+order_event_bus = OrderEventBus()
+ORDER_EVENTS_TIMEOUT_SECONDS = int(os.environ.get('ORDER_EVENTS_TIMEOUT_SECONDS', 600))
+ORDER_EVENTS_HEARTBEAT_SECONDS = 15
 
 # Models
 class UserRegister(BaseModel):
@@ -78,7 +196,27 @@ class User(BaseModel):
     clerk_id: Optional[str] = None  # Clerk user ID for Clerk authenticated users
     profile_image_url: Optional[str] = None
     purchased_products: List[str] = Field(default_factory=list)
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class VideoChapter(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    title: str
+    time: float = 0  # offset into the video, in seconds
+
+class ProductChapters(BaseModel):
+    """Chapters live in their own collection so catalog reads never pull them."""
+    model_config = ConfigDict(extra="ignore")
+    product_id: str
+    chapters: List[VideoChapter] = Field(default_factory=list)
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class ProductImage(BaseModel):
+    """Responsive derivatives of an uploaded product image."""
+    model_config = ConfigDict(extra="ignore")
+    public_id: str
+    placeholder: str  # tiny blurred LQIP, inlined as a data URI when it could be fetched at upload
+    sizes: Dict[str, Dict[str, str]] = Field(default_factory=dict)  # size -> format -> url
+    srcset: Dict[str, str] = Field(default_factory=dict)  # format -> srcset attribute
 
 class Product(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -88,11 +226,26 @@ class Product(BaseModel):
     price: float
     category: str  # "software" or "course"
     image_url: str
+    image: Optional[ProductImage] = None
     download_link: str
     video_url: Optional[str] = None
-    video_chapters: Optional[List[dict]] = Field(default_factory=list)
+    video_chapters: Optional[List[VideoChapter]] = Field(default_factory=list)
     features: List[str] = Field(default_factory=list)
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    version: int = 0  # bumped on every admin edit; exposed as the ETag
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class ProductSummary(BaseModel):
+    """Catalog listing shape - detail fields are served by get_product only."""
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    name: str
+    description: str  # excerpt for the listing card; get_product returns the full text
+    price: float
+    category: str
+    image_url: str
+    image: Optional[ProductImage] = None
+    video_url: Optional[str] = None
+    created_at: Optional[datetime] = None
 
 class ProductCreate(BaseModel):
     name: str
@@ -102,7 +255,7 @@ class ProductCreate(BaseModel):
     image_url: str
     download_link: str
     video_url: Optional[str] = None
-    video_chapters: Optional[List[dict]] = Field(default_factory=list)
+    video_chapters: Optional[List[VideoChapter]] = Field(default_factory=list)
     features: List[str] = Field(default_factory=list)
 
 class CartItem(BaseModel):
@@ -114,7 +267,8 @@ class Cart(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
     items: List[CartItem] = Field(default_factory=list)
-    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    expires_at: datetime = Field(default_factory=lambda: cart_expiry())
 
 class Order(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -125,7 +279,14 @@ class Order(BaseModel):
     razorpay_order_id: str
     razorpay_payment_id: Optional[str] = None
     status: str = "created"  # created, paid, failed
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    paid_at: Optional[datetime] = None
+    cart_fingerprint: Optional[str] = None
+    idempotency_key: Optional[str] = None  # client Idempotency-Key, or "cart:<fingerprint>"
+    claimed_at: Optional[datetime] = None  # lease on the claim; cleared once razorpay_order_id is set
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    expires_at: Optional[datetime] = Field(  # cleared once the order is paid or failed
+        default_factory=lambda: datetime.now(timezone.utc) + timedelta(hours=UNPAID_ORDER_TTL_HOURS)
+    )
 
 class RazorpayOrderCreate(BaseModel):
     amount: float
@@ -144,10 +305,154 @@ class ProductUpdate(BaseModel):
     image_url: Optional[str] = None
     download_link: Optional[str] = None
     video_url: Optional[str] = None
-    video_chapters: Optional[List[dict]] = None
+    video_chapters: Optional[List[VideoChapter]] = None
     features: Optional[List[str]] = None
 
+# Image derivatives generated at upload time: name -> width in px
+IMAGE_DERIVATIVE_WIDTHS = {"thumbnail": 160, "card": 480, "hero": 1280}
+IMAGE_DERIVATIVE_FORMATS = ["avif", "webp", "jpg"]  # preferred first, jpg is the fallback
+IMAGE_PLACEHOLDER_TRANSFORMATION = {"width": 32, "crop": "limit", "effect": "blur:1000", "quality": "auto:low"}
+IMAGE_PLACEHOLDER_MAX_BYTES = 2048  # larger placeholders stay a URL rather than bloat every listing row
+
+# Projections - listings skip the heavy detail fields (chapters, features)
+PRODUCT_EXCERPT_CHARS = 160
+PRODUCT_SUMMARY_PROJECTION = {
+    "_id": 0, "id": 1, "name": 1, "price": 1, "category": 1, "image_url": 1,
+    "video_url": 1, "created_at": 1,
+    # Cards render the srcsets; the card jpg is the only fixed URL they need as a fallback
+    "image.public_id": 1, "image.placeholder": 1, "image.srcset": 1, "image.sizes.card.jpg": 1,
+    # Listing cards clamp the description to two lines, so only a teaser leaves the server
+    "description": {"$substrCP": ["$description", 0, PRODUCT_EXCERPT_CHARS]},
+}
+PRODUCT_LIBRARY_PROJECTION = {"_id": 0, "video_chapters": 0, "features": 0}
+PRODUCT_PRICE_PROJECTION = {"_id": 0, "id": 1, "name": 1, "price": 1}
+
+# Request coalescing
+class SingleFlight:
+    """
+    Collapses concurrent identical reads into one in-flight query.
+
+    Callers with the same key await the same task, so results are shared
+    and must be treated as read-only. The query runs as its own task, so a
+    disconnecting leader doesn't cancel it for everyone else.
+    """
+    def __init__(self):
+        self._inflight: Dict[tuple, asyncio.Task] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    async def do(self, key: tuple, fn):
+        counters = self._stats.setdefault(key[0], {"executed": 0, "coalesced": 0})
+        task = self._inflight.get(key)
+        if task is None:
+            counters["executed"] += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            counters["coalesced"] += 1
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {name: dict(counters) for name, counters in self._stats.items()}
+
+single_flight = SingleFlight()
+
+# Data access - shared reads go through single_flight
+async def fetch_product(product_id: str) -> Optional[dict]:
+    return await single_flight.do(
+        ("product", product_id),
+        lambda: db.products.find_one({"id": product_id}, {"_id": 0})
+    )
+
+async def fetch_product_chapters(product_id: str, legacy: Optional[list] = None) -> List[dict]:
+    return await single_flight.do(
+        ("product_chapters", product_id),
+        lambda: load_product_chapters(product_id, legacy)
+    )
+
+async def fetch_catalog() -> List[dict]:
+    """Every product, unlike the capped listing, so any product can sit in a guest cart."""
+    return await single_flight.do(
+        ("catalog",), lambda: db.products.find({}, PRODUCT_SUMMARY_PROJECTION).to_list(None)
+    )
+
+async def fetch_products(category: Optional[str] = None, sort: Optional[str] = None) -> List[dict]:
+    query = {"category": category} if category else {}
+    
+    def find():
+        cursor = db.products.find(query, PRODUCT_SUMMARY_PROJECTION)
+        if sort:
+            cursor = cursor.sort(SORT_FIELDS[sort], -1)
+        return cursor.to_list(1000)
+    
+    return await single_flight.do(("products", category, sort), find)
+
+async def fetch_products_by_ids(product_ids: List[str]) -> List[dict]:
+    ids = sorted(set(product_ids))
+    return await single_flight.do(
+        ("purchased_products", tuple(ids)),
+        lambda: db.products.find({"id": {"$in": ids}}, PRODUCT_LIBRARY_PROJECTION).to_list(1000)
+    )
+
+class CatalogCache:
+    """
+    Product summaries keyed by id, reloaded every `ttl` seconds or after an
+    admin changes a product. Lets guest carts be validated without a query.
+    """
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._products: Dict[str, dict] = {}
+        self._loaded_at = float("-inf")
+        self._generation = 0
+
+    async def get(self) -> Dict[str, dict]:
+        if time.monotonic() - self._loaded_at > self.ttl:
+            generation = self._generation
+            products = await fetch_catalog()
+            # A write during the load may not be in this snapshot; keep it stale
+            if generation == self._generation:
+                self._products = {product['id']: product for product in products}
+                self._loaded_at = time.monotonic()
+            else:
+                return {product['id']: product for product in products}
+        return self._products
+
+    def invalidate(self):
+        self._generation += 1
+        self._loaded_at = float("-inf")
+
+catalog_cache = CatalogCache(CATALOG_CACHE_SECONDS)
+
 # Helper functions
+def product_etag(product: dict) -> str:
+    return f'"{product.get("version", 0)}"'
+
+def if_match_version(request: Request) -> Optional[int]:
+    """Product version named by If-Match ("3" or W/"3"); None when absent or "*"."""
+    header = (request.headers.get("If-Match") or "").strip()
+    if not header or header == "*":
+        return None
+    try:
+        return int(header.removeprefix("W/").strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=412, detail="If-Match does not name a product version")
+
+def product_precondition(product_id: str, version: Optional[int]) -> dict:
+    query = {"id": product_id}
+    if version is not None:
+        # Products created before versioning have no field and count as version 0
+        query.update({"$or": [{"version": 0}, {"version": {"$exists": False}}]} if version == 0 else {"version": version})
+    return query
+
+async def precondition_failure(product_id: str, version: Optional[int]) -> HTTPException:
+    """Tell a missing product (404) from a stale If-Match (412) after a conditional write matched nothing."""
+    if version is not None and await db.products.find_one({"id": product_id}, {"_id": 1}):
+        return HTTPException(status_code=412, detail="Product was modified by someone else; reload and retry")
+    return HTTPException(status_code=404, detail="Product not found")
+
+def cart_expiry() -> datetime:
+    return datetime.now(timezone.utc) + timedelta(days=CART_TTL_DAYS)
+
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
 
@@ -161,27 +466,179 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+async def load_authenticated_user(query: dict) -> dict:
+    """Shared by the app-JWT and Clerk dependencies once the token itself is verified."""
+    user = await db.users.find_one(query, {"_id": 0})
+    if user is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    bind_request_context(user_id=user['id'])
+    return user
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         token = credentials.credentials
+        # Clerk session tokens (RS256) are accepted wherever our own HS256 tokens are
+        if clerk_jwks.configured and jwt.get_unverified_header(token).get("alg") in CLERK_ALGORITHMS:
+            claims = await get_clerk_claims(credentials)
+            return await load_authenticated_user({"clerk_id": claims["sub"]})
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id: str = payload.get("sub")
         if user_id is None:
             raise HTTPException(status_code=401, detail="Invalid token")
-        user = await db.users.find_one({"id": user_id}, {"_id": 0})
-        if user is None:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
+        return await load_authenticated_user({"id": user_id})
     except ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+async def get_clerk_claims(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    """Verified claims of a Clerk session token; `sub` is the Clerk user id."""
+    if not clerk_jwks.configured:
+        raise HTTPException(status_code=503, detail="Clerk authentication not configured")
+    try:
+        return await verify_session_token(
+            clerk_jwks, credentials.credentials, issuer=CLERK_ISSUER, authorized_parties=CLERK_AUTHORIZED_PARTIES
+        )
+    except ClerkJWKSUnavailable as e:
+        # A Clerk outage must not look like a bad token, or clients sign users out
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(clerk_jwks.min_refetch_interval))})
+    except ClerkTokenError as e:
+        raise HTTPException(status_code=401, detail=str(e))
+
+async def get_current_clerk_user(claims: dict = Depends(get_clerk_claims)):
+    return await load_authenticated_user({"clerk_id": claims["sub"]})
+
+async def get_current_user_for_stream(
+    token: Optional[str] = None,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+):
+    """Like get_current_user, but browsers' EventSource can't set headers, so ?token= is accepted too."""
+    if credentials is None and token:
+        credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+    if credentials is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return await get_current_user(credentials)
+
 async def get_admin_user(current_user: dict = Depends(get_current_user)):
     if current_user.get('role') != 'admin':
         raise HTTPException(status_code=403, detail="Admin access required")
     return current_user
 
+async def is_admin_request(scope: dict) -> bool:
+    """Admin check for ASGI middleware, which runs before FastAPI dependencies."""
+    headers = dict(scope.get("headers") or [])
+    scheme, _, token = headers.get(b"authorization", b"").decode().partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return False
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except InvalidTokenError:
+        return False
+    user = await db.users.find_one({"id": payload.get("sub")}, {"_id": 0, "role": 1})
+    return bool(user) and user.get('role') == 'admin'
+
+def image_derivative_transformations() -> List[dict]:
+    """Eager transformations so Cloudinary renders every derivative at upload time."""
+    transformations = [
+        {"width": width, "crop": "limit", "quality": "auto", "format": fmt}
+        for width in IMAGE_DERIVATIVE_WIDTHS.values()
+        for fmt in IMAGE_DERIVATIVE_FORMATS
+    ]
+    transformations.append({**IMAGE_PLACEHOLDER_TRANSFORMATION, "format": "jpg"})
+    return transformations
+
+def build_product_image(public_id: str, placeholder: Optional[str] = None) -> ProductImage:
+    """Derivative URLs are deterministic, so they are built locally."""
+    def url(**options):
+        return cloudinary.utils.cloudinary_url(public_id, secure=True, **options)[0]
+
+    sizes = {
+        name: {fmt: url(width=width, crop="limit", quality="auto", format=fmt) for fmt in IMAGE_DERIVATIVE_FORMATS}
+        for name, width in IMAGE_DERIVATIVE_WIDTHS.items()
+    }
+    srcset = {
+        fmt: ", ".join(f"{sizes[name][fmt]} {width}w" for name, width in IMAGE_DERIVATIVE_WIDTHS.items())
+        for fmt in IMAGE_DERIVATIVE_FORMATS
+    }
+    return ProductImage(
+        public_id=public_id,
+        placeholder=placeholder or image_placeholder_url(public_id),
+        sizes=sizes,
+        srcset=srcset
+    )
+
+def image_placeholder_url(public_id: str) -> str:
+    return cloudinary.utils.cloudinary_url(
+        public_id, secure=True, transformation=[IMAGE_PLACEHOLDER_TRANSFORMATION], format="jpg"
+    )[0]
+
+def placeholder_data_uri(content: bytes) -> Optional[str]:
+    if not content or len(content) > IMAGE_PLACEHOLDER_MAX_BYTES:
+        return None
+    return "data:image/jpeg;base64," + base64.b64encode(content).decode("ascii")
+
+async def inline_image_placeholder(public_id: str) -> Optional[str]:
+    """The blurred placeholder as a data URI, so cards paint it without another request."""
+    def fetch():
+        response = requests.get(image_placeholder_url(public_id), timeout=5)
+        response.raise_for_status()
+        return response.content
+
+    try:
+        return placeholder_data_uri(await asyncio.to_thread(fetch))
+    except requests.RequestException as e:
+        logger.warning(f"⚠️ Could not inline image placeholder for {public_id}: {e}")
+        return None
+
+async def cloudinary_upload(file, **options) -> dict:
+    with profile_span("cloudinary"):
+        return await cloudinary_guard.call(cloudinary.uploader.upload, file, **options)
+
+async def upload_product_image(file) -> Tuple[str, ProductImage]:
+    result = await cloudinary_upload(
+        file,
+        folder="ecommerce/products",
+        resource_type="image",
+        eager=image_derivative_transformations(),
+        eager_async=True
+    )
+    placeholder = await inline_image_placeholder(result['public_id'])
+    return result['secure_url'], build_product_image(result['public_id'], placeholder)
+
+def coerce_video_chapters(data) -> List[VideoChapter]:
+    """Validate a raw chapter list, dropping malformed entries."""
+    chapters = []
+    for entry in data if isinstance(data, list) else []:
+        try:
+            chapters.append(VideoChapter.model_validate(entry))
+        except ValidationError:
+            continue
+    return sorted(chapters, key=lambda ch: ch.time)
+
+def parse_video_chapters(raw: str) -> List[VideoChapter]:
+    """Parse the JSON chapter list sent by the admin form."""
+    try:
+        return coerce_video_chapters(json.loads(raw))
+    except ValueError:
+        return []
+
+async def load_product_chapters(product_id: str, legacy: Optional[list] = None) -> List[dict]:
+    doc = await db.product_chapters.find_one({"product_id": product_id}, {"_id": 0, "chapters": 1})
+    if doc is not None:
+        return doc.get('chapters', [])
+    # Products written before chapters were split out still carry them inline
+    return [ch.model_dump() for ch in coerce_video_chapters(legacy)]
+
+async def save_product_chapters(product_id: str, chapters: List[VideoChapter], unset_legacy: bool = True):
+    doc = ProductChapters(product_id=product_id, chapters=chapters)
+    await db.product_chapters.update_one(
+        {"product_id": product_id},
+        {"$set": doc.model_dump()},
+        upsert=True
+    )
+    if unset_legacy:
+        await db.products.update_one({"id": product_id}, {"$unset": {"video_chapters": ""}})
+
 # Auth Routes
 @api_router.post("/auth/register")
 async def register(user_data: UserRegister):
@@ -191,11 +648,10 @@ async def register(user_data: UserRegister):
         raise HTTPException(status_code=400, detail="Email already registered")
     
     # Create user with demo course
-    demo_course_id = "12e942d3-1091-43f0-b22c-33508096276b"
     user = User(
         email=user_data.email,
         name=user_data.name,
-        purchased_products=[demo_course_id]
+        purchased_products=[DEMO_COURSE_ID]
     )
     user_dict = user.model_dump()
     user_dict['password_hash'] = hash_password(user_data.password)
@@ -216,7 +672,7 @@ async def register(user_data: UserRegister):
     }
 
 @api_router.post("/auth/login")
-async def login(login_data: UserLogin):
+async def login(login_data: UserLogin, request: Request, response: Response):
     user = await db.users.find_one({"email": login_data.email}, {"_id": 0})
     if not user:
         raise HTTPException(status_code=401, detail="Invalid email or password")
@@ -225,6 +681,7 @@ async def login(login_data: UserLogin):
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
     token = create_access_token({"sub": user['id']})
+    await merge_guest_cart(request, response, user)
     
     return {
         "token": token,
@@ -237,26 +694,42 @@ async def login(login_data: UserLogin):
     }
 
 @api_router.post("/auth/clerk-sync")
-async def clerk_sync(clerk_user: ClerkUserSync):
+async def clerk_sync(
+    clerk_user: ClerkUserSync, request: Request, response: Response, claims: dict = Depends(get_clerk_claims)
+):
     """
-    Sync Clerk user to MongoDB. Creates new user or updates existing one.
+    Sync Clerk user to MongoDB. Creates new user or updates existing one
+    in a single atomic upsert; the demo course is only granted on insert.
+    The clerk_id must match the caller's verified session token. A guest
+    cart brought to sign-in is merged into the user's cart.
     """
-    # Check if user already exists by clerk_id
-    existing_user = await db.users.find_one({"clerk_id": clerk_user.clerk_id}, {"_id": 0})
-    
-    if existing_user:
-        # Update existing user
-        update_data = {
-            "name": clerk_user.name,
-            "email": clerk_user.email,
-        }
-        if clerk_user.profile_image_url:
-            update_data["profile_image_url"] = clerk_user.profile_image_url
-            
-        await db.users.update_one(
+    if clerk_user.clerk_id != claims["sub"]:
+        raise HTTPException(status_code=403, detail="Cannot sync another Clerk user")
+    update = clerk_user_upsert(
+        clerk_user.clerk_id, clerk_user.email, clerk_user.name, clerk_user.profile_image_url, DEMO_COURSE_ID
+    )
+    try:
+        existing_user = await db.users.find_one_and_update(
+            {"clerk_id": clerk_user.clerk_id},
+            update,
+            projection={"_id": 0, "id": 1, "purchased_products": 1},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        # A concurrent sign-in inserted the user first; the retry takes the update path
+        existing_user = await db.users.find_one_and_update(
             {"clerk_id": clerk_user.clerk_id},
-            {"$set": update_data}
+            {"$set": update["$set"]},
+            projection={"_id": 0, "id": 1, "purchased_products": 1},
+            return_document=ReturnDocument.BEFORE
         )
+    
+    await merge_guest_cart(request, response, existing_user or {
+        "id": update["$setOnInsert"]["id"], "purchased_products": update["$setOnInsert"]["purchased_products"]
+    })
+    
+    if existing_user:
         return {
             "status": "updated",
             "user": {
@@ -266,30 +739,41 @@ async def clerk_sync(clerk_user: ClerkUserSync):
                 "clerk_id": clerk_user.clerk_id
             }
         }
-    else:
-        # Create new user with demo course
-        demo_course_id = "12e942d3-1091-43f0-b22c-33508096276b"
-        user = User(
-            email=clerk_user.email,
-            name=clerk_user.name,
-            clerk_id=clerk_user.clerk_id,
-            profile_image_url=clerk_user.profile_image_url,
-            purchased_products=[demo_course_id]
-        )
-        user_dict = user.model_dump()
-        
-        await db.users.insert_one(user_dict)
-        
-        return {
-            "status": "created",
-            "user": {
-                "id": user.id,
-                "email": user.email,
-                "name": user.name,
-                "clerk_id": user.clerk_id,
-                "purchased_products": user.purchased_products
-            }
+    return {
+        "status": "created",
+        "user": {
+            "id": update["$setOnInsert"]["id"],
+            "email": clerk_user.email,
+            "name": clerk_user.name,
+            "clerk_id": clerk_user.clerk_id,
+            "purchased_products": update["$setOnInsert"]["purchased_products"]
         }
+    }
+
+@api_router.post("/webhooks/clerk")
+async def clerk_webhook(request: Request):
+    """
+    Clerk user.created/updated/deleted events. Accepts a single event or a
+    JSON array (bulk imports); writes are batched across concurrent requests.
+    """
+    if not CLERK_WEBHOOK_SECRET:
+        raise HTTPException(status_code=503, detail="Clerk webhook secret not configured")
+    body = await request.body()
+    try:
+        verify_svix_signature(CLERK_WEBHOOK_SECRET, request.headers, body)
+    except WebhookVerificationError as e:
+        raise HTTPException(status_code=401, detail=f"Invalid webhook signature: {e}")
+    
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    events = payload if isinstance(payload, list) else [payload]
+    if not all(isinstance(event, dict) for event in events):
+        raise HTTPException(status_code=400, detail="Events must be JSON objects")
+    operations = [op for op in (event_to_operation(event, DEMO_COURSE_ID) for event in events) if op is not None]
+    await clerk_event_batcher.submit(operations)
+    return {"received": len(events), "applied": len(operations)}
 
 @api_router.get("/auth/me")
 async def get_me(current_user: dict = Depends(get_current_user)):
@@ -302,25 +786,107 @@ async def get_me(current_user: dict = Depends(get_current_user)):
     }
 
 # Product Routes
-@api_router.get("/products", response_model=List[Product])
-async def get_products(category: Optional[str] = None):
-    query = {}
-    if category:
-        query['category'] = category
-    products = await db.products.find(query, {"_id": 0}).to_list(1000)
-    return products
+@api_router.get("/products", response_model=List[ProductSummary])
+async def get_products(category: Optional[str] = None, sort: Optional[str] = None):
+    if sort and sort not in SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of {', '.join(SORT_FIELDS)}")
+    return await fetch_products(category, sort)
 
 @api_router.get("/products/{product_id}", response_model=Product)
-async def get_product(product_id: str):
-    product = await db.products.find_one({"id": product_id}, {"_id": 0})
+async def get_product(product_id: str, response: Response):
+    product = await fetch_product(product_id)
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
-    return product
+    response.headers["ETag"] = product_etag(product)
+    product_counters.record_view(product_id)
+    chapters = await fetch_product_chapters(product_id, product.get('video_chapters'))
+    return {**product, 'video_chapters': chapters}
+
+@api_router.get("/products/{product_id}/chapters", response_model=List[VideoChapter])
+async def get_product_chapters(product_id: str):
+    product = await db.products.find_one({"id": product_id}, {"_id": 0, "video_chapters": 1})
+    if product is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return await load_product_chapters(product_id, product.get('video_chapters'))
+
+async def fetch_related(product_ids: List[str], exclude: set, limit: int) -> List[dict]:
+    """Merge precomputed related lists for the given products, best combined score first."""
+    docs = await db.product_recommendations.find(
+        {"product_id": {"$in": product_ids}}, {"_id": 0, "related": 1}
+    ).to_list(len(product_ids))
+    scores = {}
+    for doc in docs:
+        for related in doc.get('related', []):
+            if related['product_id'] not in exclude:
+                scores[related['product_id']] = scores.get(related['product_id'], 0) + related['score']
+    ranked = sorted(scores, key=scores.get, reverse=True)[:limit]
+    if not ranked:
+        return []
+    products = await db.products.find({"id": {"$in": ranked}}, PRODUCT_SUMMARY_PROJECTION).to_list(limit)
+    products.sort(key=lambda product: ranked.index(product['id']))
+    return products
+
+@api_router.get("/products/{product_id}/related", response_model=List[ProductSummary])
+async def get_related_products(product_id: str, limit: int = 6):
+    return await fetch_related([product_id], {product_id}, min(limit, recommendations.TOP_K))
+
+def hls_path(product_id: str, name: str) -> str:
+    return f"/api/hls/{product_id}/{name}.m3u8"
+
+def hls_segment_url(public_id: str, expires: int) -> str:
+    """CDN delivery URL for an authenticated segment that stops working with the playlist grant."""
+    return cloudinary.utils.cloudinary_url(
+        public_id, resource_type="raw", type="authenticated", secure=True, sign_url=True,
+        auth_token={"key": CLOUDINARY_AUTH_TOKEN_KEY, "expiration": expires}
+    )[0]
+
+@api_router.get("/products/{product_id}/stream")
+async def get_product_stream(product_id: str, current_user: dict = Depends(get_current_user)):
+    """Signed HLS manifest URL for owners of the product (and admins)."""
+    if current_user.get('role') != 'admin' and product_id not in current_user.get('purchased_products', []):
+        raise HTTPException(status_code=403, detail="Purchase this product to stream it")
+    video = await db.product_videos.find_one({"product_id": product_id}, {"_id": 0, "status": 1})
+    if not CLOUDINARY_AUTH_TOKEN_KEY or not video or video['status'] != "ready":
+        raise HTTPException(status_code=404, detail="No streaming version available")
+    return {
+        "manifest_url": video_hls.sign_path(HLS_SIGNING_SECRET, hls_path(product_id, "master"), HLS_URL_TTL_SECONDS),
+        "expires_in": HLS_URL_TTL_SECONDS
+    }
+
+@api_router.get("/hls/{product_id}/{name}.m3u8")
+async def get_hls_playlist(product_id: str, name: str, exp: int, sig: str):
+    if not video_hls.verify_path(HLS_SIGNING_SECRET, hls_path(product_id, name), exp, sig):
+        raise HTTPException(status_code=403, detail="Invalid or expired playlist URL")
+    video = await db.product_videos.find_one({"product_id": product_id, "status": "ready"}, {"_id": 0})
+    if not CLOUDINARY_AUTH_TOKEN_KEY or not video:
+        raise HTTPException(status_code=404, detail="Playlist not found")
+    
+    if name == "master":
+        # Variants inherit the master's expiry, so one grant covers the whole session
+        playlist = video_hls.master_playlist(
+            video['renditions'],
+            lambda variant: f"{variant}.m3u8?{video_hls.signed_query(HLS_SIGNING_SECRET, hls_path(product_id, variant), exp)}"
+        )
+    else:
+        rendition = next((r for r in video['renditions'] if r['name'] == name), None)
+        if rendition is None:
+            raise HTTPException(status_code=404, detail="Playlist not found")
+        playlist = video_hls.media_playlist(
+            rendition['playlist'],
+            lambda segment: hls_segment_url(f"{video['folder']}/{name}/{segment}", exp)
+        )
+    return Response(
+        playlist,
+        media_type="application/vnd.apple.mpegurl",
+        headers={"Cache-Control": "private, max-age=60"}
+    )
 
 @api_router.post("/products", response_model=Product)
 async def create_product(product_data: ProductCreate, current_user: dict = Depends(get_current_user)):
     product = Product(**product_data.model_dump())
-    await db.products.insert_one(product.model_dump())
+    await db.products.insert_one(product.model_dump(exclude={"video_chapters"}))
+    await save_product_chapters(product.id, product.video_chapters or [])
+    catalog_cache.invalidate()
     return product
 
 # Cart Routes
@@ -333,7 +899,7 @@ async def get_cart(current_user: dict = Depends(get_current_user)):
     # Get product details for cart items
     items_with_details = []
     for item in cart.get('items', []):
-        product = await db.products.find_one({"id": item['product_id']}, {"_id": 0})
+        product = await db.products.find_one({"id": item['product_id']}, PRODUCT_SUMMARY_PROJECTION)
         if product:
             items_with_details.append({
                 "product": product,
@@ -342,10 +908,20 @@ async def get_cart(current_user: dict = Depends(get_current_user)):
     
     return {"items": items_with_details}
 
+@api_router.get("/cart/recommendations", response_model=List[ProductSummary])
+async def get_cart_recommendations(limit: int = 6, current_user: dict = Depends(get_current_user)):
+    """"You may also like" for the whole cart, skipping items already in the cart or owned."""
+    cart = await db.carts.find_one({"user_id": current_user['id']}, {"_id": 0, "items": 1})
+    cart_ids = [item['product_id'] for item in (cart or {}).get('items', [])]
+    if not cart_ids:
+        return []
+    exclude = set(cart_ids) | set(current_user.get('purchased_products', []))
+    return await fetch_related(cart_ids, exclude, min(limit, 20))
+
 @api_router.post("/cart/add")
 async def add_to_cart(item: CartItem, current_user: dict = Depends(get_current_user)):
     # Check if product exists
-    product = await db.products.find_one({"id": item.product_id})
+    product = await db.products.find_one({"id": item.product_id}, {"_id": 1})
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
@@ -368,7 +944,7 @@ async def add_to_cart(item: CartItem, current_user: dict = Depends(get_current_u
         
         await db.carts.update_one(
             {"user_id": current_user['id']},
-            {"$set": {"items": items, "updated_at": datetime.now(timezone.utc).isoformat()}}
+            {"$set": {"items": items, "updated_at": datetime.now(timezone.utc), "expires_at": cart_expiry()}}
         )
     
     return {"message": "Item added to cart"}
@@ -383,7 +959,7 @@ async def remove_from_cart(product_id: str, current_user: dict = Depends(get_cur
     
     await db.carts.update_one(
         {"user_id": current_user['id']},
-        {"$set": {"items": items, "updated_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {"items": items, "updated_at": datetime.now(timezone.utc), "expires_at": cart_expiry()}}
     )
     
     return {"message": "Item removed from cart"}
@@ -392,15 +968,141 @@ async def remove_from_cart(product_id: str, current_user: dict = Depends(get_cur
 async def clear_cart(current_user: dict = Depends(get_current_user)):
     await db.carts.update_one(
         {"user_id": current_user['id']},
-        {"$set": {"items": [], "updated_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {"items": [], "updated_at": datetime.now(timezone.utc), "expires_at": cart_expiry()}}
     )
     return {"message": "Cart cleared"}
 
+# Guest cart - no database access until it is merged at login or checkout
+def read_guest_cart(request: Request) -> List[str]:
+    token = request.headers.get("X-Guest-Cart") or request.cookies.get(GUEST_CART_COOKIE)
+    if not token:
+        return []
+    try:
+        return decode_guest_cart(GUEST_CART_SECRET, token, max_age_seconds=CART_TTL_DAYS * 86400)
+    except (GuestCartError, ValueError):
+        # Tampered or expired carts are dropped rather than failing the request
+        return []
+
+async def guest_cart_response(request: Request, response: Response, product_ids: List[str]) -> dict:
+    catalog = await catalog_cache.get()
+    product_ids = [product_id for product_id in product_ids if product_id in catalog]
+    token = encode_guest_cart(GUEST_CART_SECRET, product_ids)
+    response.set_cookie(
+        GUEST_CART_COOKIE, token, max_age=CART_TTL_DAYS * 86400,
+        httponly=True, samesite="lax", secure=request.url.scheme == "https"
+    )
+    return {
+        "items": [{"product": catalog[product_id], "quantity": 1} for product_id in product_ids],
+        "guest_cart": token
+    }
+
+async def merge_guest_cart(request: Request, response: Response, user: dict) -> Optional[dict]:
+    """Fold the request's guest cart into the user's cart in one upsert; None if there was nothing to merge."""
+    guest_ids = read_guest_cart(request)
+    if not guest_ids:
+        return None
+    response.delete_cookie(GUEST_CART_COOKIE)
+    catalog = await catalog_cache.get()
+    owned = set(user.get('purchased_products', []))
+    items = [
+        CartItem(product_id=product_id).model_dump()
+        for product_id in guest_ids if product_id in catalog and product_id not in owned
+    ]
+    if not items:
+        return None
+    return await db.carts.find_one_and_update(
+        {"user_id": user['id']},
+        {
+            "$addToSet": {"items": {"$each": items}},
+            "$set": {"updated_at": datetime.now(timezone.utc), "expires_at": cart_expiry()},
+            "$setOnInsert": {"id": str(uuid.uuid4())}
+        },
+        projection={"_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+
+@api_router.get("/cart/guest")
+async def get_guest_cart(request: Request, response: Response):
+    return await guest_cart_response(request, response, read_guest_cart(request))
+
+@api_router.post("/cart/guest/add")
+async def add_to_guest_cart(item: CartItem, request: Request, response: Response):
+    if item.product_id not in await catalog_cache.get():
+        raise HTTPException(status_code=404, detail="Product not found")
+    product_ids = read_guest_cart(request)
+    if item.product_id in product_ids:
+        raise HTTPException(status_code=400, detail="Product already in cart")
+    return await guest_cart_response(request, response, product_ids + [item.product_id])
+
+@api_router.delete("/cart/guest/remove/{product_id}")
+async def remove_from_guest_cart(product_id: str, request: Request, response: Response):
+    product_ids = [pid for pid in read_guest_cart(request) if pid != product_id]
+    return await guest_cart_response(request, response, product_ids)
+
+@api_router.delete("/cart/guest/clear")
+async def clear_guest_cart(request: Request, response: Response):
+    return await guest_cart_response(request, response, [])
+
+@api_router.post("/cart/merge")
+async def merge_cart(request: Request, response: Response, current_user: dict = Depends(get_current_user)):
+    cart = await merge_guest_cart(request, response, current_user)
+    return {"message": "Guest cart merged", "items": len(cart['items']) if cart else 0}
+
 # Payment & Order Routes
+def cart_fingerprint(items: List[dict]) -> str:
+    """Stable hash of what is being bought and at which prices."""
+    canonical = sorted((item['product_id'], item['quantity'], item['price']) for item in items)
+    return hashlib.sha256(json.dumps(canonical).encode()).hexdigest()
+
+def checkout_response(order: dict, reused: bool = False) -> dict:
+    return {
+        "order_id": order['id'],
+        "razorpay_order_id": order['razorpay_order_id'],
+        "amount": order['total'],
+        "currency": "INR",
+        "key_id": os.environ.get('RAZORPAY_KEY_ID', ''),
+        "reused": reused
+    }
+
+async def wait_for_razorpay_order(order_id: str, timeout: float = 5.0) -> Optional[dict]:
+    """
+    Another request claimed this checkout and is still talking to Razorpay.
+    Returns the order once it has a Razorpay id, None if the claim went away,
+    or the still-unfinished claim when the wait times out.
+    """
+    deadline = asyncio.get_running_loop().time() + timeout
+    while True:
+        order = await db.orders.find_one({"id": order_id}, {"_id": 0})
+        if order is None or order.get('razorpay_order_id') or asyncio.get_running_loop().time() >= deadline:
+            return order
+        await asyncio.sleep(0.1)
+
+async def release_stale_claim(order: dict) -> bool:
+    """Delete a claim whose lease ran out before it got a Razorpay order (the worker died)."""
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=ORDER_CLAIM_LEASE_SECONDS)
+    result = await db.orders.delete_one({
+        "id": order['id'], "razorpay_order_id": "",
+        "$or": [
+            {"claimed_at": {"$lte": cutoff}},
+            # Claims made before the lease field existed
+            {"claimed_at": {"$exists": False}, "created_at": {"$lte": cutoff}}
+        ]
+    })
+    return result.deleted_count == 1
+
 @api_router.post("/orders/create")
-async def create_order(current_user: dict = Depends(get_current_user)):
-    # Get cart
-    cart = await db.carts.find_one({"user_id": current_user['id']})
+async def create_order(request: Request, response: Response, current_user: dict = Depends(get_current_user)):
+    """
+    Reuses the user's unexpired pending order when the cart is unchanged (or
+    the Idempotency-Key matches), so retries and double clicks don't create
+    new Razorpay orders. Concurrent requests are serialized by a unique index
+    on (user_id, idempotency_key) over pending orders.
+    """
+    # Get cart, folding in a guest cart brought to checkout
+    cart = await merge_guest_cart(request, response, current_user)
+    if cart is None:
+        cart = await db.carts.find_one({"user_id": current_user['id']})
     if not cart or not cart.get('items'):
         raise HTTPException(status_code=400, detail="Cart is empty")
     
@@ -408,7 +1110,7 @@ async def create_order(current_user: dict = Depends(get_current_user)):
     items = []
     total = 0
     for item in cart['items']:
-        product = await db.products.find_one({"id": item['product_id']}, {"_id": 0})
+        product = await db.products.find_one({"id": item['product_id']}, PRODUCT_PRICE_PROJECTION)
         if product:
             items.append({
                 "product_id": product['id'],
@@ -418,33 +1120,93 @@ async def create_order(current_user: dict = Depends(get_current_user)):
             })
             total += product['price'] * item['quantity']
     
+    fingerprint = cart_fingerprint(items)
+    client_key = request.headers.get("Idempotency-Key")
+    now = datetime.now(timezone.utc)
+    
+    # Reuse: an explicit key matches any earlier order, the cart fingerprint only a live pending one
+    if client_key:
+        lookup = {"user_id": current_user['id'], "idempotency_key": client_key}
+    else:
+        lookup = {"user_id": current_user['id'], "status": "created",
+                  "cart_fingerprint": fingerprint, "expires_at": {"$gt": now}}
+    
+    for _ in range(3):
+        existing = await db.orders.find_one(lookup, {"_id": 0})
+        if existing:
+            if existing.get('cart_fingerprint') != fingerprint:
+                raise HTTPException(status_code=422, detail="Idempotency-Key was used with a different cart")
+            if not existing.get('razorpay_order_id'):
+                existing = await wait_for_razorpay_order(existing['id'])
+                if existing and not existing.get('razorpay_order_id'):
+                    if not await release_stale_claim(existing):
+                        raise HTTPException(status_code=409, detail="Checkout already in progress")
+                    existing = None
+                if not existing:
+                    # The claim was abandoned; claim the checkout ourselves
+                    continue
+            return checkout_response(existing, reused=True)
+        
+        # Claim the checkout before calling Razorpay
+        order = Order(
+            user_id=current_user['id'],
+            items=items,
+            total=total,
+            razorpay_order_id="",
+            cart_fingerprint=fingerprint,
+            idempotency_key=client_key or f"cart:{fingerprint}",
+            claimed_at=now
+        )
+        try:
+            await db.orders.insert_one(order.model_dump())
+            break
+        except DuplicateKeyError:
+            # Lost the race, or an expired pending order the TTL monitor hasn't removed yet
+            await db.orders.delete_one({
+                "user_id": current_user['id'], "idempotency_key": order.idempotency_key,
+                "status": "created", "expires_at": {"$lte": now}
+            })
+            lookup = {"user_id": current_user['id'], "idempotency_key": order.idempotency_key, "status": "created"}
+    else:
+        raise HTTPException(status_code=409, detail="Checkout already in progress")
+    
     # Create Razorpay order
-    razorpay_order = razorpay_client.order.create({
-        "amount": int(total * 100),  # Convert to paise
-        "currency": "INR",
-        "payment_capture": 1
-    })
+    try:
+        with profile_span("razorpay"):
+            razorpay_order = await razorpay_guard.call(razorpay_client.order.create, {
+                "amount": int(total * 100),  # Convert to paise
+                "currency": "INR",
+                "payment_capture": 1
+            })
+    except Exception:
+        await db.orders.delete_one({"id": order.id})
+        raise
     
-    # Create order in database
-    order = Order(
-        user_id=current_user['id'],
-        items=items,
-        total=total,
-        razorpay_order_id=razorpay_order['id']
+    result = await db.orders.update_one(
+        {"id": order.id, "razorpay_order_id": ""},
+        {"$set": {"razorpay_order_id": razorpay_order['id']}, "$unset": {"claimed_at": ""}}
     )
+    if result.matched_count == 0:
+        # Razorpay took longer than the lease and another request took the checkout over
+        raise HTTPException(status_code=409, detail="Checkout already in progress")
+    order.razorpay_order_id = razorpay_order['id']
+    order.claimed_at = None
     
-    await db.orders.insert_one(order.model_dump())
-    
-    return {
-        "order_id": order.id,
-        "razorpay_order_id": razorpay_order['id'],
-        "amount": total,
-        "currency": "INR",
-        "key_id": os.environ.get('RAZORPAY_KEY_ID', '')
-    }
+    return checkout_response(order.model_dump())
+
+async def record_order_recommendations(order_id: str, product_ids: List[str], paid_at: datetime):
+    # Runs after the response; never fails a verified payment
+    try:
+        await recommendations.record_order(db, product_ids, paid_at)
+    except Exception as e:
+        logger.error(f"❌ Failed to update recommendations for order {order_id}: {e}")
 
 @api_router.post("/orders/verify")
-async def verify_payment(verification: PaymentVerification, current_user: dict = Depends(get_current_user)):
+async def verify_payment(
+    verification: PaymentVerification,
+    background_tasks: BackgroundTasks,
+    current_user: dict = Depends(get_current_user)
+):
     try:
         # Verify signature
         razorpay_client.utility.verify_payment_signature({
@@ -458,13 +1220,17 @@ async def verify_payment(verification: PaymentVerification, current_user: dict =
         if not order:
             raise HTTPException(status_code=404, detail="Order not found")
         
-        await db.orders.update_one(
-            {"id": verification.order_id},
+        # Conditional so a retried verify doesn't count the purchase twice
+        paid_at = datetime.now(timezone.utc)
+        result = await db.orders.update_one(
+            {"id": verification.order_id, "status": {"$ne": "paid"}},
             {"$set": {
                 "status": "paid",
+                "paid_at": paid_at,
                 "razorpay_payment_id": verification.razorpay_payment_id
-            }}
+            }, "$unset": {"expires_at": ""}}
         )
+        newly_paid = result.modified_count == 1
         
         # Add products to user's purchased list
         product_ids = [item['product_id'] for item in order['items']]
@@ -479,22 +1245,89 @@ async def verify_payment(verification: PaymentVerification, current_user: dict =
             {"$set": {"items": []}}
         )
         
+        if newly_paid:
+            order_event_bus.notify({**order, "status": "paid"})
+            product_counters.record_purchases(product_ids)
+            background_tasks.add_task(record_order_recommendations, verification.order_id, product_ids, paid_at)
+        
         return {"message": "Payment verified successfully", "status": "paid"}
     except Exception as e:
         await db.orders.update_one(
-            {"id": verification.order_id},
-            {"$set": {"status": "failed"}}
+            {"id": verification.order_id, "status": {"$ne": "paid"}},
+            {"$set": {"status": "failed"}, "$unset": {"expires_at": ""}}
         )
+        order_event_bus.notify({"id": verification.order_id, "status": "failed"})
         raise HTTPException(status_code=400, detail=f"Payment verification failed: {str(e)}")
 
 @api_router.get("/orders")
-async def get_orders(current_user: dict = Depends(get_current_user)):
-    orders = await db.orders.find({"user_id": current_user['id']}, {"_id": 0}).sort("created_at", -1).to_list(1000)
+async def get_orders(
+    limit: int = 1000,
+    before: Optional[datetime] = None,
+    include_archived: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Newest orders first. Page with ?before=<created_at of the last order>;
+    include_archived continues into orders_archive once recent orders run out.
+    """
+    limit = min(max(limit, 1), 1000)
+    query = {"user_id": current_user['id'], **time_range("created_at", lt=before)}
+    orders = await db.orders.find(query, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
+    if include_archived and len(orders) < limit:
+        if orders:
+            query.update(time_range("created_at", lt=to_datetime(orders[-1]['created_at'])))
+        remaining = limit - len(orders)
+        orders += await db.orders_archive.find(query, {"_id": 0}).sort("created_at", -1).limit(remaining).to_list(remaining)
     return orders
 
+@api_router.get("/orders/{order_id}/events")
+async def order_event_stream(order_id: str, current_user: dict = Depends(get_current_user_for_stream)):
+    """
+    Server-sent events for one order: `status` on every transition and
+    `entitlements` once paid. The stream ends when the order is paid/failed.
+    """
+    query = {"id": order_id, "user_id": current_user['id']}
+    if not await find_order(query, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Order not found")
+    
+    async def stream():
+        # Subscribe before reading the current state so no transition slips between them
+        with order_event_bus.subscribe(order_id) as queue:
+            order = await find_order(query)
+            if order is None:
+                # Expired by its TTL since the check above; there is nothing left to report
+                return
+            for event in order_events(order):
+                yield format_sse(event['event'], event['data'])
+            if order.get('status') in TERMINAL_STATUSES:
+                return
+            
+            deadline = asyncio.get_running_loop().time() + ORDER_EVENTS_TIMEOUT_SECONDS
+            while asyncio.get_running_loop().time() < deadline:
+                try:
+                    event = await asyncio.wait_for(queue.get(), ORDER_EVENTS_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_sse(event['event'], event['data'])
+                # A paid order's last event is its entitlement grant
+                if event['event'] == "entitlements" or event['data'].get('status') == "failed":
+                    return
+    
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def find_order(query: dict, projection: Optional[dict] = None) -> Optional[dict]:
+    """A live order, or its archived copy once archive_orders has moved it."""
+    projection = projection or {"_id": 0}
+    return await db.orders.find_one(query, projection) or await db.orders_archive.find_one(query, projection)
+
 @api_router.get("/orders/{order_id}")
 async def get_order(order_id: str, current_user: dict = Depends(get_current_user)):
-    order = await db.orders.find_one({"id": order_id, "user_id": current_user['id']}, {"_id": 0})
+    order = await find_order({"id": order_id, "user_id": current_user['id']})
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     return order
@@ -506,24 +1339,26 @@ async def get_purchased_products(current_user: dict = Depends(get_current_user))
     if not purchased_ids:
         return []
     
-    products = await db.products.find({"id": {"$in": purchased_ids}}, {"_id": 0}).to_list(1000)
-    return products
+    return await fetch_products_by_ids(purchased_ids)
 
 @api_router.get("/clerk/purchased-products/{clerk_id}")
-async def get_clerk_purchased_products(clerk_id: str):
+async def get_clerk_purchased_products(clerk_id: str, claims: dict = Depends(get_clerk_claims)):
     """
-    Get purchased products for a Clerk user by their clerk_id
+    Get purchased products for the signed-in Clerk user
     """
-    user = await db.users.find_one({"clerk_id": clerk_id}, {"_id": 0})
-    if not user:
+    if clerk_id != claims["sub"]:
+        raise HTTPException(status_code=403, detail="Cannot read another user's purchases")
+    try:
+        current_user = await get_current_clerk_user(claims)
+    except HTTPException:
+        # Signed in with Clerk but not synced to MongoDB yet
         return []
     
-    purchased_ids = user.get('purchased_products', [])
+    purchased_ids = current_user.get('purchased_products', [])
     if not purchased_ids:
         return []
     
-    products = await db.products.find({"id": {"$in": purchased_ids}}, {"_id": 0}).to_list(1000)
-    return products
+    return await fetch_products_by_ids(purchased_ids)
 
 # Admin Routes
 @api_router.post("/admin/upload")
@@ -533,7 +1368,7 @@ async def upload_file(
 ):
     try:
         # Upload to Cloudinary
-        result = cloudinary.uploader.upload(
+        result = await cloudinary_upload(
             file.file,
             folder="ecommerce",
             resource_type="auto"
@@ -542,6 +1377,8 @@ async def upload_file(
             "url": result['secure_url'],
             "public_id": result['public_id']
         }
+    except (HTTPException, DependencyUnavailable):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
@@ -562,18 +1399,15 @@ async def admin_create_product(
         image_url = ""
         download_link = ""
         
+        product_image = None
+        
         # Upload image if provided
         if image:
-            img_result = cloudinary.uploader.upload(
-                image.file,
-                folder="ecommerce/products",
-                resource_type="image"
-            )
-            image_url = img_result['secure_url']
+            image_url, product_image = await upload_product_image(image.file)
         
         # Upload download file if provided
         if download_file:
-            file_result = cloudinary.uploader.upload(
+            file_result = await cloudinary_upload(
                 download_file.file,
                 folder="ecommerce/downloads",
                 resource_type="auto"
@@ -584,13 +1418,7 @@ async def admin_create_product(
         features_list = [f.strip() for f in features.split(',') if f.strip()] if features else []
         
         # Parse video chapters (JSON string)
-        import json
-        video_chapters_list = []
-        if video_chapters:
-            try:
-                video_chapters_list = json.loads(video_chapters)
-            except:
-                pass
+        video_chapters_list = parse_video_chapters(video_chapters) if video_chapters else []
         
         # Create product
         product = Product(
@@ -599,20 +1427,27 @@ async def admin_create_product(
             price=price,
             category=category,
             image_url=image_url,
+            image=product_image,
             download_link=download_link,
             video_url=video_url if video_url else None,
             video_chapters=video_chapters_list,
             features=features_list
         )
         
-        await db.products.insert_one(product.model_dump())
+        await db.products.insert_one(product.model_dump(exclude={"video_chapters"}))
+        await save_product_chapters(product.id, video_chapters_list)
+        catalog_cache.invalidate()
         return product
+    except (HTTPException, DependencyUnavailable):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to create product: {str(e)}")
 
 @api_router.put("/admin/products/{product_id}")
 async def admin_update_product(
     product_id: str,
+    request: Request,
+    response: Response,
     name: Optional[str] = Form(None),
     description: Optional[str] = Form(None),
     price: Optional[float] = Form(None),
@@ -624,10 +1459,17 @@ async def admin_update_product(
     download_file: UploadFile = File(None),
     admin_user: dict = Depends(get_admin_user)
 ):
+    """
+    Partial update in one find_one_and_update. Send the product's ETag as
+    If-Match to get a 412 instead of overwriting someone else's edit.
+    """
     try:
-        product = await db.products.find_one({"id": product_id}, {"_id": 0})
-        if not product:
-            raise HTTPException(status_code=404, detail="Product not found")
+        version = if_match_version(request)
+        precondition = product_precondition(product_id, version)
+        
+        # Check the precondition before spending time on uploads; the write re-checks it atomically
+        if (image or download_file) and not await db.products.find_one(precondition, {"_id": 1}):
+            raise await precondition_failure(product_id, version)
         
         update_data = {}
         
@@ -643,64 +1485,189 @@ async def admin_update_product(
             update_data['features'] = [f.strip() for f in features.split(',') if f.strip()]
         if video_url is not None:
             update_data['video_url'] = video_url if video_url else None
-        if video_chapters:
-            import json
-            try:
-                update_data['video_chapters'] = json.loads(video_chapters)
-            except:
-                pass
+        chapters_update = parse_video_chapters(video_chapters) if video_chapters else None
         
         # Upload new image if provided
         if image:
-            img_result = cloudinary.uploader.upload(
-                image.file,
-                folder="ecommerce/products",
-                resource_type="image"
-            )
-            update_data['image_url'] = img_result['secure_url']
+            image_url, product_image = await upload_product_image(image.file)
+            update_data['image_url'] = image_url
+            update_data['image'] = product_image.model_dump()
         
         # Upload new download file if provided
         if download_file:
-            file_result = cloudinary.uploader.upload(
+            file_result = await cloudinary_upload(
                 download_file.file,
                 folder="ecommerce/downloads",
                 resource_type="auto"
             )
             update_data['download_link'] = file_result['secure_url']
         
+        update = {"$inc": {"version": 1}}
         if update_data:
-            await db.products.update_one(
-                {"id": product_id},
-                {"$set": update_data}
-            )
+            update['$set'] = update_data
+        if chapters_update is not None:
+            update['$unset'] = {"video_chapters": ""}  # chapters move to product_chapters
+        updated_product = await db.products.find_one_and_update(
+            precondition,
+            update,
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if updated_product is None:
+            raise await precondition_failure(product_id, version)
+        catalog_cache.invalidate()
         
-        updated_product = await db.products.find_one({"id": product_id}, {"_id": 0})
+        if chapters_update is not None:
+            await save_product_chapters(product_id, chapters_update, unset_legacy=False)
+            updated_product['video_chapters'] = [chapter.model_dump() for chapter in chapters_update]
+        else:
+            updated_product['video_chapters'] = await load_product_chapters(product_id, updated_product.get('video_chapters'))
+        response.headers["ETag"] = product_etag(updated_product)
         return updated_product
+    except (HTTPException, DependencyUnavailable):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to update product: {str(e)}")
 
+async def transcode_in_subprocess(source: str, work_dir: str, chapter_times: List[float]) -> dict:
+    """
+    Runs the video_hls CLI in its own process group, so cancelling the job
+    (shutdown, worker recycle) kills ffmpeg instead of leaving it running.
+    """
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "video_hls", source, work_dir,
+        "--chapters", ",".join(str(t) for t in chapter_times),
+        cwd=str(ROOT_DIR), stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+        start_new_session=True
+    )
+    try:
+        _, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        os.killpg(process.pid, signal.SIGKILL)
+        raise
+    if process.returncode != 0:
+        raise RuntimeError(f"transcode exited with {process.returncode}: {stderr.decode(errors='replace')[-2000:]}")
+    return json.loads(Path(work_dir, "ladder.json").read_text())
+
+async def process_product_video(video: dict) -> dict:
+    """Transcode a queued upload into a chapter-aligned HLS ladder and publish it to Cloudinary."""
+    product_id = video['product_id']
+    work_dir = tempfile.mkdtemp(prefix="hls-")
+    try:
+        chapters = await load_product_chapters(product_id)
+        ladder = await transcode_in_subprocess(
+            video['job']['source'], work_dir, [chapter['time'] for chapter in chapters]
+        )
+        folder = f"ecommerce/hls/{product_id}/{uuid.uuid4().hex[:8]}"
+        uploads = asyncio.Semaphore(HLS_UPLOAD_CONCURRENCY)
+        
+        async def upload_segment(rendition: str, segment: str):
+            async with uploads:
+                await cloudinary_upload(
+                    os.path.join(work_dir, rendition, segment),
+                    public_id=f"{folder}/{rendition}/{segment}",
+                    resource_type="raw",
+                    type="authenticated"
+                )
+        
+        await asyncio.gather(*(
+            upload_segment(rendition['name'], segment)
+            for rendition in ladder['renditions']
+            for segment in video_hls.playlist_segments(rendition['playlist'])
+        ))
+        return {**ladder, "folder": folder}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+video_jobs = VideoJobRunner(
+    process_product_video,
+    lease_seconds=float(os.environ.get('HLS_JOB_LEASE_SECONDS', 300)),
+    max_attempts=int(os.environ.get('HLS_JOB_MAX_ATTEMPTS', 3))
+)
+
+@api_router.post("/admin/products/{product_id}/video", status_code=202)
+async def admin_upload_product_video(
+    product_id: str,
+    video: UploadFile = File(...),
+    admin_user: dict = Depends(get_admin_user)
+):
+    """
+    Queue an HLS transcode for the video job runners. Segments are aligned
+    to the product's current chapters, so re-upload after changing chapter
+    times. Progress is visible in the job field of GET .../video.
+    """
+    if not CLOUDINARY_AUTH_TOKEN_KEY:
+        raise HTTPException(
+            status_code=503,
+            detail="HLS streaming needs CLOUDINARY_AUTH_TOKEN_KEY (Cloudinary token-based authentication)"
+        )
+    if not await db.products.find_one({"id": product_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Product not found")
+    
+    os.makedirs(HLS_SOURCE_DIR, exist_ok=True)
+    fd, source = tempfile.mkstemp(prefix=f"{product_id}-", suffix=Path(video.filename or "").suffix, dir=HLS_SOURCE_DIR)
+    with os.fdopen(fd, "wb") as out:
+        await asyncio.to_thread(shutil.copyfileobj, video.file, out)
+    job = new_job(source)
+    # Playback keeps using the previous ladder until the new one is ready
+    previous = await db.product_videos.find_one_and_update(
+        {"product_id": product_id},
+        {"$set": {"processing": True, "job": job, "updated_at": datetime.now(timezone.utc)},
+         "$setOnInsert": {"status": "processing"}},
+        projection={"_id": 0, "job": 1},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+    # A replaced job that never started leaves its source behind; a running one cleans up after itself
+    if previous and previous.get('job', {}).get('status') == "queued":
+        remove_source(previous['job'])
+    video_jobs.wake()
+    return {"status": "processing", "job_id": job['id']}
+
+@api_router.get("/admin/products/{product_id}/video")
+async def admin_get_product_video(product_id: str, admin_user: dict = Depends(get_admin_user)):
+    video = await db.product_videos.find_one(
+        {"product_id": product_id}, {"_id": 0, "renditions.playlist": 0}
+    )
+    if not video:
+        raise HTTPException(status_code=404, detail="No video uploaded")
+    return video
+
 @api_router.delete("/admin/products/{product_id}")
 async def admin_delete_product(
     product_id: str,
+    request: Request,
     admin_user: dict = Depends(get_admin_user)
 ):
-    product = await db.products.find_one({"id": product_id})
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
+    version = if_match_version(request)
+    deleted = await db.products.find_one_and_delete(product_precondition(product_id, version), projection={"_id": 1})
+    if deleted is None:
+        raise await precondition_failure(product_id, version)
     
-    await db.products.delete_one({"id": product_id})
+    await db.product_chapters.delete_one({"product_id": product_id})
+    video = await db.product_videos.find_one_and_delete({"product_id": product_id}, projection={"job": 1})
+    if video and video.get('job', {}).get('status') == "queued":
+        remove_source(video['job'])
+    catalog_cache.invalidate()
     return {"message": "Product deleted successfully"}
 
 @api_router.get("/admin/stats")
 async def get_admin_stats(admin_user: dict = Depends(get_admin_user)):
     total_users = await db.users.count_documents({"role": "user"})
     total_products = await db.products.count_documents({})
-    total_orders = await db.orders.count_documents({})
-    paid_orders = await db.orders.count_documents({"status": "paid"})
+    total_orders = 0
+    paid_orders = 0
+    total_revenue = 0
     
-    # Calculate total revenue
-    orders = await db.orders.find({"status": "paid"}, {"_id": 0}).to_list(1000)
-    total_revenue = sum(order.get('total', 0) for order in orders)
+    # Archived orders still count towards the totals
+    for collection in (db.orders, db.orders_archive):
+        total_orders += await collection.count_documents({})
+        paid_orders += await collection.count_documents({"status": "paid"})
+        revenue = await collection.aggregate([
+            {"$match": {"status": "paid"}},
+            {"$group": {"_id": None, "total": {"$sum": "$total"}}}
+        ]).to_list(1)
+        total_revenue += revenue[0]['total'] if revenue else 0
     
     return {
         "total_users": total_users,
@@ -710,20 +1677,131 @@ async def get_admin_stats(admin_user: dict = Depends(get_admin_user)):
         "total_revenue": total_revenue
     }
 
+@api_router.get("/admin/reports")
+async def get_sales_report(
+    group_by: str = "day",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    status: Optional[str] = "paid",
+    admin_user: dict = Depends(get_admin_user)
+):
+    if group_by not in reports.GROUPINGS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of {', '.join(reports.GROUPINGS)}")
+    return await reports.build_report(db, start, end, group_by, status or None)
+
+@api_router.get("/admin/exports/orders")
+async def export_orders(
+    format: str = "csv",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    status: Optional[str] = None,
+    admin_user: dict = Depends(get_admin_user)
+):
+    """One row per order item, streamed batch by batch from live and archived orders."""
+    query = reports.order_query(start, end, status)
+    if format == "csv":
+        body, media_type = reports.stream_orders_csv(db, query), "text/csv"
+    elif format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise HTTPException(status_code=501, detail="Parquet export requires pyarrow")
+        body, media_type = reports.stream_orders_parquet(db, query), "application/vnd.apache.parquet"
+    else:
+        raise HTTPException(status_code=400, detail="format must be csv or parquet")
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="orders.{format}"'}
+    )
+
+@api_router.post("/admin/maintenance/rebuild-recommendations")
+async def admin_rebuild_recommendations(admin_user: dict = Depends(get_admin_user)):
+    try:
+        return await recommendations.rebuild(db)
+    except recommendations.RebuildInProgress as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@api_router.post("/admin/maintenance/archive-orders")
+async def admin_archive_orders(
+    older_than_days: int = ORDER_ARCHIVE_AFTER_DAYS,
+    max_batches: int = 20,
+    admin_user: dict = Depends(get_admin_user)
+):
+    """Runs a bounded archival pass; use `python -m maintenance archive-orders` for a full backlog."""
+    return await archive_orders(db, older_than_days, max_batches=max_batches)
+
+@api_router.get("/admin/profiles")
+async def list_profiles(limit: int = 50, route: Optional[str] = None, admin_user: dict = Depends(get_admin_user)):
+    query = {"route": route} if route else {}
+    profiles = await db.request_profiles.find(query, {"_id": 0, "speedscope": 0}).sort("created_at", -1).to_list(min(limit, 500))
+    return profiles
+
+@api_router.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, format: Optional[str] = None, admin_user: dict = Depends(get_admin_user)):
+    """Returns the stored profile; ?format=speedscope returns a file speedscope.app can open."""
+    profile = await db.request_profiles.find_one({"id": profile_id}, {"_id": 0})
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "speedscope":
+        return profile['speedscope']
+    return profile
+
+@api_router.get("/admin/slow-queries")
+async def get_slow_queries(hours: int = 24, limit: int = 50, admin_user: dict = Depends(get_admin_user)):
+    """Slow commands aggregated by query shape, worst total time first, with the latest explain."""
+    since = datetime.now(timezone.utc) - timedelta(hours=hours)
+    shapes = await db.slow_queries.aggregate([
+        {"$match": {"created_at": {"$gte": since}}},
+        {"$group": {
+            "_id": "$shape_id",
+            "collection": {"$first": "$collection"},
+            "command": {"$first": "$command"},
+            "shape": {"$first": "$shape"},
+            "sort": {"$first": "$sort"},
+            "count": {"$sum": 1},
+            "total_ms": {"$sum": "$duration_ms"},
+            "avg_ms": {"$avg": "$duration_ms"},
+            "max_ms": {"$max": "$duration_ms"},
+            "routes": {"$addToSet": "$route"},
+            "last_seen": {"$max": "$created_at"}
+        }},
+        {"$sort": {"total_ms": -1}},
+        {"$limit": min(limit, 500)}
+    ]).to_list(None)
+    explains = await db.slow_query_explains.find(
+        {"shape_id": {"$in": [shape['_id'] for shape in shapes]}}, {"_id": 0}
+    ).to_list(None)
+    explains_by_shape = {explain['shape_id']: explain for explain in explains}
+    for shape in shapes:
+        shape['shape_id'] = shape.pop('_id')
+        shape['explain'] = explains_by_shape.get(shape['shape_id'])
+    return shapes
+
+@api_router.get("/health/dependencies")
+async def dependency_health():
+    guards = {guard.name: guard.snapshot() for guard in (razorpay_guard, cloudinary_guard)}
+    return {
+        "status": "ok" if all(g['state'] == "closed" for g in guards.values()) else "degraded",
+        "dependencies": guards
+    }
+
+@api_router.get("/admin/metrics")
+async def get_admin_metrics(admin_user: dict = Depends(get_admin_user)):
+    return {"single_flight": single_flight.stats()}
+
 @api_router.post("/admin/distribute-demo-course")
 async def distribute_demo_course(admin_user: dict = Depends(get_admin_user)):
     """Add demo course to all existing users"""
-    demo_course_id = "12e942d3-1091-43f0-b22c-33508096276b"
-    
     # Check if demo course exists
-    demo_course = await db.products.find_one({"id": demo_course_id})
+    demo_course = await db.products.find_one({"id": DEMO_COURSE_ID})
     if not demo_course:
         raise HTTPException(status_code=404, detail="Demo course not found")
     
     # Add to all users who don't already have it
     result = await db.users.update_many(
-        {"purchased_products": {"$ne": demo_course_id}},
-        {"$addToSet": {"purchased_products": demo_course_id}}
+        {"purchased_products": {"$ne": DEMO_COURSE_ID}},
+        {"$addToSet": {"purchased_products": DEMO_COURSE_ID}}
     )
     
     return {
@@ -752,6 +1830,16 @@ async def seed_admin():
 # ✅ Include all routers
 app.include_router(api_router)
 
+@app.exception_handler(DependencyUnavailable)
+async def dependency_unavailable_handler(request: Request, exc: DependencyUnavailable):
+    logger.warning(f"⚠️ {exc}")
+    headers = {"Retry-After": str(max(1, round(exc.retry_after)))} if exc.retry_after else None
+    return JSONResponse(
+        status_code=503,
+        content={"detail": f"{exc.dependency} is temporarily unavailable, please retry shortly"},
+        headers=headers
+    )
+
 # ✅ Safe, flexible CORS handling
 origins_env = os.environ.get("CORS_ORIGINS", "*")
 
@@ -768,19 +1856,132 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# ✅ Simple logging (Vercel captures stdout automatically)
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+# ✅ Opt-in request profiling (admin X-Profile header or PROFILE_SAMPLE_RATE)
+async def store_request_profile(doc: dict):
+    try:
+        await db.request_profiles.insert_one(doc)
+    except Exception as e:
+        logger.error(f"❌ Failed to store request profile: {e}")
+
+app.add_middleware(
+    ProfilingMiddleware,
+    authorize=is_admin_request,
+    store=store_request_profile,
+    sample_rate=float(os.environ.get("PROFILE_SAMPLE_RATE", 0)),
+    interval_ms=float(os.environ.get("PROFILE_INTERVAL_MS", 5))
 )
+
+# ✅ JSON logs via a background queue listener (Vercel captures stdout automatically)
+app.add_middleware(RequestLogMiddleware)
+configure_logging(os.environ.get("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger("server")
 
 logger.info("🚀 FastAPI server initialized successfully")
 
+# ✅ Open MongoDB connections before the first request hits this worker
+@app.on_event("startup")
+async def prewarm_db_client():
+    try:
+        # Concurrent pings each check out their own connection, opening minPoolSize of them now
+        await asyncio.gather(*(client.admin.command("ping") for _ in range(max(MONGO_MIN_POOL_SIZE, 1))))
+        logger.info(f"✅ MongoDB connection pool warmed ({MONGO_MIN_POOL_SIZE} connections).")
+    except Exception as e:
+        logger.warning(f"⚠️ MongoDB not reachable at startup: {e}")
+
+async def ensure_index(collection, keys, **kwargs):
+    """Each index gets its own try, so one failure can't skip the rest."""
+    try:
+        await collection.create_index(keys, **kwargs)
+    except Exception as e:
+        # Typically existing duplicates under a unique index: the constraint is NOT enforced until fixed
+        logger.error(f"❌ Could not create index {keys!r} on {collection.name}: {e}")
+
+# ✅ Indexes (creation is idempotent, so every worker can run this)
+@app.on_event("startup")
+async def ensure_indexes():
+    await ensure_index(
+        db.request_profiles, "created_at",
+        expireAfterSeconds=int(os.environ.get("PROFILE_RETENTION_HOURS", 72)) * 3600
+    )
+    await ensure_index(db.request_profiles, "id", unique=True)
+    await ensure_index(
+        db.slow_queries, "created_at",
+        expireAfterSeconds=int(os.environ.get("SLOW_QUERY_RETENTION_HOURS", 168)) * 3600
+    )
+    await ensure_index(db.slow_query_explains, "shape_id", unique=True)
+    # TTL - expires_at is set per document, so the index itself expires immediately;
+    # documents from before these indexes get theirs from `python -m maintenance migrate-timestamps`
+    await ensure_index(db.carts, "expires_at", expireAfterSeconds=0)
+    await ensure_index(db.orders, "expires_at", expireAfterSeconds=0)
+    await ensure_index(db.orders, [("user_id", 1), ("created_at", -1)])
+    await ensure_index(db.orders, [("status", 1), ("created_at", 1)])
+    # One pending order per checkout key; paid/failed orders drop out of the index
+    await ensure_index(
+        db.orders, [("user_id", 1), ("idempotency_key", 1)],
+        unique=True,
+        partialFilterExpression={"status": "created", "idempotency_key": {"$exists": True}}
+    )
+    await ensure_index(db.orders_archive, "id", unique=True)
+    await ensure_index(db.orders_archive, [("user_id", 1), ("created_at", -1)])
+    await ensure_index(db.product_recommendations, "product_id", unique=True)
+    await ensure_index(db.product_videos, "product_id", unique=True)
+    await ensure_index(db.product_videos, [("job.status", 1), ("job.queued_at", 1)], sparse=True)
+    # Popularity sorts, with and without a category filter
+    for field in SORT_FIELDS.values():
+        await ensure_index(db.products, [(field, -1)])
+        await ensure_index(db.products, [("category", 1), (field, -1)])
+    # Unique clerk_id makes concurrent clerk-sync upserts collapse onto one user;
+    # on an existing database, merge duplicate clerk_id users first or this stays unenforced
+    await ensure_index(
+        db.users, "clerk_id", unique=True, partialFilterExpression={"clerk_id": {"$type": "string"}}
+    )
+    for keys, options in recommendations.PAIR_INDEXES:
+        await ensure_index(db.product_pairs, keys, **options)
+    # Lookups by application id; a no-op when the id is stored as _id
+    for name in uuid_ids.UUID_ID_COLLECTIONS:
+        await ensure_index(db[name], "id", unique=True)
+
+# ✅ Slow-query log flusher
+@app.on_event("startup")
+async def start_slow_query_log():
+    slow_query_log.start(db)
+
+# ✅ Order events bridge (change stream; process-local without a replica set)
+@app.on_event("startup")
+async def start_order_event_bus():
+    order_event_bus.start(db)
+
+# ✅ Warm the Clerk JWKS so the first Clerk request doesn't pay for the fetch
+@app.on_event("startup")
+async def warm_clerk_jwks():
+    if not clerk_jwks.configured:
+        return
+    try:
+        await clerk_jwks.refresh()
+        logger.info("✅ Clerk JWKS loaded")
+    except ClerkTokenError as e:
+        logger.warning(f"⚠️ {e}; will retry on first Clerk request")
+
+# ✅ HLS transcode jobs (run outside requests; resumed after restarts)
+@app.on_event("startup")
+async def start_video_jobs():
+    if not CLOUDINARY_AUTH_TOKEN_KEY:
+        logger.warning("⚠️ CLOUDINARY_AUTH_TOKEN_KEY is not set; course videos play as progressive files only")
+    video_jobs.start(db)
+
+# ✅ Popularity counter flusher
+@app.on_event("startup")
+async def start_product_counters():
+    product_counters.start(db)
+
 # ✅ Graceful shutdown for MongoDB or other clients
 @app.on_event("shutdown")
 async def shutdown_db_client():
     try:
+        await slow_query_log.stop()
+        await order_event_bus.stop()
+        await product_counters.stop()
+        await video_jobs.stop()
         client.close()
         logger.info("✅ MongoDB connection closed successfully.")
     except Exception as e:
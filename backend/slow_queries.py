@@ -0,0 +1,175 @@
+"""
+Slow-query log built on pymongo command monitoring.
+
+Commands slower than the threshold are queued in memory by the listener
+(which runs on Motor's executor threads) and flushed to the slow_queries
+collection by a background task. A sampled subset of read commands is
+re-run with explain("executionStats") and the latest plan per query shape
+is kept in slow_query_explains.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from pymongo import monitoring
+
+from structured_logging import request_context
+
+logger = logging.getLogger("server.slow_queries")
+
+# Command name -> key holding the filter
+FILTER_KEYS = {
+    "find": "filter",
+    "count": "query",
+    "distinct": "query",
+    "findAndModify": "query",
+    "delete": "deletes",
+    "update": "updates",
+    "aggregate": "pipeline",
+}
+EXPLAINABLE = {"find", "count", "distinct", "aggregate"}
+OWN_COLLECTIONS = {"slow_queries", "slow_query_explains"}
+
+
+def normalize_shape(value):
+    """Replace literal values with 1 so queries differing only in values share a shape."""
+    if isinstance(value, dict):
+        return {key: normalize_shape(val) for key, val in sorted(value.items())}
+    if isinstance(value, (list, tuple)):
+        if value and all(isinstance(item, dict) for item in value):
+            return [normalize_shape(item) for item in value]
+        return 1
+    return 1
+
+
+def command_filter(name: str, command: dict):
+    key = FILTER_KEYS.get(name)
+    if key is None:
+        return None
+    value = command.get(key)
+    if name == "aggregate":
+        match = next((stage["$match"] for stage in value or [] if "$match" in stage), {})
+        return match
+    if name in ("update", "delete"):
+        # Bulk writes carry several statements; the first one is representative
+        return (value or [{}])[0].get("q", {})
+    return value or {}
+
+
+class SlowQueryLog(monitoring.CommandListener):
+    def __init__(self, threshold_ms: float = 100.0, explain_rate: float = 0.1,
+                 flush_interval: float = 5.0, max_pending: int = 10000):
+        self.threshold_ms = threshold_ms
+        self.explain_rate = explain_rate
+        self.flush_interval = flush_interval
+        self._started: Dict[tuple, tuple] = {}
+        self._lock = threading.Lock()
+        self._pending: deque = deque(maxlen=max_pending)
+        self._task: Optional[asyncio.Task] = None
+        self._db = None
+
+    # pymongo listener callbacks - keep these cheap, they run for every command
+    def started(self, event):
+        if event.command_name in FILTER_KEYS:
+            with self._lock:
+                self._started[(event.connection_id, event.request_id)] = (
+                    event.command, request_context.get()
+                )
+
+    def succeeded(self, event):
+        with self._lock:
+            started = self._started.pop((event.connection_id, event.request_id), None)
+        duration_ms = event.duration_micros / 1000
+        if started is None or duration_ms < self.threshold_ms:
+            return
+        command, ctx = started
+        collection = command.get(event.command_name)
+        if collection in OWN_COLLECTIONS:
+            return
+        # ctx is the request's mutable log context; it is read at flush time,
+        # after the middleware has replaced the raw path with the route template
+        self._pending.append((event.command_name, event.database_name, collection, command, duration_ms, ctx, time.time()))
+
+    def failed(self, event):
+        with self._lock:
+            self._started.pop((event.connection_id, event.request_id), None)
+
+    # Background flushing
+    def start(self, db):
+        self._db = db
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"❌ Slow query flush failed: {e}")
+
+    async def flush(self):
+        if self._db is None or not self._pending:
+            return
+        records, explains = [], {}
+        while self._pending:
+            name, database, collection, command, duration_ms, ctx, ts = self._pending.popleft()
+            shape = json.dumps(normalize_shape(command_filter(name, command)), sort_keys=True)
+            sort = json.dumps(dict(command["sort"])) if command.get("sort") else None
+            shape_id = hashlib.sha1(f"{collection}|{name}|{shape}|{sort}".encode()).hexdigest()
+            records.append({
+                "shape_id": shape_id,
+                "collection": collection,
+                "command": name,
+                "shape": shape,
+                "sort": sort,
+                "duration_ms": round(duration_ms, 3),
+                "route": (ctx or {}).get("route"),
+                "method": (ctx or {}).get("method"),
+                "created_at": datetime.fromtimestamp(ts, timezone.utc),
+            })
+            if name in EXPLAINABLE and database == self._db.name and random.random() < self.explain_rate:
+                explains[shape_id] = (collection, name, command)
+        await self._db.slow_queries.insert_many(records)
+        for shape_id, (collection, name, command) in explains.items():
+            await self._explain(shape_id, collection, name, command)
+
+    async def _explain(self, shape_id: str, collection: str, name: str, command: dict):
+        # Strip session and cluster-time fields the driver added to the original command
+        replay = {key: val for key, val in command.items() if not key.startswith("$") and key != "lsid"}
+        try:
+            result = await self._db.command({"explain": replay, "verbosity": "executionStats"})
+        except Exception as e:
+            logger.warning(f"⚠️ explain failed for {collection}.{name}: {e}")
+            return
+        stats = result.get("executionStats", {})
+        await self._db.slow_query_explains.update_one(
+            {"shape_id": shape_id},
+            {"$set": {
+                "shape_id": shape_id,
+                "collection": collection,
+                "command": name,
+                "winning_plan": result.get("queryPlanner", {}).get("winningPlan"),
+                "execution_stats": {
+                    "n_returned": stats.get("nReturned"),
+                    "total_keys_examined": stats.get("totalKeysExamined"),
+                    "total_docs_examined": stats.get("totalDocsExamined"),
+                    "execution_time_ms": stats.get("executionTimeMillis"),
+                },
+                "captured_at": datetime.now(timezone.utc),
+            }},
+            upsert=True
+        )
@@ -0,0 +1,172 @@
+"""
+JSON logging that never blocks the event loop.
+
+Records are pushed onto an in-memory queue by a QueueHandler and written to
+stdout by a QueueListener thread. Every record carries the current request
+context (request id, route, user id) and RequestLogMiddleware emits one
+access record per request with its latency. High-volume routes are sampled.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+# The middleware stores a mutable dict here; dependencies running in child
+# tasks (e.g. get_current_user) fill in fields such as user_id.
+request_context: ContextVar[Optional[dict]] = ContextVar("request_context", default=None)
+
+CONTEXT_FIELDS = ("request_id", "method", "route", "user_id")
+RESERVED_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+access_logger = logging.getLogger("server.access")
+
+
+def bind_request_context(**fields):
+    """Attach fields (e.g. user_id) to the current request's log context."""
+    ctx = request_context.get()
+    if ctx is not None:
+        ctx.update(fields)
+
+
+class ContextFilter(logging.Filter):
+    """Copies the request context onto the record in the emitting thread."""
+
+    def filter(self, record):
+        ctx = request_context.get()
+        if ctx:
+            for field in CONTEXT_FIELDS:
+                if field in ctx and not hasattr(record, field):
+                    setattr(record, field, ctx[field])
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of access records for high-volume routes; errors and slow requests always pass."""
+
+    def __init__(self, rates: Dict[str, float], slow_ms: float):
+        super().__init__()
+        self.rates = rates
+        self.slow_ms = slow_ms
+
+    def filter(self, record):
+        if record.name != access_logger.name:
+            return True
+        if getattr(record, "status", 0) >= 500 or getattr(record, "latency_ms", 0) >= self.slow_ms:
+            return True
+        rate = self.rates.get(getattr(record, "route", None))
+        return rate is None or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RESERVED_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def parse_sample_rates(raw: str) -> Dict[str, float]:
+    """Parse "route=rate,route=rate" as used by LOG_SAMPLE_ROUTES."""
+    rates = {}
+    for part in raw.split(","):
+        route, _, rate = part.strip().partition("=")
+        if route and rate:
+            rates[route] = float(rate)
+    return rates
+
+
+def configure_logging(level: str = "INFO") -> Optional[logging.handlers.QueueListener]:
+    """
+    Route the root logger through a queue to a background writer thread.
+
+    LOG_QUEUE=0 writes synchronously instead, for environments that may
+    freeze the process right after a response (e.g. serverless). That is
+    the default on Vercel, which sets VERCEL in every function's environment.
+    """
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    rates = parse_sample_rates(os.environ.get(
+        "LOG_SAMPLE_ROUTES", "/api/products=0.05,/api/products/{product_id}=0.05"
+    ))
+    slow_ms = float(os.environ.get("LOG_SLOW_REQUEST_MS", 1000))
+
+    listener = None
+    if os.environ.get("LOG_QUEUE", "0" if os.environ.get("VERCEL") else "1") != "0":
+        log_queue = queue.SimpleQueue()
+        handler = logging.handlers.QueueHandler(log_queue)
+        listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+    else:
+        handler = stream_handler
+    handler.addFilter(ContextFilter())
+    handler.addFilter(SamplingFilter(rates, slow_ms))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    return listener
+
+
+class RequestLogMiddleware:
+    """Pure ASGI middleware: binds request context and logs one access record per request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        request_id = headers.get(b"x-request-id", b"").decode() or uuid.uuid4().hex
+        ctx = {"request_id": request_id, "method": scope["method"], "route": scope["path"]}
+        token = request_context.set(ctx)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-request-id", request_id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The router stores the matched route in scope; log the template, not the raw path
+            route = scope.get("route")
+            if route is not None:
+                ctx["route"] = getattr(route, "path", ctx["route"])
+            access_logger.info(
+                "request",
+                extra={
+                    "path": scope["path"],
+                    "status": status,
+                    "latency_ms": round((time.perf_counter() - start) * 1000, 2),
+                },
+            )
+            request_context.reset(token)
@@ -0,0 +1,33 @@
+"""
+Timestamp helpers for the move from ISO-8601 strings to native BSON dates.
+
+Documents written before `python -m maintenance migrate-timestamps` keep
+string timestamps until the migration reaches them, so range filters match
+both representations. Once a collection is migrated the string branch of
+the $or matches nothing and costs one empty index scan.
+"""
+from datetime import datetime, timezone
+from typing import Optional, Union
+
+
+def to_datetime(value: Union[str, datetime]) -> datetime:
+    """Aware UTC datetime from a stored timestamp; naive values are taken as UTC."""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def time_range(field: str, gte: Optional[datetime] = None, lt: Optional[datetime] = None) -> dict:
+    """Filter on `field` within [gte, lt) for native dates and legacy ISO strings alike."""
+    native, legacy = {}, {}
+    if gte is not None:
+        native['$gte'] = to_datetime(gte)
+        legacy['$gte'] = native['$gte'].isoformat()
+    if lt is not None:
+        native['$lt'] = to_datetime(lt)
+        legacy['$lt'] = native['$lt'].isoformat()
+    if not native:
+        return {}
+    return {"$or": [{field: native}, {field: legacy}]}
@@ -0,0 +1,403 @@
+"""
+Opt-in storage of the application UUID as the Mongo `_id`.
+
+By default documents carry a string `id` next to Mongo's ObjectId `_id`,
+which costs a second unique index per collection. With MONGO_UUID_IDS=1
+the users, products, carts and orders collections instead store the UUID
+as a binary subtype-4 `_id` and no `id` field. UuidIdCollection maps
+between the two at the driver boundary, so route code keeps filtering on
+and reading `id`:
+
+    {"id": "…"}  ->  {"_id": Binary(…, 4)}   (filters, sorts, inserts, upserts)
+    {"_id": Binary(…, 4)}  ->  {"id": "…"}   (returned documents)
+
+Move existing data with `python -m maintenance migrate-uuid-ids`, and
+compare the layouts with:
+
+    cd backend && python -m uuid_ids --docs 100000
+"""
+import argparse
+import asyncio
+import copy
+import os
+import random
+import statistics
+import time
+import uuid
+from pathlib import Path
+
+from bson.binary import Binary, UuidRepresentation
+
+UUID_ID_COLLECTIONS = ("users", "products", "carts", "orders")
+_QUERY_LIST_OPERATORS = ("$in", "$nin", "$all")
+_UPDATE_ID_OPERATORS = ("$setOnInsert",)
+
+
+def enabled() -> bool:
+    return os.environ.get("MONGO_UUID_IDS", "").lower() in ("1", "true", "yes")
+
+
+def to_bson_id(value):
+    """Binary UUID for UUID-shaped ids; anything else is stored as given."""
+    if isinstance(value, str):
+        try:
+            return Binary.from_uuid(uuid.UUID(value), UuidRepresentation.STANDARD)
+        except ValueError:
+            return value
+    return value
+
+
+def to_app_id(value):
+    """Exact inverse of to_bson_id: the `id` a stored `_id` was made from."""
+    if isinstance(value, Binary) and value.subtype == 4:
+        return str(value.as_uuid(UuidRepresentation.STANDARD))
+    return value
+
+
+def from_bson_id(value):
+    value = to_app_id(value)
+    return value if isinstance(value, str) else str(value)
+
+
+def _map_id_condition(condition):
+    if isinstance(condition, dict) and any(key.startswith("$") for key in condition):
+        return {
+            operator: [to_bson_id(v) for v in operand] if operator in _QUERY_LIST_OPERATORS else to_bson_id(operand)
+            for operator, operand in condition.items()
+        }
+    return to_bson_id(condition)
+
+
+def map_filter(query):
+    if not query:
+        return query
+    mapped = {}
+    for key, value in query.items():
+        if key == "id":
+            mapped["_id"] = _map_id_condition(value)
+        elif key in ("$or", "$and", "$nor"):
+            mapped[key] = [map_filter(clause) for clause in value]
+        else:
+            mapped[key] = value
+    return mapped
+
+
+def map_document(document: dict) -> dict:
+    """Application document -> stored document."""
+    if "id" not in document:
+        return document
+    stored = {key: value for key, value in document.items() if key not in ("id", "_id")}
+    return {"_id": to_bson_id(document["id"]), **stored}
+
+
+def map_update(update):
+    if not isinstance(update, dict):
+        return update  # aggregation pipeline updates pass through
+    mapped = dict(update)
+    for operator in _UPDATE_ID_OPERATORS:
+        if operator in mapped and "id" in mapped[operator]:
+            mapped[operator] = map_document(mapped[operator])
+    return mapped
+
+
+def map_projection(projection):
+    """
+    Returns (stored projection, whether the caller wants `id`, whether it asked for `_id`).
+
+    `_id` always has to be read since it *is* the id; it is only handed back
+    as-is when the caller explicitly projected it.
+    """
+    if projection is None:
+        return None, True, False
+    fields = dict.fromkeys(projection, 1) if isinstance(projection, (list, tuple)) else dict(projection)
+    keep_raw = bool(fields.pop("_id", 0))
+    want_id = fields.pop("id", None)
+    inclusive = any(value for value in fields.values())
+    if want_id is None:
+        want_id = not inclusive
+    if not fields:
+        return ({"_id": 1} if keep_raw else None), bool(want_id), keep_raw
+    if inclusive:
+        fields["_id"] = 1
+    return fields, bool(want_id), keep_raw
+
+
+def map_result(document, want_id: bool = True, keep_raw: bool = False):
+    if document is None or "_id" not in document:
+        return document
+    raw = document["_id"] if keep_raw else document.pop("_id")
+    if want_id:
+        document["id"] = from_bson_id(raw)
+    return document
+
+
+def map_sort(keys):
+    if isinstance(keys, str):
+        return "_id" if keys == "id" else keys
+    return [("_id" if key == "id" else key, direction) for key, direction in keys]
+
+
+def _projection_args(args, kwargs):
+    """Pull the projection out of find()/find_one() style arguments."""
+    args = list(args)
+    if args:
+        projection = args.pop(0)
+    else:
+        projection = kwargs.pop("projection", None)
+    return args, projection
+
+
+class _MappedCursor:
+    def __init__(self, cursor, want_id: bool, keep_raw: bool):
+        self._cursor = cursor
+        self._want_id = want_id
+        self._keep_raw = keep_raw
+
+    def sort(self, key_or_list, direction=None):
+        if direction is None:
+            self._cursor = self._cursor.sort(map_sort(key_or_list))
+        else:
+            self._cursor = self._cursor.sort(map_sort(key_or_list), direction)
+        return self
+
+    def limit(self, limit):
+        self._cursor = self._cursor.limit(limit)
+        return self
+
+    def skip(self, skip):
+        self._cursor = self._cursor.skip(skip)
+        return self
+
+    def batch_size(self, batch_size):
+        self._cursor = self._cursor.batch_size(batch_size)
+        return self
+
+    async def to_list(self, length=None):
+        return [map_result(doc, self._want_id, self._keep_raw) for doc in await self._cursor.to_list(length)]
+
+    def __aiter__(self):
+        self._iterator = self._cursor.__aiter__()
+        return self
+
+    async def __anext__(self):
+        return map_result(await self._iterator.__anext__(), self._want_id, self._keep_raw)
+
+
+class _MappedChangeStream:
+    def __init__(self, stream_manager):
+        self._manager = stream_manager
+        self._stream = None
+
+    async def __aenter__(self):
+        self._stream = await self._manager.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc):
+        return await self._manager.__aexit__(*exc)
+
+    @property
+    def resume_token(self):
+        return self._stream.resume_token
+
+    def __aiter__(self):
+        self._iterator = self._stream.__aiter__()
+        return self
+
+    async def __anext__(self):
+        change = await self._iterator.__anext__()
+        if change.get("fullDocument"):
+            change["fullDocument"] = map_result(change["fullDocument"])
+        return change
+
+
+class UuidIdCollection:
+    """Motor collection proxy that stores `id` as a binary UUID `_id`."""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    # Reads
+    async def find_one(self, filter=None, *args, **kwargs):
+        args, projection = _projection_args(args, kwargs)
+        stored, want_id, keep_raw = map_projection(projection)
+        document = await self._collection.find_one(map_filter(filter), stored, *args, **kwargs)
+        return map_result(document, want_id, keep_raw)
+
+    def find(self, filter=None, *args, **kwargs):
+        args, projection = _projection_args(args, kwargs)
+        stored, want_id, keep_raw = map_projection(projection)
+        return _MappedCursor(self._collection.find(map_filter(filter), stored, *args, **kwargs), want_id, keep_raw)
+
+    async def count_documents(self, filter, *args, **kwargs):
+        return await self._collection.count_documents(map_filter(filter), *args, **kwargs)
+
+    # Writes
+    async def insert_one(self, document, *args, **kwargs):
+        return await self._collection.insert_one(map_document(document), *args, **kwargs)
+
+    async def insert_many(self, documents, *args, **kwargs):
+        return await self._collection.insert_many([map_document(d) for d in documents], *args, **kwargs)
+
+    async def replace_one(self, filter, replacement, *args, **kwargs):
+        return await self._collection.replace_one(map_filter(filter), map_document(replacement), *args, **kwargs)
+
+    async def update_one(self, filter, update, *args, **kwargs):
+        return await self._collection.update_one(map_filter(filter), map_update(update), *args, **kwargs)
+
+    async def update_many(self, filter, update, *args, **kwargs):
+        return await self._collection.update_many(map_filter(filter), map_update(update), *args, **kwargs)
+
+    async def delete_one(self, filter, *args, **kwargs):
+        return await self._collection.delete_one(map_filter(filter), *args, **kwargs)
+
+    async def delete_many(self, filter, *args, **kwargs):
+        return await self._collection.delete_many(map_filter(filter), *args, **kwargs)
+
+    async def find_one_and_update(self, filter, update, projection=None, **kwargs):
+        stored, want_id, keep_raw = map_projection(projection)
+        if "sort" in kwargs and kwargs["sort"] is not None:
+            kwargs["sort"] = map_sort(kwargs["sort"])
+        document = await self._collection.find_one_and_update(
+            map_filter(filter), map_update(update), projection=stored, **kwargs
+        )
+        return map_result(document, want_id, keep_raw)
+
+    async def find_one_and_replace(self, filter, replacement, projection=None, **kwargs):
+        stored, want_id, keep_raw = map_projection(projection)
+        document = await self._collection.find_one_and_replace(
+            map_filter(filter), map_document(replacement), projection=stored, **kwargs
+        )
+        return map_result(document, want_id, keep_raw)
+
+    async def find_one_and_delete(self, filter, projection=None, **kwargs):
+        stored, want_id, keep_raw = map_projection(projection)
+        document = await self._collection.find_one_and_delete(map_filter(filter), projection=stored, **kwargs)
+        return map_result(document, want_id, keep_raw)
+
+    async def bulk_write(self, requests, *args, **kwargs):
+        mapped = []
+        for request in requests:
+            # pymongo's write models keep their arguments in these private attributes
+            request = copy.copy(request)
+            if getattr(request, "_filter", None) is not None:
+                request._filter = map_filter(request._filter)
+            if getattr(request, "_doc", None) is not None:
+                request._doc = map_update(request._doc) if type(request).__name__.startswith("Update") \
+                    else map_document(request._doc)
+            mapped.append(request)
+        return await self._collection.bulk_write(mapped, *args, **kwargs)
+
+    async def create_index(self, keys, **kwargs):
+        # `_id` is already the unique id index
+        if keys == "id" or keys == [("id", 1)]:
+            return "_id_"
+        return await self._collection.create_index(keys, **kwargs)
+
+    def watch(self, *args, **kwargs):
+        return _MappedChangeStream(self._collection.watch(*args, **kwargs))
+
+
+class UuidIdDatabase:
+    """Database proxy handing out UuidIdCollection for UUID_ID_COLLECTIONS."""
+
+    def __init__(self, database, collections=UUID_ID_COLLECTIONS):
+        self._database = database
+        self._collections = {name: UuidIdCollection(database[name]) for name in collections}
+
+    def __getattr__(self, name):
+        if name in self._collections:
+            return self._collections[name]
+        return getattr(self._database, name)
+
+    def __getitem__(self, name):
+        return self._collections.get(name) or self._database[name]
+
+
+def open_database(client, name: str):
+    database = client[name]
+    return UuidIdDatabase(database) if enabled() else database
+
+
+# Benchmark
+def _sample_document(index: int) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": str(uuid.uuid4()),
+        "status": "paid",
+        "total": float(index % 5000),
+        "items": [{"product_id": str(uuid.uuid4()), "name": f"Product {index % 100}", "price": 499.0, "quantity": 1}],
+    }
+
+
+async def _load(collection, documents, batch: int = 5000):
+    for start in range(0, len(documents), batch):
+        await collection.insert_many([dict(d) for d in documents[start:start + batch]])
+
+
+async def _lookup_latencies(find_by_id, ids, samples: int):
+    latencies = []
+    for document_id in random.sample(ids, min(samples, len(ids))):
+        started = time.perf_counter()
+        await find_by_id(document_id)
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    return {
+        "p50_ms": round(statistics.median(latencies), 3),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1], 3),
+    }
+
+
+async def benchmark(db, docs: int, samples: int) -> dict:
+    documents = [_sample_document(i) for i in range(docs)]
+    ids = [d["id"] for d in documents]
+    string_ids, binary_ids = db["bench_string_ids"], db["bench_uuid_ids"]
+    await string_ids.drop()
+    await binary_ids.drop()
+    try:
+        await string_ids.create_index("id", unique=True)
+        await _load(string_ids, documents)
+        await _load(UuidIdCollection(binary_ids), documents)
+        results = {}
+        for label, collection, find_by_id in (
+            ("string id + ObjectId _id", string_ids, lambda i: string_ids.find_one({"id": i}, {"_id": 0})),
+            ("binary UUID _id", binary_ids, lambda i: UuidIdCollection(binary_ids).find_one({"id": i})),
+        ):
+            stats = await db.command("collStats", collection.name)
+            results[label] = {
+                "data_mb": round(stats["size"] / 2**20, 2),
+                "index_mb": round(stats["totalIndexSize"] / 2**20, 2),
+                "indexes": stats["nindexes"],
+                **await _lookup_latencies(find_by_id, ids, samples),
+            }
+        return results
+    finally:
+        await string_ids.drop()
+        await binary_ids.drop()
+
+
+def main(argv=None):
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Compare string-id and binary-UUID _id layouts")
+    parser.add_argument("--docs", type=int, default=100_000)
+    parser.add_argument("--samples", type=int, default=2000)
+    args = parser.parse_args(argv)
+    load_dotenv(Path(__file__).parent / ".env")
+
+    async def run():
+        client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+        try:
+            return await benchmark(client[os.environ["DB_NAME"]], args.docs, args.samples)
+        finally:
+            client.close()
+
+    for label, result in asyncio.run(run()).items():
+        print(f"{label:26} {result}")
+
+
+if __name__ == "__main__":
+    main()
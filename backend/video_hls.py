@@ -0,0 +1,201 @@
+"""
+HLS ladders for course videos.
+
+Admin uploads are transcoded with ffmpeg into several H.264 renditions.
+Keyframes are forced at every chapter start and evenly in between, and
+the muxer cuts a segment at each of them, so a chapter seek always lands
+on a segment boundary instead of mid-segment. Playlists are served by the
+API with HMAC-signed, expiring URLs (see sign_path/verify_path); the
+segments themselves live in Cloudinary as authenticated raw files and are
+listed with CDN token URLs that expire together with the playlist, which
+needs Cloudinary token-based authentication (CLOUDINARY_AUTH_TOKEN_KEY).
+
+The transcode step needs only ffmpeg/ffprobe on PATH and can be run
+offline:
+
+    cd backend && python -m video_hls lesson.mp4 out/ --chapters 0,95.5,310
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import subprocess
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional
+
+SEGMENT_SECONDS = 6.0
+# Boundaries closer than this are merged; it is also the muxer's hls_time
+MIN_SEGMENT_SECONDS = 1.0
+TRANSCODE_TIMEOUT_SECONDS = int(os.environ.get("HLS_TRANSCODE_TIMEOUT_SECONDS", 3600))
+
+
+@dataclass
+class Rendition:
+    name: str
+    height: int
+    video_kbps: int
+    audio_kbps: int
+
+
+RENDITIONS = [
+    Rendition("1080p", 1080, 5000, 192),
+    Rendition("720p", 720, 2800, 128),
+    Rendition("480p", 480, 1400, 96),
+    Rendition("360p", 360, 800, 64),
+]
+
+
+def segment_boundaries(duration: float, chapter_times: Iterable[float],
+                       target: float = SEGMENT_SECONDS, minimum: float = MIN_SEGMENT_SECONDS) -> List[float]:
+    """Segment start times: every chapter start, with each chapter split into ~target-second pieces."""
+    starts = [0.0] + sorted({round(t, 3) for t in chapter_times if minimum <= t <= duration - minimum})
+    boundaries = []
+    for start, stop in zip(starts, starts[1:] + [duration]):
+        pieces = max(1, round((stop - start) / target))
+        step = (stop - start) / pieces
+        boundaries.extend(round(start + i * step, 3) for i in range(pieces))
+    merged = []
+    for boundary in boundaries:
+        if not merged or boundary - merged[-1] >= minimum:
+            merged.append(boundary)
+    return merged
+
+
+def probe(source: str) -> dict:
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", source],
+        capture_output=True, check=True, text=True
+    )
+    info = json.loads(result.stdout)
+    video = next(s for s in info["streams"] if s.get("codec_type") == "video")
+    return {
+        "duration": float(info["format"]["duration"]),
+        "height": int(video["height"]),
+        "has_audio": any(s.get("codec_type") == "audio" for s in info["streams"]),
+    }
+
+
+def ladder_for(source_height: int, renditions: List[Rendition] = RENDITIONS) -> List[Rendition]:
+    """Renditions no taller than the source; never upscale, but always keep the smallest."""
+    ladder = [r for r in renditions if r.height <= source_height]
+    return ladder or [min(renditions, key=lambda r: r.height)]
+
+
+def ffmpeg_command(source: str, output_dir: str, boundaries: List[float],
+                   ladder: List[Rendition], has_audio: bool) -> List[str]:
+    labels = [f"v{i}" for i in range(len(ladder))]
+    filters = [f"[0:v]split={len(ladder)}" + "".join(f"[{label}]" for label in labels)]
+    filters += [f"[{label}]scale=-2:{r.height}[{label}out]" for label, r in zip(labels, ladder)]
+    command = ["ffmpeg", "-y", "-v", "error", "-i", source, "-filter_complex", ";".join(filters)]
+    stream_map = []
+    for i, (label, r) in enumerate(zip(labels, ladder)):
+        command += [
+            "-map", f"[{label}out]", f"-c:v:{i}", "libx264", f"-b:v:{i}", f"{r.video_kbps}k",
+            f"-maxrate:v:{i}", f"{int(r.video_kbps * 1.07)}k", f"-bufsize:v:{i}", f"{r.video_kbps * 2}k",
+        ]
+        if has_audio:
+            command += ["-map", "a:0", f"-c:a:{i}", "aac", f"-b:a:{i}", f"{r.audio_kbps}k"]
+        stream_map.append(f"v:{i},a:{i},name:{r.name}" if has_audio else f"v:{i},name:{r.name}")
+    if has_audio:
+        command += ["-ac", "2"]
+    command += [
+        "-preset", "veryfast", "-profile:v", "main",
+        # Keyframes only where we want segments to start
+        "-force_key_frames", ",".join(f"{b:.3f}" for b in boundaries),
+        "-g", "100000", "-keyint_min", "100000", "-sc_threshold", "0",
+        "-f", "hls", "-hls_time", str(MIN_SEGMENT_SECONDS), "-hls_playlist_type", "vod",
+        "-hls_flags", "independent_segments",
+        "-hls_segment_filename", os.path.join(output_dir, "%v", "segment_%05d.ts"),
+        "-master_pl_name", "master.m3u8",
+        "-var_stream_map", " ".join(stream_map),
+        os.path.join(output_dir, "%v", "index.m3u8"),
+    ]
+    return command
+
+
+def transcode(source: str, output_dir: str, chapter_times: Iterable[float],
+              renditions: List[Rendition] = RENDITIONS) -> dict:
+    """Runs ffmpeg and returns the ladder description stored in product_videos."""
+    info = probe(source)
+    ladder = ladder_for(info["height"], renditions)
+    boundaries = segment_boundaries(info["duration"], chapter_times)
+    subprocess.run(
+        ffmpeg_command(source, output_dir, boundaries, ladder, info["has_audio"]),
+        check=True, capture_output=True, timeout=TRANSCODE_TIMEOUT_SECONDS
+    )
+    return {
+        "duration": info["duration"],
+        "boundaries": boundaries,
+        "renditions": [
+            {
+                **asdict(r),
+                "bandwidth": (r.video_kbps + (r.audio_kbps if info["has_audio"] else 0)) * 1000,
+                "playlist": (Path(output_dir) / r.name / "index.m3u8").read_text(),
+            }
+            for r in ladder
+        ],
+    }
+
+
+def playlist_segments(playlist: str) -> List[str]:
+    return [line.strip() for line in playlist.splitlines() if line.strip() and not line.startswith("#")]
+
+
+def master_playlist(renditions: List[dict], variant_uri: Callable[[str], str]) -> str:
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-INDEPENDENT-SEGMENTS"]
+    for r in sorted(renditions, key=lambda r: r["bandwidth"], reverse=True):
+        width = round(r["height"] * 16 / 9 / 2) * 2
+        lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={r['bandwidth']},RESOLUTION={width}x{r['height']}")
+        lines.append(variant_uri(r["name"]))
+    return "\n".join(lines) + "\n"
+
+
+def media_playlist(playlist: str, segment_uri: Callable[[str], str]) -> str:
+    """Rewrites each segment line of a stored playlist to a deliverable URL."""
+    return "\n".join(
+        segment_uri(line.strip()) if line.strip() and not line.startswith("#") else line
+        for line in playlist.splitlines()
+    ) + "\n"
+
+
+# Signed playlist URLs
+def _signature(secret: str, path: str, expires: int) -> str:
+    digest = hmac.new(secret.encode(), f"{path}:{expires}".encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:18]).decode()
+
+
+def signed_query(secret: str, path: str, expires: int) -> str:
+    return f"exp={expires}&sig={_signature(secret, path, expires)}"
+
+
+def sign_path(secret: str, path: str, ttl_seconds: int, now: Optional[float] = None) -> str:
+    expires = int((now or time.time()) + ttl_seconds)
+    return f"{path}?{signed_query(secret, path, expires)}"
+
+
+def verify_path(secret: str, path: str, expires: int, signature: str, now: Optional[float] = None) -> bool:
+    if expires < (now or time.time()):
+        return False
+    return hmac.compare_digest(signature, _signature(secret, path, expires))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Transcode a video into a chapter-aligned HLS ladder")
+    parser.add_argument("source")
+    parser.add_argument("output_dir")
+    parser.add_argument("--chapters", default="", help="comma-separated chapter start times in seconds")
+    args = parser.parse_args(argv)
+    chapter_times = [float(t) for t in args.chapters.split(",") if t.strip()]
+    result = transcode(args.source, args.output_dir, chapter_times)
+    Path(args.output_dir, "ladder.json").write_text(json.dumps(result, indent=2))
+    for r in result["renditions"]:
+        print(f"{r['name']:>6} {r['bandwidth'] // 1000:>5} kbps {len(playlist_segments(r['playlist']))} segments")
+    print(f"segment starts: {result['boundaries']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Durable queue for HLS transcodes.
+
+An upload records a job on its product_videos document (job.status
+"queued") and every API worker runs a VideoJobRunner that picks jobs up
+outside any request. A job is claimed with one find_one_and_update and held
+under a lease that is renewed while it runs. If the worker dies or is
+recycled the lease runs out and another worker (or the same one after a
+restart) starts the job again from the stored source file; a graceful
+shutdown hands the job back straight away. After `max_attempts` the video
+is marked failed.
+
+The source file must be readable by every worker, so HLS_SOURCE_DIR has to
+be a shared volume when workers run on several hosts.
+"""
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Optional
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger("server.video_jobs")
+
+
+def new_job(source: str) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "status": "queued",
+        "source": source,
+        "attempts": 0,
+        "queued_at": datetime.now(timezone.utc),
+    }
+
+
+def remove_source(job: Optional[dict]):
+    if job and job.get("source"):
+        try:
+            os.remove(job["source"])
+        except FileNotFoundError:
+            pass
+
+
+class VideoJobRunner:
+    def __init__(self, process: Callable[[dict], Awaitable[dict]], lease_seconds: float = 300.0,
+                 poll_interval: float = 30.0, max_attempts: int = 3):
+        # process(video) transcodes and publishes, returning the fields to $set on success
+        self.process = process
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._db = None
+
+    def start(self, db):
+        self._db = db
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                while await self.run_next():
+                    pass
+            except Exception as e:
+                logger.error(f"❌ Video job runner error: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def _lease(self) -> datetime:
+        return datetime.now(timezone.utc) + timedelta(seconds=self.lease_seconds)
+
+    async def claim(self) -> Optional[dict]:
+        """Oldest queued job, or a running one whose worker stopped renewing its lease."""
+        return await self._db.product_videos.find_one_and_update(
+            {"$or": [
+                {"job.status": "queued"},
+                {"job.status": "running", "job.lease_until": {"$lte": datetime.now(timezone.utc)}},
+            ]},
+            {"$set": {"job.status": "running", "job.worker": self.worker_id, "job.lease_until": self._lease()},
+             "$inc": {"job.attempts": 1}},
+            sort=[("job.queued_at", 1)],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _heartbeat(self, product_id: str, job_id: str):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            await self._db.product_videos.update_one(
+                {"product_id": product_id, "job.id": job_id}, {"$set": {"job.lease_until": self._lease()}}
+            )
+
+    async def run_next(self) -> bool:
+        video = await self.claim()
+        if video is None:
+            return False
+        product_id, job = video["product_id"], video["job"]
+        # Updates only land while this job is still current; a newer upload replaces it
+        current = {"product_id": product_id, "job.id": job["id"]}
+        now = datetime.now(timezone.utc)
+        if job["attempts"] > self.max_attempts:
+            await self._fail(current, job, f"gave up after {self.max_attempts} attempts")
+            return True
+        heartbeat = asyncio.ensure_future(self._heartbeat(product_id, job["id"]))
+        try:
+            fields = await self.process(video)
+        except asyncio.CancelledError:
+            # Shutting down: hand the job back without spending an attempt
+            await self._db.product_videos.update_one(
+                current, {"$set": {"job.status": "queued"}, "$inc": {"job.attempts": -1}}
+            )
+            raise
+        except Exception as e:
+            logger.error(f"❌ HLS transcode failed for product {product_id} (attempt {job['attempts']}): {e}")
+            if job["attempts"] >= self.max_attempts:
+                await self._fail(current, job, str(e))
+            else:
+                await self._db.product_videos.update_one(
+                    current, {"$set": {"job.status": "queued", "job.error": str(e), "updated_at": now}}
+                )
+            return True
+        finally:
+            heartbeat.cancel()
+        await self._db.product_videos.update_one(
+            current,
+            {"$set": {**fields, "status": "ready", "processing": False, "error": None,
+                      "updated_at": datetime.now(timezone.utc)},
+             "$unset": {"job": ""}}
+        )
+        remove_source(job)
+        logger.info(f"✅ HLS ladder ready for product {product_id}")
+        return True
+
+    async def _fail(self, current: dict, job: dict, error: str):
+        await self._db.product_videos.update_one(
+            current,
+            {"$set": {"processing": False, "error": error, "updated_at": datetime.now(timezone.utc)},
+             "$unset": {"job": ""}}
+        )
+        # A previously published ladder stays playable
+        await self._db.product_videos.update_one(
+            {"product_id": current["product_id"], "status": {"$ne": "ready"}}, {"$set": {"status": "failed"}}
+        )
+        remove_source(job)
@@ -1,6 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import { BrowserRouter, Routes, Route, Link, useNavigate, useParams } from 'react-router-dom';
-import { ClerkProvider, SignIn, SignUp, UserButton, useUser, SignedIn, SignedOut } from '@clerk/clerk-react';
+import { ClerkProvider, SignIn, SignUp, UserButton, useAuth, useUser, SignedIn, SignedOut } from '@clerk/clerk-react';
 import axios from 'axios';
 import { motion, useScroll, useTransform } from 'framer-motion';
 import { Button } from '@/components/ui/button';
@@ -19,6 +19,34 @@ const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 const CLERK_PUBLISHABLE_KEY = process.env.REACT_APP_PUBLISHABLE_KEY || 'pk_test_aGVyb2ljLW1hc3RpZmYtODcuY2xlcmsuYWNjb3VudHMuZGV2JA';
 
+// Signed-in users (our JWT or a Clerk session) use /cart; visitors keep a signed guest
+// cart token that the API merges into their real cart at sign-in and checkout
+const GUEST_CART_KEY = 'guest_cart';
+
+const guestCartHeaders = () => {
+  const guestCart = localStorage.getItem(GUEST_CART_KEY);
+  return guestCart ? { 'X-Guest-Cart': guestCart } : {};
+};
+
+const cartRequest = async (authToken, method, path = '', data) => {
+  const response = await axios({
+    method,
+    url: authToken ? `${API}/cart${path}` : `${API}/cart/guest${path}`,
+    data,
+    headers: authToken ? { Authorization: `Bearer ${authToken}` } : guestCartHeaders()
+  });
+  if (!authToken) {
+    localStorage.setItem(GUEST_CART_KEY, response.data.guest_cart);
+  }
+  return response.data;
+};
+
+// Bearer token for API calls: the Clerk session when signed in with Clerk, else our own JWT
+const useApiToken = (token) => {
+  const { getToken, isSignedIn } = useAuth();
+  return async () => (isSignedIn ? await getToken() : token) || null;
+};
+
 const App = () => {
   return (
     <ClerkProvider 
@@ -35,6 +63,7 @@ const AppContent = () => {
   const [user, setUser] = useState(null);
   const { toast } = useToast();
   const { user: clerkUser, isLoaded } = useUser();
+  const { getToken } = useAuth();
   const [clerkSynced, setClerkSynced] = useState(false);
 
   useEffect(() => {
@@ -53,7 +82,10 @@ const AppContent = () => {
             email: clerkUser.primaryEmailAddress?.emailAddress,
             name: clerkUser.fullName || clerkUser.firstName || 'User',
             profile_image_url: clerkUser.imageUrl
+          }, {
+            headers: { Authorization: `Bearer ${await getToken()}`, ...guestCartHeaders() }
           });
+          localStorage.removeItem(GUEST_CART_KEY);
           console.log('Clerk user synced to MongoDB:', response.data);
           setClerkSynced(true);
         } catch (error) {
@@ -342,7 +374,13 @@ const AuthPage = ({ setToken, toast }) => {
     e.preventDefault();
     try {
       const endpoint = isLogin ? '/auth/login' : '/auth/register';
-      const response = await axios.post(`${API}${endpoint}`, formData);
+      const response = await axios.post(`${API}${endpoint}`, formData, { headers: guestCartHeaders() });
+      if (!isLogin && localStorage.getItem(GUEST_CART_KEY)) {
+        await axios.post(`${API}/cart/merge`, {}, {
+          headers: { Authorization: `Bearer ${response.data.token}`, ...guestCartHeaders() }
+        });
+      }
+      localStorage.removeItem(GUEST_CART_KEY);
       localStorage.setItem('token', response.data.token);
       setToken(response.data.token);
       toast({ title: isLogin ? 'Login successful!' : 'Account created!' });
@@ -418,21 +456,39 @@ const AuthPage = ({ setToken, toast }) => {
   );
 };
 
+// Responsive product image; `size` picks the derivative used where srcset is unsupported
+const ProductPicture = ({ product, size, sizes, className, loading }) => {
+  const image = product.image;
+  if (!image) {
+    return <img src={product.image_url} alt={product.name} loading={loading} className={className} />;
+  }
+  return (
+    <picture>
+      <source type="image/avif" srcSet={image.srcset.avif} sizes={sizes} />
+      <source type="image/webp" srcSet={image.srcset.webp} sizes={sizes} />
+      <img
+        src={image.sizes?.[size]?.jpg || product.image_url}
+        srcSet={image.srcset.jpg}
+        sizes={sizes}
+        alt={product.name}
+        loading={loading}
+        style={{ backgroundImage: `url("${image.placeholder}")`, backgroundSize: 'cover' }}
+        className={className}
+      />
+    </picture>
+  );
+};
+
 const ProductsPage = ({ clerkUser, user, token, toast }) => {
   const [products, setProducts] = useState([]);
   const [category, setCategory] = useState('all');
   const [cart, setCart] = useState([]);
   const navigate = useNavigate();
-
-  // Get authentication - prioritize Clerk for regular users
-  const isAuthenticated = clerkUser || (user && token);
-  const userEmail = clerkUser?.primaryEmailAddress?.emailAddress || user?.email;
+  const apiToken = useApiToken(token);
 
   useEffect(() => {
     fetchProducts();
-    if (isAuthenticated) {
-      fetchCart();
-    }
+    fetchCart();
   }, [category, clerkUser, token]);
 
   const fetchProducts = async () => {
@@ -447,63 +503,28 @@ const ProductsPage = ({ clerkUser, user, token, toast }) => {
 
   const fetchCart = async () => {
     try {
-      // For Clerk users, use email-based cart (we'll store in localStorage temporarily)
-      if (clerkUser) {
-        const clerkCart = JSON.parse(localStorage.getItem(`clerk_cart_${clerkUser.id}`) || '[]');
-        setCart(clerkCart);
-      } else if (token) {
-        const response = await axios.get(`${API}/cart`, {
-          headers: { Authorization: `Bearer ${token}` }
-        });
-        setCart(response.data.items || []);
-      }
+      const data = await cartRequest(await apiToken(), 'get');
+      setCart(data.items || []);
     } catch (error) {
       console.error('Error fetching cart:', error);
     }
   };
 
-  const isInCart = (productId) => {
-    if (clerkUser) {
-      return cart.some(item => item.id === productId);
-    }
-    return cart.some(item => item.product?.id === productId);
-  };
+  const isInCart = (productId) => cart.some(item => item.product?.id === productId);
 
   const addToCart = async (productId) => {
-    if (!isAuthenticated) {
-      sonnerToast.error('Please sign in first');
-      navigate('/signin');
-      return;
-    }
-
     if (isInCart(productId)) {
       sonnerToast.info('Product already in cart');
       return;
     }
 
     try {
-      if (clerkUser) {
-        // For Clerk users, use localStorage cart
-        const product = products.find(p => p.id === productId);
-        const newCart = [...cart, { ...product, quantity: 1 }];
-        localStorage.setItem(`clerk_cart_${clerkUser.id}`, JSON.stringify(newCart));
-        setCart(newCart);
-        sonnerToast.success('Added to cart! 🎉', {
-          description: 'Product has been added to your cart',
-          duration: 2000,
-        });
-      } else if (token) {
-        await axios.post(
-          `${API}/cart/add`,
-          { product_id: productId, quantity: 1 },
-          { headers: { Authorization: `Bearer ${token}` } }
-        );
-        sonnerToast.success('Added to cart! 🎉', {
-          description: 'Product has been added to your cart',
-          duration: 2000,
-        });
-        fetchCart();
-      }
+      await cartRequest(await apiToken(), 'post', '/add', { product_id: productId, quantity: 1 });
+      sonnerToast.success('Added to cart! 🎉', {
+        description: 'Product has been added to your cart',
+        duration: 2000,
+      });
+      fetchCart();
     } catch (error) {
       if (error.response?.status === 400) {
         sonnerToast.info('Product already in cart');
@@ -543,9 +564,11 @@ const ProductsPage = ({ clerkUser, user, token, toast }) => {
           >
             <Card className="h-full flex flex-col">
               <div className="relative">
-                <img
-                  src={product.image_url}
-                  alt={product.name}
+                <ProductPicture
+                  product={product}
+                  size="card"
+                  sizes="(min-width: 768px) 33vw, 100vw"
+                  loading="lazy"
                   className="w-full h-48 object-cover rounded-t-lg"
                 />
                 {product.category === 'course' && (
@@ -604,17 +627,34 @@ const ProductDetailPage = ({ clerkUser, user, token, toast }) => {
   const { id } = useParams();
   const [product, setProduct] = useState(null);
   const [isInCart, setIsInCart] = useState(false);
+  const [hlsUrl, setHlsUrl] = useState(null);
   const navigate = useNavigate();
-
-  const isAuthenticated = clerkUser || (user && token);
+  const apiToken = useApiToken(token);
 
   useEffect(() => {
     fetchProduct();
-    if (isAuthenticated) {
-      checkIfInCart();
-    }
+    checkIfInCart();
+    fetchStream();
   }, [id, clerkUser, token]);
 
+  const fetchStream = async () => {
+    // Only owners get a manifest; the token may be our JWT or a Clerk session
+    const authToken = await apiToken();
+    if (!authToken) {
+      setHlsUrl(null);
+      return;
+    }
+    try {
+      const response = await axios.get(`${API}/products/${id}/stream`, {
+        headers: { Authorization: `Bearer ${authToken}` }
+      });
+      setHlsUrl(`${BACKEND_URL}${response.data.manifest_url}`);
+    } catch (error) {
+      // Not owned or not transcoded yet - fall back to the progressive video
+      setHlsUrl(null);
+    }
+  };
+
   const fetchProduct = async () => {
     try {
       const response = await axios.get(`${API}/products/${id}`);
@@ -626,29 +666,14 @@ const ProductDetailPage = ({ clerkUser, user, token, toast }) => {
 
   const checkIfInCart = async () => {
     try {
-      if (clerkUser) {
-        const clerkCart = JSON.parse(localStorage.getItem(`clerk_cart_${clerkUser.id}`) || '[]');
-        const inCart = clerkCart.some(item => item.id === id);
-        setIsInCart(inCart);
-      } else if (token) {
-        const response = await axios.get(`${API}/cart`, {
-          headers: { Authorization: `Bearer ${token}` }
-        });
-        const inCart = response.data.items?.some(item => item.product?.id === id);
-        setIsInCart(inCart);
-      }
+      const data = await cartRequest(await apiToken(), 'get');
+      setIsInCart(!!data.items?.some(item => item.product?.id === id));
     } catch (error) {
       console.error('Error checking cart:', error);
     }
   };
 
   const addToCart = async () => {
-    if (!isAuthenticated) {
-      sonnerToast.error('Please sign in first');
-      navigate('/signin');
-      return;
-    }
-
     if (isInCart) {
       sonnerToast.info('Product already in cart');
       navigate('/cart');
@@ -656,29 +681,13 @@ const ProductDetailPage = ({ clerkUser, user, token, toast }) => {
     }
 
     try {
-      if (clerkUser) {
-        const clerkCart = JSON.parse(localStorage.getItem(`clerk_cart_${clerkUser.id}`) || '[]');
-        clerkCart.push({ ...product, quantity: 1 });
-        localStorage.setItem(`clerk_cart_${clerkUser.id}`, JSON.stringify(clerkCart));
-        sonnerToast.success('Added to cart! 🎉', {
-          description: 'Product has been added to your cart',
-          duration: 2000,
-        });
-        setIsInCart(true);
-        setTimeout(() => navigate('/cart'), 1500);
-      } else if (token) {
-        await axios.post(
-          `${API}/cart/add`,
-          { product_id: id, quantity: 1 },
-          { headers: { Authorization: `Bearer ${token}` } }
-        );
-        sonnerToast.success('Added to cart! 🎉', {
-          description: 'Product has been added to your cart',
-          duration: 2000,
-        });
-        setIsInCart(true);
-        setTimeout(() => navigate('/cart'), 1500);
-      }
+      await cartRequest(await apiToken(), 'post', '/add', { product_id: id, quantity: 1 });
+      sonnerToast.success('Added to cart! 🎉', {
+        description: 'Product has been added to your cart',
+        duration: 2000,
+      });
+      setIsInCart(true);
+      setTimeout(() => navigate('/cart'), 1500);
     } catch (error) {
       if (error.response?.status === 400) {
         sonnerToast.info('Product already in cart');
@@ -703,6 +712,7 @@ const ProductDetailPage = ({ clerkUser, user, token, toast }) => {
             <h2 className="text-3xl font-bold mb-6">Course Preview</h2>
             <AdvancedVideoPlayer 
               videoUrl={product.video_url} 
+              hlsUrl={hlsUrl}
               chapters={product.video_chapters || []} 
             />
           </div>
@@ -711,17 +721,19 @@ const ProductDetailPage = ({ clerkUser, user, token, toast }) => {
         <div className="grid md:grid-cols-2 gap-12">
           <div>
             {!product.video_url && (
-              <img
-                src={product.image_url}
-                alt={product.name}
+              <ProductPicture
+                product={product}
+                size="hero"
+                sizes="(min-width: 768px) 50vw, 100vw"
                 className="w-full rounded-lg shadow-lg"
               />
             )}
             {product.video_url && product.category === 'software' && (
               <div>
-                <img
-                  src={product.image_url}
-                  alt={product.name}
+                <ProductPicture
+                  product={product}
+                  size="hero"
+                  sizes="(min-width: 768px) 50vw, 100vw"
                   className="w-full rounded-lg shadow-lg mb-6"
                 />
                 <div className="bg-slate-100 rounded-lg p-6">
@@ -730,6 +742,7 @@ const ProductDetailPage = ({ clerkUser, user, token, toast }) => {
                   </h3>
                   <AdvancedVideoPlayer 
                     videoUrl={product.video_url} 
+                    hlsUrl={hlsUrl}
                     chapters={product.video_chapters || []} 
                   />
                 </div>
@@ -780,28 +793,15 @@ const ProductDetailPage = ({ clerkUser, user, token, toast }) => {
 const CartPage = ({ clerkUser, user, token, toast }) => {
   const [cart, setCart] = useState({ items: [] });
   const navigate = useNavigate();
-
-  const isAuthenticated = clerkUser || (user && token);
+  const apiToken = useApiToken(token);
 
   useEffect(() => {
-    if (!isAuthenticated) {
-      navigate('/signin');
-      return;
-    }
     fetchCart();
   }, [clerkUser, token]);
 
   const fetchCart = async () => {
     try {
-      if (clerkUser) {
-        const clerkCart = JSON.parse(localStorage.getItem(`clerk_cart_${clerkUser.id}`) || '[]');
-        setCart({ items: clerkCart.map(item => ({ product: item, quantity: item.quantity || 1 })) });
-      } else if (token) {
-        const response = await axios.get(`${API}/cart`, {
-          headers: { Authorization: `Bearer ${token}` }
-        });
-        setCart(response.data);
-      }
+      setCart(await cartRequest(await apiToken(), 'get'));
     } catch (error) {
       console.error('Error fetching cart:', error);
     }
@@ -809,27 +809,20 @@ const CartPage = ({ clerkUser, user, token, toast }) => {
 
   const removeItem = async (productId) => {
     try {
-      if (clerkUser) {
-        const clerkCart = JSON.parse(localStorage.getItem(`clerk_cart_${clerkUser.id}`) || '[]');
-        const newCart = clerkCart.filter(item => item.id !== productId);
-        localStorage.setItem(`clerk_cart_${clerkUser.id}`, JSON.stringify(newCart));
-        sonnerToast.success('Item removed from cart');
-        fetchCart();
-      } else if (token) {
-        await axios.delete(`${API}/cart/remove/${productId}`, {
-          headers: { Authorization: `Bearer ${token}` }
-        });
-        sonnerToast.success('Item removed from cart');
-        fetchCart();
-      }
+      await cartRequest(await apiToken(), 'delete', `/remove/${productId}`);
+      sonnerToast.success('Item removed from cart');
+      fetchCart();
     } catch (error) {
       sonnerToast.error('Error removing item');
     }
   };
 
   const checkout = async () => {
-    if (clerkUser) {
-      sonnerToast.info('Clerk checkout coming soon! For now, admin users can process orders.');
+    const authToken = await apiToken();
+    if (!authToken) {
+      // The guest cart is merged into the account at sign-in
+      sonnerToast.info('Please sign in to checkout');
+      navigate('/signin');
       return;
     }
     
@@ -837,7 +830,7 @@ const CartPage = ({ clerkUser, user, token, toast }) => {
       const response = await axios.post(
         `${API}/orders/create`,
         {},
-        { headers: { Authorization: `Bearer ${token}` } }
+        { headers: { Authorization: `Bearer ${authToken}` } }
       );
 
       const options = {
@@ -857,7 +850,7 @@ const CartPage = ({ clerkUser, user, token, toast }) => {
                 razorpay_signature: razorpayResponse.razorpay_signature,
                 order_id: response.data.order_id
               },
-              { headers: { Authorization: `Bearer ${token}` } }
+              { headers: { Authorization: `Bearer ${authToken}` } }
             );
             sonnerToast.success('Payment successful!');
             navigate('/dashboard');
@@ -968,6 +961,7 @@ const CartPage = ({ clerkUser, user, token, toast }) => {
 };
 
 const DashboardPage = ({ clerkUser, user, token }) => {
+  const { getToken } = useAuth();
   const [purchasedProducts, setPurchasedProducts] = useState([]);
   const [orders, setOrders] = useState([]);
   const navigate = useNavigate();
@@ -994,7 +988,9 @@ const DashboardPage = ({ clerkUser, user, token }) => {
   const fetchDemoCourse = async () => {
     try {
       // For Clerk users, fetch purchased products from MongoDB using clerk_id
-      const response = await axios.get(`${API}/clerk/purchased-products/${clerkUser.id}`);
+      const response = await axios.get(`${API}/clerk/purchased-products/${clerkUser.id}`, {
+        headers: { Authorization: `Bearer ${await getToken()}` }
+      });
       setPurchasedProducts(response.data);
     } catch (error) {
       console.error('Error fetching purchased products:', error);
@@ -1239,6 +1235,16 @@ const AdminDashboard = ({ user, token, toast }) => {
     }
   };
 
+  const editProduct = async (productId) => {
+    // Listings only carry summary fields; load the full product for editing
+    try {
+      const response = await axios.get(`${API}/products/${productId}`);
+      setEditingProduct(response.data);
+    } catch (error) {
+      sonnerToast.error('Error loading product');
+    }
+  };
+
   const deleteProduct = async (productId) => {
     if (!window.confirm('Are you sure you want to delete this product?')) return;
     
@@ -1338,7 +1344,7 @@ const AdminDashboard = ({ user, token, toast }) => {
                   <Button
                     variant="outline"
                     size="sm"
-                    onClick={() => setEditingProduct(product)}
+                    onClick={() => editProduct(product.id)}
                   >
                     Edit
                   </Button>
@@ -1419,12 +1425,16 @@ const ProductModal = ({ product, token, toast, onClose, onSuccess }) => {
       
       const method = product ? 'put' : 'post';
 
-      await axios[method](url, formDataToSend, {
-        headers: {
-          Authorization: `Bearer ${token}`,
-          'Content-Type': 'multipart/form-data'
-        }
-      });
+      const headers = {
+        Authorization: `Bearer ${token}`,
+        'Content-Type': 'multipart/form-data'
+      };
+      if (product) {
+        // Reject the save if someone else edited the product since it was loaded
+        headers['If-Match'] = `"${product.version ?? 0}"`;
+      }
+
+      await axios[method](url, formDataToSend, { headers });
 
       sonnerToast.success(product ? 'Product updated!' : 'Product created!');
       onSuccess();
@@ -9,8 +9,13 @@ import {
   DropdownMenuTrigger,
 } from '@/components/ui/dropdown-menu';
 
-const AdvancedVideoPlayer = ({ videoUrl, chapters = [] }) => {
+const AdvancedVideoPlayer = ({ videoUrl, hlsUrl, chapters = [] }) => {
   const videoRef = useRef(null);
+  // Adaptive streaming: natively where the browser plays HLS (Safari, iOS, Android), through hls.js
+  // elsewhere (Chrome, Firefox, Edge), and the progressive file when neither works
+  const canPlayHls = typeof document !== 'undefined' &&
+    document.createElement('video').canPlayType('application/vnd.apple.mpegurl') !== '';
+  const useHlsJs = Boolean(hlsUrl) && !canPlayHls;
   const [isPlaying, setIsPlaying] = useState(false);
   const [currentTime, setCurrentTime] = useState(0);
   const [duration, setDuration] = useState(0);
@@ -22,6 +27,37 @@ const AdvancedVideoPlayer = ({ videoUrl, chapters = [] }) => {
   const [currentChapter, setCurrentChapter] = useState(null);
   const controlsTimeoutRef = useRef(null);
 
+  useEffect(() => {
+    if (!useHlsJs) return;
+    let hls = null;
+    let cancelled = false;
+    const fallBack = () => {
+      if (videoRef.current) videoRef.current.src = videoUrl;
+    };
+    // Loaded on demand so visitors without a manifest never download it
+    import('hls.js').then(({ default: Hls }) => {
+      if (cancelled || !videoRef.current) return;
+      if (!Hls.isSupported()) {
+        fallBack();
+        return;
+      }
+      hls = new Hls();
+      hls.on(Hls.Events.ERROR, (event, data) => {
+        if (data.fatal) {
+          hls.destroy();
+          hls = null;
+          fallBack();
+        }
+      });
+      hls.loadSource(hlsUrl);
+      hls.attachMedia(videoRef.current);
+    }).catch(fallBack);
+    return () => {
+      cancelled = true;
+      if (hls) hls.destroy();
+    };
+  }, [hlsUrl, videoUrl, useHlsJs]);
+
   useEffect(() => {
     const video = videoRef.current;
     if (!video) return;
@@ -144,7 +180,7 @@ const AdvancedVideoPlayer = ({ videoUrl, chapters = [] }) => {
     >
       <video
         ref={videoRef}
-        src={videoUrl}
+        src={useHlsJs ? undefined : (hlsUrl || videoUrl)}
         className="w-full aspect-video"
         onClick={togglePlay}
       />
@@ -0,0 +1,10 @@
+import os
+import sys
+from pathlib import Path
+
+# Backend modules import each other as top-level modules (uvicorn runs from backend/)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+# server.py reads these at import; Motor only connects when a query runs
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
@@ -0,0 +1,155 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+
+pytest.importorskip("cryptography")
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+
+from clerk_auth import ClerkJWKS, ClerkJWKSUnavailable, ClerkTokenError, load_local_jwks, verify_session_token
+
+ISSUER = "https://example.clerk.accounts.dev"
+
+
+def make_key(kid):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update(kid=kid, alg="RS256", use="sig")
+    return private_key, jwk
+
+
+SIGNING_KEY, SIGNING_JWK = make_key("ins_test")
+OTHER_KEY, OTHER_JWK = make_key("ins_rotated")
+
+
+def session_token(key=SIGNING_KEY, kid="ins_test", **claims):
+    now = int(time.time())
+    payload = {"sub": "user_123", "iss": ISSUER, "iat": now, "exp": now + 60, "azp": "https://shop.example"}
+    payload.update(claims)
+    return jwt.encode(payload, key, algorithm="RS256", headers={"kid": kid})
+
+
+@pytest.fixture
+def local_jwks(monkeypatch):
+    monkeypatch.setenv("CLERK_JWKS", json.dumps({"keys": [SIGNING_JWK]}))
+    return ClerkJWKS(local_jwks=load_local_jwks(os.environ["CLERK_JWKS"]))
+
+
+def verify(jwks, token, **kwargs):
+    kwargs.setdefault("issuer", ISSUER)
+    return asyncio.run(verify_session_token(jwks, token, **kwargs))
+
+
+def test_valid_token(local_jwks):
+    assert verify(local_jwks, session_token())["sub"] == "user_123"
+
+
+def test_jwks_file_path(tmp_path):
+    path = tmp_path / "jwks.json"
+    path.write_text(json.dumps({"keys": [SIGNING_JWK]}))
+    jwks = ClerkJWKS(local_jwks=load_local_jwks(str(path)))
+    assert verify(jwks, session_token())["sub"] == "user_123"
+
+
+def test_expired_token(local_jwks):
+    now = int(time.time())
+    with pytest.raises(ClerkTokenError, match="expired"):
+        verify(local_jwks, session_token(iat=now - 120, exp=now - 60))
+
+
+def test_wrong_issuer(local_jwks):
+    with pytest.raises(ClerkTokenError, match="Invalid token"):
+        verify(local_jwks, session_token(iss="https://evil.clerk.accounts.dev"))
+
+
+def test_authorized_party(local_jwks):
+    token = session_token()
+    assert verify(local_jwks, token, authorized_parties=["https://shop.example"])
+    with pytest.raises(ClerkTokenError, match="authorized party"):
+        verify(local_jwks, token, authorized_parties=["https://other.example"])
+
+
+def test_unknown_kid(local_jwks):
+    with pytest.raises(ClerkTokenError, match="Unknown signing key"):
+        verify(local_jwks, session_token(OTHER_KEY, kid="ins_rotated"))
+
+
+def test_signature_from_other_key(local_jwks):
+    with pytest.raises(ClerkTokenError, match="Invalid token"):
+        verify(local_jwks, session_token(OTHER_KEY, kid="ins_test"))
+
+
+def test_hs256_token_rejected(local_jwks):
+    token = jwt.encode({"sub": "user_123", "exp": int(time.time()) + 60}, "secret", algorithm="HS256")
+    with pytest.raises(ClerkTokenError):
+        verify(local_jwks, token)
+
+
+def fail_fetch():
+    raise ValueError("Clerk is down")
+
+
+def test_unknown_kid_refetches_rotated_keys():
+    jwks = ClerkJWKS(jwks_url="https://example.invalid/jwks.json", min_refetch_interval=0)
+    responses = [{"keys": [SIGNING_JWK]}, {"keys": [SIGNING_JWK, OTHER_JWK]}]
+    jwks._fetch = lambda: responses[min(jwks.fetches, 1)]
+    assert verify(jwks, session_token(OTHER_KEY, kid="ins_rotated"))["sub"] == "user_123"
+    assert jwks.fetches == 2
+
+
+def test_fetch_failure_without_keys_is_unavailable():
+    jwks = ClerkJWKS(jwks_url="https://example.invalid/jwks.json")
+
+    jwks._fetch = fail_fetch
+    with pytest.raises(ClerkJWKSUnavailable):
+        verify(jwks, session_token())
+
+
+def test_fetch_failure_keeps_cached_keys():
+    jwks = ClerkJWKS(jwks_url="https://example.invalid/jwks.json", refresh_interval=0)
+    jwks._fetch = lambda: {"keys": [SIGNING_JWK]}
+    assert verify(jwks, session_token())
+
+    jwks._fetch = fail_fetch
+    assert verify(jwks, session_token())["sub"] == "user_123"
+
+
+class Users:
+    def __init__(self, user=None):
+        self.user = user
+
+    async def find_one(self, query, projection=None):
+        return self.user
+
+
+def test_dependency_maps_outage_to_503(monkeypatch):
+    pytest.importorskip("motor")
+    import server
+    from fastapi import HTTPException
+    from fastapi.security import HTTPAuthorizationCredentials
+
+    jwks = ClerkJWKS(jwks_url="https://example.invalid/jwks.json")
+    jwks._fetch = fail_fetch
+    monkeypatch.setattr(server, "clerk_jwks", jwks)
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=session_token())
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(server.get_clerk_claims(credentials))
+    assert exc.value.status_code == 503
+
+
+def test_purchased_products_for_unsynced_user_is_empty(monkeypatch):
+    pytest.importorskip("motor")
+    import server
+    from fastapi import HTTPException
+    from types import SimpleNamespace
+
+    monkeypatch.setattr(server, "db", SimpleNamespace(users=Users()))
+    claims = {"sub": "user_123"}
+    assert asyncio.run(server.get_clerk_purchased_products("user_123", claims)) == []
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(server.get_clerk_purchased_products("user_456", claims))
+    assert exc.value.status_code == 403
@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from clerk_webhooks import ClerkEventBatcher
+
+
+class FakeUsers:
+    """Records bulk_write calls; ops whose clerk_id is in `poison` fail like a duplicate key."""
+
+    def __init__(self, poison=()):
+        self.poison = set(poison)
+        self.calls = []
+
+    async def bulk_write(self, ops, ordered=True):
+        self.calls.append(([op._filter["clerk_id"] for op in ops], ordered))
+        errors = [{"index": i, "code": 11000, "errmsg": "E11000"} for i, op in enumerate(ops)
+                  if op._filter["clerk_id"] in self.poison]
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": 0})
+
+
+def upsert(clerk_id):
+    return UpdateOne({"clerk_id": clerk_id}, {"$set": {"name": clerk_id}}, upsert=True)
+
+
+def test_failing_op_only_fails_its_request():
+    async def scenario():
+        users = FakeUsers(poison={"bad"})
+        batcher = ClerkEventBatcher(lambda: users, max_delay=0.01)
+        results = await asyncio.gather(
+            batcher.submit([upsert("a")]), batcher.submit([upsert("bad")]), batcher.submit([upsert("c")]),
+            return_exceptions=True
+        )
+        assert results[0] is None and results[2] is None
+        assert isinstance(results[1], BulkWriteError)
+        assert users.calls == [(["a", "bad", "c"], False)]
+
+    asyncio.run(scenario())
+
+
+def test_events_for_one_user_keep_their_order():
+    async def scenario():
+        users = FakeUsers()
+        batcher = ClerkEventBatcher(lambda: users, max_delay=0.01)
+        await asyncio.gather(
+            batcher.submit([upsert("a"), upsert("b")]),
+            batcher.submit([DeleteOne({"clerk_id": "a"})]),
+        )
+        assert users.calls == [(["a", "b"], False), (["a"], False)]
+
+    asyncio.run(scenario())
+
+
+def test_connection_error_fails_every_request_in_the_round():
+    class Down:
+        async def bulk_write(self, ops, ordered=True):
+            raise ConnectionError("down")
+
+    async def scenario():
+        batcher = ClerkEventBatcher(lambda: Down(), max_delay=0.01)
+        results = await asyncio.gather(
+            batcher.submit([upsert("a")]), batcher.submit([upsert("b")]), return_exceptions=True
+        )
+        assert all(isinstance(result, ConnectionError) for result in results)
+
+    asyncio.run(scenario())
+
+
+def test_empty_submit_does_not_write():
+    async def scenario():
+        users = FakeUsers()
+        await ClerkEventBatcher(lambda: users).submit([])
+        assert users.calls == []
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("body", [b"{not json", b"[1, 2]"])
+def test_webhook_rejects_malformed_body(monkeypatch, body):
+    pytest.importorskip("motor")
+    import server
+    from starlette.testclient import TestClient
+
+    monkeypatch.setattr(server, "CLERK_WEBHOOK_SECRET", "whsec_dGVzdA==")
+    monkeypatch.setattr(server, "verify_svix_signature", lambda secret, headers, body: None)
+    response = TestClient(server.app).post("/api/webhooks/clerk", content=body)
+    assert response.status_code == 400
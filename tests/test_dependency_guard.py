@@ -0,0 +1,151 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from dependency_guard import CLOSED, HALF_OPEN, OPEN, DependencyGuard, DependencyUnavailable
+
+
+class FakeSDK:
+    """Stands in for a blocking SDK call; each mode injects one kind of fault."""
+
+    def __init__(self):
+        self.mode = "ok"
+        self.release = threading.Event()
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.mode == "error":
+            raise ConnectionError("connection reset")
+        if self.mode == "hang":
+            self.release.wait(5)
+        return "done"
+
+
+def guard(**kwargs):
+    options = dict(timeout=0.05, max_concurrency=2, failure_threshold=2, reset_timeout=0.05)
+    options.update(kwargs)
+    return DependencyGuard("fake", **options)
+
+
+async def wait_for_idle(g, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while g.in_flight and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+
+
+def test_success_passes_result_through():
+    async def scenario():
+        g, sdk = guard(), FakeSDK()
+        assert await g.call(sdk) == "done"
+        assert g.snapshot()["state"] == CLOSED
+        await wait_for_idle(g)
+        assert g.in_flight == 0
+
+    asyncio.run(scenario())
+
+
+def test_opens_after_threshold_and_fails_fast():
+    async def scenario():
+        g, sdk = guard(), FakeSDK()
+        sdk.mode = "error"
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                await g.call(sdk)
+        assert g.state == OPEN
+        with pytest.raises(DependencyUnavailable, match="circuit open"):
+            await g.call(sdk)
+        assert sdk.calls == 2
+
+    asyncio.run(scenario())
+
+
+def test_non_failures_do_not_trip_breaker():
+    async def scenario():
+        g, sdk = guard(is_failure=lambda exc: not isinstance(exc, ConnectionError)), FakeSDK()
+        sdk.mode = "error"
+        for _ in range(3):
+            with pytest.raises(ConnectionError):
+                await g.call(sdk)
+        assert g.state == CLOSED
+
+    asyncio.run(scenario())
+
+
+def test_timeout_counts_as_failure_and_holds_slot_until_thread_ends():
+    async def scenario():
+        g, sdk = guard(failure_threshold=5), FakeSDK()
+        sdk.mode = "hang"
+        with pytest.raises(DependencyUnavailable, match="no response"):
+            await g.call(sdk)
+        assert g.consecutive_failures == 1
+        assert g.in_flight == 1
+        sdk.release.set()
+        await wait_for_idle(g)
+        assert g.in_flight == 0
+
+    asyncio.run(scenario())
+
+
+def test_half_open_trial_closes_or_reopens():
+    async def scenario():
+        g, sdk = guard(), FakeSDK()
+        sdk.mode = "error"
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                await g.call(sdk)
+        await asyncio.sleep(0.06)
+        with pytest.raises(ConnectionError):
+            await g.call(sdk)
+        assert g.state == OPEN
+        await asyncio.sleep(0.06)
+        sdk.mode = "ok"
+        assert await g.call(sdk) == "done"
+        assert g.state == CLOSED
+
+    asyncio.run(scenario())
+
+
+def test_full_bulkhead_in_half_open_does_not_wedge_breaker():
+    async def scenario():
+        g, sdk = guard(max_concurrency=1, failure_threshold=1), FakeSDK()
+        sdk.mode = "hang"
+        # The timed-out thread keeps the only slot while the breaker opens
+        with pytest.raises(DependencyUnavailable, match="no response"):
+            await g.call(sdk)
+        await asyncio.sleep(0.06)
+        with pytest.raises(DependencyUnavailable, match="too many concurrent calls"):
+            await g.call(sdk)
+        sdk.release.set()
+        await wait_for_idle(g)
+        sdk.mode = "ok"
+        assert await g.call(sdk) == "done"
+        assert g.state == CLOSED
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_trial_releases_trial_without_closing():
+    async def scenario():
+        g, sdk = guard(timeout=5, failure_threshold=1), FakeSDK()
+        sdk.mode = "error"
+        with pytest.raises(ConnectionError):
+            await g.call(sdk)
+        await asyncio.sleep(0.06)
+        sdk.mode = "hang"
+        task = asyncio.ensure_future(g.call(sdk))
+        await asyncio.sleep(0.02)
+        assert g.state == HALF_OPEN
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert g.state == HALF_OPEN
+        sdk.release.set()
+        await wait_for_idle(g)
+        sdk.mode = "ok"
+        assert await g.call(sdk) == "done"
+        assert g.state == CLOSED
+
+    asyncio.run(scenario())
@@ -0,0 +1,92 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+from order_events import OrderEventBus, format_sse, order_events
+
+PAID = {"id": "o1", "status": "paid", "items": [{"product_id": "a"}, {"product_id": "b"}]}
+
+
+def test_paid_order_reports_status_then_entitlements():
+    assert order_events(PAID) == [
+        {"event": "status", "data": {"order_id": "o1", "status": "paid"}},
+        {"event": "entitlements", "data": {"order_id": "o1", "product_ids": ["a", "b"]}},
+    ]
+    assert order_events({"id": "o1", "status": "created"}) == [
+        {"event": "status", "data": {"order_id": "o1", "status": "created"}}
+    ]
+
+
+def test_format_sse_frames_one_event():
+    frame = format_sse("status", {"order_id": "o1"})
+    assert frame.startswith("event: status\ndata: ") and frame.endswith("\n\n")
+    assert json.loads(frame.split("data: ", 1)[1]) == {"order_id": "o1"}
+
+
+def test_subscribers_get_only_their_order():
+    async def scenario():
+        bus = OrderEventBus()
+        with bus.subscribe("o1") as first, bus.subscribe("o1") as second, bus.subscribe("o2") as other:
+            bus.notify(PAID)
+            assert [first.get_nowait()["event"] for _ in range(2)] == ["status", "entitlements"]
+            assert second.qsize() == 2
+            assert other.empty()
+
+    asyncio.run(scenario())
+
+
+def test_unsubscribe_drops_the_order_entry():
+    async def scenario():
+        bus = OrderEventBus()
+        with bus.subscribe("o1") as queue:
+            pass
+        assert bus._subscribers == {}
+        bus.notify(PAID)  # nobody listening
+        assert queue.empty()
+
+    asyncio.run(scenario())
+
+
+def test_bridged_bus_leaves_delivery_to_the_change_stream():
+    async def scenario():
+        bus = OrderEventBus()
+        bus.bridged = True
+        with bus.subscribe("o1") as queue:
+            bus.notify(PAID)
+            assert queue.empty()
+            bus.dispatch(PAID)
+            assert queue.qsize() == 2
+
+    asyncio.run(scenario())
+
+
+class Orders:
+    """find_one returns the queued results in turn, then None."""
+
+    def __init__(self, *results):
+        self.results = list(results)
+
+    async def find_one(self, query, projection=None):
+        return self.results.pop(0) if self.results else None
+
+
+async def open_stream(server):
+    response = await server.order_event_stream("o1", current_user={"id": "u"})
+    return "".join([chunk async for chunk in response.body_iterator])
+
+
+def test_stream_closes_when_the_order_expires_after_the_check(monkeypatch):
+    import server
+
+    monkeypatch.setattr(server, "db", SimpleNamespace(orders=Orders({"_id": 1}), orders_archive=Orders()))
+    assert asyncio.run(open_stream(server)) == ""
+
+
+def test_stream_reports_an_archived_order(monkeypatch):
+    import server
+
+    archived = {**PAID, "user_id": "u"}
+    monkeypatch.setattr(server, "db", SimpleNamespace(orders=Orders(), orders_archive=Orders({"_id": 1}, archived)))
+
+    body = asyncio.run(open_stream(server))
+    assert body.startswith("event: status\n") and "event: entitlements\n" in body
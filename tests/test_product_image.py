@@ -0,0 +1,57 @@
+import asyncio
+import base64
+
+import requests
+
+import server
+
+
+def test_every_size_has_every_format():
+    image = server.build_product_image("ecommerce/products/abc")
+    assert set(image.sizes) == set(server.IMAGE_DERIVATIVE_WIDTHS)
+    for name, width in server.IMAGE_DERIVATIVE_WIDTHS.items():
+        assert set(image.sizes[name]) == set(server.IMAGE_DERIVATIVE_FORMATS)
+        for fmt, url in image.sizes[name].items():
+            assert f"w_{width}" in url and url.endswith(f"abc.{fmt}")
+
+
+def test_srcset_lists_each_width_once_per_format():
+    image = server.build_product_image("ecommerce/products/abc")
+    for fmt in server.IMAGE_DERIVATIVE_FORMATS:
+        candidates = [entry.rsplit(" ", 1) for entry in image.srcset[fmt].split(", ")]
+        assert [descriptor for _, descriptor in candidates] == [
+            f"{width}w" for width in server.IMAGE_DERIVATIVE_WIDTHS.values()
+        ]
+        assert [url for url, _ in candidates] == [image.sizes[name][fmt] for name in server.IMAGE_DERIVATIVE_WIDTHS]
+
+
+def test_eager_transformations_match_the_built_urls():
+    transformations = server.image_derivative_transformations()
+    assert len(transformations) == len(server.IMAGE_DERIVATIVE_WIDTHS) * len(server.IMAGE_DERIVATIVE_FORMATS) + 1
+    assert {**server.IMAGE_PLACEHOLDER_TRANSFORMATION, "format": "jpg"} in transformations
+
+
+def test_placeholder_defaults_to_url_and_accepts_data_uri():
+    assert server.build_product_image("p").placeholder == server.image_placeholder_url("p")
+    data_uri = server.placeholder_data_uri(b"\xff\xd8jpeg")
+    assert data_uri == "data:image/jpeg;base64," + base64.b64encode(b"\xff\xd8jpeg").decode()
+    assert server.build_product_image("p", data_uri).placeholder == data_uri
+
+
+def test_oversized_or_empty_placeholder_is_not_inlined():
+    assert server.placeholder_data_uri(b"") is None
+    assert server.placeholder_data_uri(b"x" * (server.IMAGE_PLACEHOLDER_MAX_BYTES + 1)) is None
+
+
+def test_placeholder_fetch_failure_keeps_url(monkeypatch):
+    def fail(*args, **kwargs):
+        raise requests.ConnectionError("offline")
+
+    monkeypatch.setattr(server.requests, "get", fail)
+    assert asyncio.run(server.inline_image_placeholder("p")) is None
+
+
+def test_summary_projection_keeps_only_listing_image_fields():
+    assert "image" not in server.PRODUCT_SUMMARY_PROJECTION
+    image_fields = {key for key in server.PRODUCT_SUMMARY_PROJECTION if key.startswith("image.")}
+    assert image_fields == {"image.public_id", "image.placeholder", "image.srcset", "image.sizes.card.jpg"}
@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from recommendations import CooccurrenceCounter, pair_update_action, recommendation_docs, top_k_related
+
+
+def pair_counts(counter):
+    rows, cols, counts = counter.pairs()
+    ids = counter.product_ids
+    return {(ids[r], ids[c]): n for r, c, n in zip(rows.tolist(), cols.tolist(), counts.tolist())}
+
+
+def test_counter_counts_both_directions_once_per_basket():
+    counter = CooccurrenceCounter()
+    counter.add_many([["a", "b", "c"], ["a", "b"], ["b", "a", "a"], ["c"]])
+    assert pair_counts(counter) == {
+        ("a", "b"): 3, ("b", "a"): 3,
+        ("a", "c"): 1, ("c", "a"): 1,
+        ("b", "c"): 1, ("c", "b"): 1,
+    }
+
+
+def test_counter_merges_across_chunks():
+    chunked, whole = CooccurrenceCounter(chunk_pairs=2), CooccurrenceCounter()
+    baskets = [["a", "b"], ["b", "c"], ["a", "b", "c"], ["c", "a"], ["a", "b"]]
+    chunked.add_many(baskets)
+    whole.add_many(baskets)
+    assert pair_counts(chunked) == pair_counts(whole)
+
+
+def test_empty_counter_has_no_pairs():
+    rows, cols, counts = CooccurrenceCounter().pairs()
+    assert rows.size == cols.size == counts.size == 0
+    assert all(array.size == 0 for array in top_k_related(rows, cols, counts))
+
+
+def test_top_k_keeps_highest_counts_per_row_with_stable_ties():
+    rows = np.array([0, 0, 0, 0, 1, 1])
+    cols = np.array([3, 1, 2, 4, 0, 2])
+    counts = np.array([5, 7, 5, 1, 2, 9])
+    kept = top_k_related(rows, cols, counts, k=2)
+    # Row 0: count 7 first, then the tie at 5 broken by the lower column
+    assert [array.tolist() for array in kept] == [[0, 0, 1, 1], [1, 2, 2, 0], [7, 5, 9, 2]]
+
+
+def test_recommendation_docs_group_by_product():
+    docs = recommendation_docs(["a", "b", "c"], np.array([0, 0, 2]), np.array([1, 2, 0]), np.array([4, 2, 1]))
+    assert [(doc["product_id"], doc["related"]) for doc in docs] == [
+        ("a", [{"product_id": "b", "score": 4}, {"product_id": "c", "score": 2}]),
+        ("c", [{"product_id": "a", "score": 1}]),
+    ]
+
+
+NOW = datetime(2026, 10, 1, 12, tzinfo=timezone.utc)
+
+
+def test_orders_are_applied_without_a_rebuild():
+    assert pair_update_action(None, NOW, NOW) == "apply"
+    assert pair_update_action({"counted_before": NOW - timedelta(hours=1)}, NOW, NOW) == "apply"
+
+
+def test_orders_counted_by_the_last_rebuild_are_skipped():
+    assert pair_update_action({"counted_before": NOW}, NOW - timedelta(seconds=1), NOW) == "skip"
+
+
+def test_orders_paid_during_a_rebuild_are_deferred():
+    state = {"rebuilding_since": NOW - timedelta(minutes=5), "rebuilding_until": NOW + timedelta(minutes=55)}
+    assert pair_update_action(state, NOW, NOW) == "defer"
+    # Paid before the cutoff: the rebuild counts it, and the old counts may still take the increment
+    assert pair_update_action(state, NOW - timedelta(minutes=6), NOW) == "apply"
+
+
+def test_expired_rebuild_lease_stops_deferring():
+    state = {"rebuilding_since": NOW - timedelta(hours=2), "rebuilding_until": NOW - timedelta(hours=1)}
+    assert pair_update_action(state, NOW, NOW) == "apply"
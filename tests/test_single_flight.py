@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from server import SingleFlight
+
+
+class Query:
+    """A read that blocks until released, counting how often it runs."""
+
+    def __init__(self, result="rows", error=None):
+        self.result = result
+        self.error = error
+        self.runs = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.runs += 1
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def test_concurrent_callers_share_one_query():
+    async def scenario():
+        flight, query = SingleFlight(), Query()
+        waiters = [asyncio.ensure_future(flight.do(("products", None), query)) for _ in range(5)]
+        await asyncio.sleep(0)
+        query.release.set()
+        assert await asyncio.gather(*waiters) == ["rows"] * 5
+        assert query.runs == 1
+        assert flight.stats() == {"products": {"executed": 1, "coalesced": 4}}
+
+    asyncio.run(scenario())
+
+
+def test_different_keys_and_later_calls_run_again():
+    async def scenario():
+        flight, query = SingleFlight(), Query()
+        query.release.set()
+        await asyncio.gather(flight.do(("product", "a"), query), flight.do(("product", "b"), query))
+        await flight.do(("product", "a"), query)
+        assert query.runs == 3
+        assert flight.stats() == {"product": {"executed": 3, "coalesced": 0}}
+
+    asyncio.run(scenario())
+
+
+def test_error_reaches_every_waiter():
+    async def scenario():
+        flight, query = SingleFlight(), Query(error=RuntimeError("mongo down"))
+        waiters = [asyncio.ensure_future(flight.do(("catalog",), query)) for _ in range(3)]
+        await asyncio.sleep(0)
+        query.release.set()
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert query.runs == 1
+        # The failed flight is forgotten, so the next caller retries
+        query.error = None
+        assert await flight.do(("catalog",), query) == "rows"
+        assert query.runs == 2
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_leader_does_not_cancel_followers():
+    async def scenario():
+        flight, query = SingleFlight(), Query()
+        leader = asyncio.ensure_future(flight.do(("products", None), query))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do(("products", None), query))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        query.release.set()
+        assert await follower == "rows"
+        assert query.runs == 1
+
+    asyncio.run(scenario())
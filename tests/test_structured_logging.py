@@ -0,0 +1,43 @@
+import atexit
+import logging
+
+import pytest
+
+from structured_logging import configure_logging
+
+
+@pytest.fixture(autouse=True)
+def restore_root_logger():
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield
+    root.handlers[:] = handlers
+    root.setLevel(level)
+
+
+def stop(listener):
+    listener.stop()
+    atexit.unregister(listener.stop)
+
+
+def test_queue_is_the_default(monkeypatch):
+    monkeypatch.delenv("LOG_QUEUE", raising=False)
+    monkeypatch.delenv("VERCEL", raising=False)
+    listener = configure_logging()
+    assert listener is not None
+    stop(listener)
+
+
+def test_vercel_logs_synchronously(monkeypatch):
+    monkeypatch.delenv("LOG_QUEUE", raising=False)
+    monkeypatch.setenv("VERCEL", "1")
+    assert configure_logging() is None
+    assert isinstance(logging.getLogger().handlers[0], logging.StreamHandler)
+
+
+def test_log_queue_overrides_vercel(monkeypatch):
+    monkeypatch.setenv("LOG_QUEUE", "1")
+    monkeypatch.setenv("VERCEL", "1")
+    listener = configure_logging()
+    assert listener is not None
+    stop(listener)
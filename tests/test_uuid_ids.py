@@ -0,0 +1,127 @@
+import asyncio
+import uuid
+
+from bson.binary import Binary, UuidRepresentation
+from pymongo import DeleteMany, DeleteOne, InsertOne, MongoClient, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.bulk import _Bulk
+
+from uuid_ids import (
+    UuidIdCollection, UuidIdDatabase, from_bson_id, map_document, map_filter, map_projection, map_result, map_sort,
+    map_update, to_app_id, to_bson_id
+)
+
+APP_ID = "6f1c1b0e-6a52-4a58-9a57-2a8d3c1f5e10"
+STORED_ID = Binary.from_uuid(uuid.UUID(APP_ID), UuidRepresentation.STANDARD)
+OTHER_ID = "0b7a3a63-1d7a-4a1e-8d0e-0d2f6f0c9c11"
+
+
+def test_ids_round_trip():
+    assert to_bson_id(APP_ID) == STORED_ID and STORED_ID.subtype == 4
+    assert to_app_id(STORED_ID) == from_bson_id(STORED_ID) == APP_ID
+    # Ids that are not UUIDs are stored as given
+    assert to_bson_id("legacy-1") == "legacy-1" and to_app_id("legacy-1") == "legacy-1"
+    assert to_bson_id(7) == 7 and to_app_id(7) == 7 and from_bson_id(7) == "7"
+
+
+def test_filter_maps_id_conditions():
+    assert map_filter({"id": APP_ID, "status": "paid"}) == {"_id": STORED_ID, "status": "paid"}
+    assert map_filter({"id": {"$in": [APP_ID, "legacy-1"]}}) == {"_id": {"$in": [STORED_ID, "legacy-1"]}}
+    assert map_filter({"id": {"$ne": APP_ID}}) == {"_id": {"$ne": STORED_ID}}
+    assert map_filter({"$or": [{"id": APP_ID}, {"$and": [{"id": OTHER_ID}]}]}) == {
+        "$or": [{"_id": STORED_ID}, {"$and": [{"_id": to_bson_id(OTHER_ID)}]}]
+    }
+    # Only the top-level application id is mapped
+    assert map_filter({"user_id": APP_ID, "items.id": APP_ID}) == {"user_id": APP_ID, "items.id": APP_ID}
+    assert map_filter({}) == {} and map_filter(None) is None
+
+
+def test_document_moves_id_into_underscore_id():
+    assert map_document({"id": APP_ID, "_id": "ignored", "name": "n"}) == {"_id": STORED_ID, "name": "n"}
+    assert map_document({"name": "n"}) == {"name": "n"}
+
+
+def test_update_maps_only_set_on_insert_ids():
+    update = {"$set": {"name": "n"}, "$setOnInsert": {"id": APP_ID, "created": 1}}
+    assert map_update(update) == {"$set": {"name": "n"}, "$setOnInsert": {"_id": STORED_ID, "created": 1}}
+    assert update["$setOnInsert"]["id"] == APP_ID  # the caller's update is left alone
+    pipeline = [{"$set": {"name": "n"}}]
+    assert map_update(pipeline) is pipeline
+
+
+def test_projection_paths():
+    # (stored projection, caller wants id, caller asked for _id)
+    assert map_projection(None) == (None, True, False)
+    assert map_projection({"_id": 0}) == (None, True, False)
+    assert map_projection({"_id": 0, "items": 0}) == ({"items": 0}, True, False)
+    assert map_projection({"_id": 0, "name": 1}) == ({"name": 1, "_id": 1}, False, False)
+    assert map_projection({"_id": 0, "id": 1, "name": 1}) == ({"name": 1, "_id": 1}, True, False)
+    assert map_projection({"_id": 0, "id": 0}) == (None, False, False)
+    assert map_projection({"_id": 1}) == ({"_id": 1}, True, True)
+    assert map_projection(["name"]) == ({"name": 1, "_id": 1}, False, False)
+
+
+def test_result_and_sort():
+    assert map_result({"_id": STORED_ID, "name": "n"}) == {"name": "n", "id": APP_ID}
+    assert map_result({"_id": STORED_ID, "name": "n"}, want_id=False) == {"name": "n"}
+    assert map_result({"_id": STORED_ID}, want_id=False, keep_raw=True) == {"_id": STORED_ID}
+    assert map_result(None) is None
+    assert map_sort("id") == "_id"
+    assert map_sort([("id", 1), ("created_at", -1)]) == [("_id", 1), ("created_at", -1)]
+
+
+class Recorder:
+    """Feeds write models to pymongo's own bulk builder, like a real bulk_write would."""
+
+    def __init__(self):
+        self.collection = MongoClient(connect=False)["test"]["orders"]
+        self.ops = []
+
+    async def bulk_write(self, requests, ordered=True):
+        bulk = _Bulk(self.collection, ordered, False)
+        for request in requests:
+            request._add_to_bulk(bulk)
+        self.ops = [op for _, op in bulk.ops]
+        return len(self.ops)
+
+
+def test_bulk_write_maps_every_write_model():
+    recorder = Recorder()
+    update = UpdateOne({"id": APP_ID}, {"$set": {"status": "paid"}, "$setOnInsert": {"id": APP_ID}}, upsert=True)
+    requests = [
+        InsertOne({"id": APP_ID, "name": "n"}),
+        update,
+        UpdateMany({"id": {"$in": [APP_ID]}}, {"$set": {"a": 1}}),
+        ReplaceOne({"id": APP_ID}, {"id": APP_ID, "name": "m"}),
+        DeleteOne({"id": APP_ID}),
+        DeleteMany({"id": {"$in": [APP_ID]}}),
+    ]
+    asyncio.run(UuidIdCollection(recorder).bulk_write(requests, ordered=False))
+    insert, update_one, update_many, replace, delete_one, delete_many = recorder.ops
+    assert insert == {"_id": STORED_ID, "name": "n"}
+    assert update_one["q"] == {"_id": STORED_ID}
+    assert update_one["u"] == {"$set": {"status": "paid"}, "$setOnInsert": {"_id": STORED_ID}}
+    assert update_one["upsert"] is True
+    assert update_many["q"] == {"_id": {"$in": [STORED_ID]}} and update_many["multi"] is True
+    assert replace["q"] == {"_id": STORED_ID} and replace["u"] == {"_id": STORED_ID, "name": "m"}
+    assert delete_one["q"] == {"_id": STORED_ID} and delete_one["limit"] == 1
+    assert delete_many["q"] == {"_id": {"$in": [STORED_ID]}} and delete_many["limit"] == 0
+    # The caller's write models are copied, not rewritten
+    assert update._filter == {"id": APP_ID}
+
+
+def test_database_wraps_only_uuid_collections():
+    raw = MongoClient(connect=False)["test"]
+    db = UuidIdDatabase(raw)
+    assert isinstance(db.orders, UuidIdCollection) and db["orders"] is db.orders
+    assert db.orders_archive.name == "orders_archive" and not isinstance(db.orders_archive, UuidIdCollection)
+    assert db["product_pairs"].name == "product_pairs"
+
+
+def test_id_index_is_the_underscore_id_index():
+    class Collection:
+        async def create_index(self, keys, **kwargs):
+            return "created"
+
+    collection = UuidIdCollection(Collection())
+    assert asyncio.run(collection.create_index("id", unique=True)) == "_id_"
+    assert asyncio.run(collection.create_index([("user_id", 1)])) == "created"
@@ -0,0 +1,108 @@
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+import video_hls
+from video_hls import (
+    RENDITIONS, ladder_for, master_playlist, media_playlist, playlist_segments, segment_boundaries, sign_path,
+    signed_query, verify_path
+)
+
+SECRET = "test-secret"
+PATH = "/api/hls/p1/master.m3u8"
+NOW = 1_800_000_000.0
+
+STORED_PLAYLIST = """#EXTM3U
+#EXT-X-VERSION:3
+#EXT-X-TARGETDURATION:7
+#EXT-X-PLAYLIST-TYPE:VOD
+#EXTINF:6.000000,
+segment_00000.ts
+#EXTINF:5.500000,
+segment_00001.ts
+#EXT-X-ENDLIST
+"""
+
+
+def test_boundaries_split_evenly_without_chapters():
+    assert segment_boundaries(30, []) == [0.0, 6.0, 12.0, 18.0, 24.0]
+    assert segment_boundaries(4, []) == [0.0]
+
+
+def test_every_chapter_start_is_a_boundary():
+    boundaries = segment_boundaries(100, [95.5, 10, 47.25])
+    assert {10.0, 47.25, 95.5} <= set(boundaries)
+    assert boundaries == sorted(boundaries) and boundaries[0] == 0.0
+    # Pieces inside a chapter stay close to the target length
+    gaps = [b - a for a, b in zip(boundaries, boundaries[1:] + [100])]
+    assert all(video_hls.MIN_SEGMENT_SECONDS <= gap <= 1.5 * video_hls.SEGMENT_SECONDS for gap in gaps)
+
+
+def test_boundaries_ignore_chapters_at_the_edges_and_merge_near_duplicates():
+    # 0.5 and 19.5 sit within a second of the ends; 5.5 is under a second after 5
+    assert segment_boundaries(20, [0.5, 5, 5.5, 19.5]) == [0.0, 5.0, 12.75]
+    assert segment_boundaries(20, [5, 5.0004]) == segment_boundaries(20, [5])
+
+
+def test_ladder_never_upscales_but_keeps_the_smallest():
+    assert [r.name for r in ladder_for(720)] == ["720p", "480p", "360p"]
+    assert [r.name for r in ladder_for(2160)] == [r.name for r in RENDITIONS]
+    assert [r.name for r in ladder_for(240)] == ["360p"]
+
+
+def test_signed_path_verifies_until_it_expires():
+    signed = sign_path(SECRET, PATH, 60, now=NOW)
+    path, query = signed.split("?")
+    params = {key: value[0] for key, value in parse_qs(query).items()}
+    assert path == PATH and int(params["exp"]) == NOW + 60
+    assert verify_path(SECRET, PATH, int(params["exp"]), params["sig"], now=NOW + 59)
+    assert not verify_path(SECRET, PATH, int(params["exp"]), params["sig"], now=NOW + 61)
+
+
+@pytest.mark.parametrize("secret, path, shift", [
+    ("other-secret", PATH, 0),
+    (SECRET, "/api/hls/p2/master.m3u8", 0),
+    (SECRET, PATH, 3600),  # extending the expiry invalidates the signature
+])
+def test_signature_is_bound_to_secret_path_and_expiry(secret, path, shift):
+    expires = int(NOW + 60)
+    sig = parse_qs(signed_query(SECRET, PATH, expires))["sig"][0]
+    assert not verify_path(secret, path, expires + shift, sig, now=NOW)
+
+
+def test_media_playlist_rewrites_only_segment_lines():
+    playlist = media_playlist(STORED_PLAYLIST, lambda segment: f"https://cdn.example/{segment}?token=t")
+    lines = playlist.splitlines()
+    assert lines[5] == "https://cdn.example/segment_00000.ts?token=t"
+    assert lines[7] == "https://cdn.example/segment_00001.ts?token=t"
+    assert [line for line in lines if line.startswith("#")] == [
+        line for line in STORED_PLAYLIST.splitlines() if line.startswith("#")
+    ]
+    assert playlist_segments(STORED_PLAYLIST) == ["segment_00000.ts", "segment_00001.ts"]
+
+
+def test_master_playlist_lists_variants_by_bandwidth():
+    renditions = [
+        {"name": "360p", "height": 360, "bandwidth": 864000},
+        {"name": "720p", "height": 720, "bandwidth": 2928000},
+    ]
+    playlist = master_playlist(renditions, lambda name: f"{name}.m3u8?exp=1&sig=s")
+    assert playlist.splitlines() == [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        "#EXT-X-INDEPENDENT-SEGMENTS",
+        "#EXT-X-STREAM-INF:BANDWIDTH=2928000,RESOLUTION=1280x720",
+        "720p.m3u8?exp=1&sig=s",
+        "#EXT-X-STREAM-INF:BANDWIDTH=864000,RESOLUTION=640x360",
+        "360p.m3u8?exp=1&sig=s",
+    ]
+
+
+def test_segment_urls_are_expiring_cdn_token_urls(monkeypatch):
+    import server
+
+    monkeypatch.setattr(server, "CLOUDINARY_AUTH_TOKEN_KEY", "ab" * 16)
+    url = urlsplit(server.hls_segment_url("ecommerce/hls/p1/abc/720p/segment_00001.ts", 2_000_000_000))
+    assert url.netloc == "res.cloudinary.com"
+    assert url.path.endswith("/raw/authenticated/v1/ecommerce/hls/p1/abc/720p/segment_00001.ts")
+    assert parse_qs(url.query)["__cld_token__"][0].startswith("exp=2000000000~hmac=")